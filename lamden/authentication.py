@@ -17,11 +17,14 @@ DEFAULT_DOMAIN = '*'
 
 class SocketAuthenticator:
     def __init__(self, client: ContractingClient, ctx: zmq.asyncio.Context, bootnodes: dict={},
-                 loop=asyncio.get_event_loop(), domain='*', cert_dir=CERT_DIR, debug=False):
+                 loop=asyncio.get_event_loop(), domain='*', cert_dir=CERT_DIR, debug=False, governance=None):
 
         # Create the directory if it doesn't exist
         self.client = client
 
+        # Members are read through the node's governance cache when it has one
+        self.governance = governance
+
         self.cert_dir = pathlib.Path.home() / cert_dir
         self.cert_dir.mkdir(parents=True, exist_ok=True)
 
@@ -36,6 +39,11 @@ class SocketAuthenticator:
 
         self.bootnodes = bootnodes
 
+        # Curve public keys of the nodes allowed to connect, by verifying key. Connections are checked against these
+        # in memory. The key files are only written for socket pools, which read the server key of a peer from them.
+        self.keys = {}
+        self.allowed = set()
+
         # This should throw an exception if the socket already exist
         try:
             self.authenticator = AsyncioAuthenticator(context=self.ctx, loop=self.loop)
@@ -48,32 +56,42 @@ class SocketAuthenticator:
             for node in bootnodes.keys():
                 self.add_verifying_key(node)
 
-            self.authenticator.configure_curve(domain=self.domain, location=self.cert_dir)
+            self.configure()
+
+    def callback(self, domain, key):
+        # Called by the ZAP handler with the z85 encoded curve key of every connecting client
+        return key in self.allowed
 
     def refresh_governance_sockets(self):
-        masternode_list = self.client.get_var(
+        reader = self.client if self.governance is None else self.governance
+
+        masternode_list = reader.get_var(
             contract='masternodes',
             variable='S',
             arguments=['members']
         )
 
-        delegate_list = self.client.get_var(
+        delegate_list = reader.get_var(
             contract='delegates',
             variable='S',
             arguments=['members']
         )
 
-        self.flush_all_keys()
+        members = masternode_list + delegate_list
 
-        for mn in masternode_list:
-            self.add_verifying_key(mn)
+        # This runs after every block, but the members rarely change
+        if set(members) == set(self.keys.keys()):
+            return members
 
-        for dl in delegate_list:
-            self.add_verifying_key(dl)
+        for vk in set(self.keys.keys()) - set(members):
+            self.remove_verifying_key(vk)
+
+        for vk in members:
+            self.add_verifying_key(vk)
 
         self.log.info(f'Refreshing keys for {len(masternode_list)} masters and {len(delegate_list)} delegates.')
 
-        self.authenticator.configure_curve(domain=self.domain, location=self.cert_dir)
+        return members
 
     def add_verifying_key(self, vk: str):
         # Convert to bytes if hex string
@@ -86,12 +104,36 @@ class SocketAuthenticator:
             self.log.error('ED25519 Cryptographic error. The key provided is not within the cryptographic key space.')
             return
 
-        zvk = z85.encode(pk).decode('utf-8')
-        _write_key_file(self.cert_dir / f'{vk}.key', banner=_cert_public_banner, public_key=zvk)
+        zvk = z85.encode(pk)
+
+        if self.keys.get(vk) == zvk:
+            return
+
+        self.keys[vk] = zvk
+        self.allowed.add(zvk)
+
+        _write_key_file(self.cert_dir / f'{vk}.key', banner=_cert_public_banner, public_key=zvk.decode('utf-8'))
+
+    def remove_verifying_key(self, vk: str):
+        zvk = self.keys.pop(vk, None)
+
+        if zvk is None:
+            return
+
+        self.allowed.discard(zvk)
+
+        try:
+            (self.cert_dir / f'{vk}.key').unlink()
+        except FileNotFoundError:
+            pass
 
     def flush_all_keys(self):
+        self.keys.clear()
+        self.allowed.clear()
+
         shutil.rmtree(str(self.cert_dir))
         self.cert_dir.mkdir(parents=True, exist_ok=True)
 
     def configure(self):
-        self.authenticator.configure_curve(domain=self.domain, location=self.cert_dir)
+        # Keys are looked up in memory as clients connect, so adding or removing one needs no reconfiguring
+        self.authenticator.configure_curve_callback(domain=self.domain, credentials_provider=self)
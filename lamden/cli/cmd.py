@@ -1,14 +1,22 @@
 import argparse
 from lamden.cli.start import start_node, join_network
 # from lamden.cli.update import verify_access, verify_pkg, trigger, vote, check_ready_quorum
-from lamden.storage import BlockStorage
+from lamden.storage import BlockStorage, FileBlockStorage, NonceStorage
 from contracting.client import ContractDriver, ContractingClient
 from lamden.contracts import sync
+from lamden import db_config
+
+
+def flush_block_dir(args):
+    # Nodes started with --block_storage file keep their blocks on disk rather than in Mongo
+    if args.block_dir is not None:
+        FileBlockStorage(root=args.block_dir).flush()
 
 
 def flush(args):
     if args.storage_type == 'blocks':
         BlockStorage().drop_collections()
+        flush_block_dir(args)
         print('All blocks deleted.')
     elif args.storage_type == 'state':
         ContractDriver().flush()
@@ -22,12 +30,39 @@ def flush(args):
             b.client.drop_database(db)
 
         ContractDriver().flush()
+        flush_block_dir(args)
         print('All blocks deleted.')
         print('State deleted.')
     else:
         print('Invalid option. < blocks | state | all >')
 
 
+def indexes(args):
+    storages = [
+        BlockStorage(ensure_indexes=False),
+        NonceStorage(ensure_indexes=False)
+    ]
+
+    for s in storages:
+        if args.create:
+            # Unique indexes cannot be built while duplicates are left from older versions
+            for collection, removed in s.remove_duplicates().items():
+                if removed > 0:
+                    print(f'{collection}: removed {removed} duplicate documents.')
+
+            s.create_indexes()
+
+        for collection, missing in s.index_report().items():
+            if len(missing) == 0:
+                print(f'{collection}: all indexes present.')
+            else:
+                print(f'{collection}: missing indexes {", ".join(missing)}. Run with --create to build them.')
+
+        for query, stages in s.query_plans().items():
+            health = 'COLLECTION SCAN' if 'COLLSCAN' in stages else 'indexed'
+            print(f'{query}: {" <- ".join(stages)} ({health})')
+
+
 def setup_cilparser(parser):
     # create parser for update commands
     subparser = parser.add_subparsers(title='subcommands', description='Network update commands',
@@ -41,9 +76,17 @@ def setup_cilparser(parser):
     start_parser.add_argument('-wp', '--webserver_port', type=int, default=18080)
     start_parser.add_argument('-p', '--pid', type=int, default=-1)
     start_parser.add_argument('-b', '--bypass_catchup', type=bool, default=False)
+    start_parser.add_argument('-bs', '--block_storage', type=str, default='mongo', choices=['mongo', 'file'])
+    start_parser.add_argument('-bd', '--block_dir', type=str, default=db_config.BLOCK_DIR)
+    start_parser.add_argument('-si', '--snapshot_interval', type=int, default=1000)
+    start_parser.add_argument('-sd', '--snapshot_dir', type=str, default=db_config.SNAPSHOT_DIR)
+    start_parser.add_argument('-q', '--quorum', type=float, default=1.0)
+    start_parser.add_argument('-fo', '--fanout', type=int, default=0)
+    start_parser.add_argument('-w', '--workers', type=int, default=0)
 
     flush_parser = subparser.add_parser('flush')
     flush_parser.add_argument('storage_type', type=str)
+    flush_parser.add_argument('-bd', '--block_dir', type=str, default=None)
 
     join_parser = subparser.add_parser('join')
     join_parser.add_argument('node_type', type=str)
@@ -51,9 +94,19 @@ def setup_cilparser(parser):
     join_parser.add_argument('-m', '--mn_seed', type=str)
     join_parser.add_argument('-mp', '--mn_seed_port', type=int, default=18080)
     join_parser.add_argument('-wp', '--webserver_port', type=int, default=18080)
+    join_parser.add_argument('-bs', '--block_storage', type=str, default='mongo', choices=['mongo', 'file'])
+    join_parser.add_argument('-bd', '--block_dir', type=str, default=db_config.BLOCK_DIR)
+    join_parser.add_argument('-si', '--snapshot_interval', type=int, default=1000)
+    join_parser.add_argument('-sd', '--snapshot_dir', type=str, default=db_config.SNAPSHOT_DIR)
+    join_parser.add_argument('-q', '--quorum', type=float, default=1.0)
+    join_parser.add_argument('-fo', '--fanout', type=int, default=0)
+    join_parser.add_argument('-w', '--workers', type=int, default=0)
 
     sync_parser = subparser.add_parser('sync')
 
+    indexes_parser = subparser.add_parser('indexes')
+    indexes_parser.add_argument('-c', '--create', action='store_true')
+
     return True
 
 
@@ -76,6 +129,9 @@ def main():
     elif args.command == 'join':
         join_network(args)
 
+    elif args.command == 'indexes':
+        indexes(args)
+
     elif args.command == 'sync':
         client = ContractingClient()
         sync.flush_sys_contracts(client=client)
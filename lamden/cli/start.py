@@ -12,6 +12,7 @@ from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
 
 from lamden.crypto.wallet import Wallet
+from lamden.storage import BlockStorage, FileBlockStorage, SnapshotStorage
 from lamden.nodes.masternode.masternode import Masternode
 from lamden.nodes.delegate.delegate import Delegate
 
@@ -30,6 +31,20 @@ def start_mongo():
         time.sleep(3)
 
 
+def resolve_block_storage(args):
+    # Contract state and nonces still live in Mongo, so Mongo has to be running either way
+    if args.block_storage == 'file':
+        return FileBlockStorage(root=args.block_dir)
+    return BlockStorage()
+
+
+def resolve_snapshots(args):
+    # An interval of 0 turns snapshots off
+    if args.snapshot_interval <= 0:
+        return None
+    return SnapshotStorage(root=args.snapshot_dir)
+
+
 def print_ascii_art():
     print('''
                 ##
@@ -139,7 +154,12 @@ def start_node(args):
             constitution=const,
             webserver_port=args.webserver_port,
             bypass_catchup=args.bypass_catchup,
-            node_type=args.node_type
+            node_type=args.node_type,
+            blocks=resolve_block_storage(args),
+            snapshots=resolve_snapshots(args),
+            snapshot_interval=args.snapshot_interval,
+            discovery_quorum=args.quorum,
+            fanout=args.fanout
         )
     elif args.node_type == 'delegate':
         n = Delegate(
@@ -149,7 +169,9 @@ def start_node(args):
             bootnodes=bootnodes,
             constitution=const,
             bypass_catchup=args.bypass_catchup,
-            node_type=args.node_type
+            node_type=args.node_type,
+            discovery_quorum=args.quorum,
+            workers=args.workers
         )
 
     loop = asyncio.get_event_loop()
@@ -195,7 +217,12 @@ def join_network(args):
             webserver_port=args.webserver_port,
             bootnodes=bootnodes,
             seed=mn_seed,
-            node_type=args.node_type
+            node_type=args.node_type,
+            blocks=resolve_block_storage(args),
+            snapshots=resolve_snapshots(args),
+            snapshot_interval=args.snapshot_interval,
+            discovery_quorum=args.quorum,
+            fanout=args.fanout
         )
     elif args.node_type == 'delegate':
         start_mongo()
@@ -206,7 +233,9 @@ def join_network(args):
             constitution=const,
             bootnodes=bootnodes,
             seed=mn_seed,
-            node_type=args.node_type
+            node_type=args.node_type,
+            discovery_quorum=args.quorum,
+            workers=args.workers
         )
 
     loop = asyncio.get_event_loop()
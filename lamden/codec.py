@@ -0,0 +1,185 @@
+from contracting.db.encoder import encode, decode, as_object
+from contracting.stdlib.bridge.decimal import ContractingDecimal, fix_precision
+from contracting.stdlib.bridge.time import Datetime, Timedelta
+import decimal
+import math
+import msgpack
+import zlib
+
+# Wire formats for router traffic. JSON is what every node understands. Binary is msgpack with contracting's types
+# packed as extension types, and is only used with peers that have said they support it.
+JSON = 'json'
+BINARY = 'msgpack'
+
+FORMATS = [BINARY, JSON]
+
+# Large messages in either format can be zlib compressed against a preset dictionary. Peers that can read that
+# advertise COMPRESSION next to the formats they read.
+COMPRESSION = 'zlib-1'
+
+SUPPORTED = FORMATS + [COMPRESSION]
+
+# Binary and compressed messages start with a version byte. JSON text never starts with these, so what a message is
+# can be told from its first byte. A new binary layout or compression dictionary gets a new tag.
+BINARY_V1 = b'\x01'
+COMPRESSED_V1 = b'\x02'
+
+# Smaller messages are not worth the CPU. Level 1 gets nearly all of the size reduction of higher levels here,
+# because hashes and signatures hardly compress at all.
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 1
+
+# Upper bound on a decompressed message, so a small malicious frame cannot blow up into gigabytes
+MAX_MESSAGE_SIZE = 128 * 1024 * 1024
+
+# Keys repeated in every transaction, batch, subblock contender and block. The dictionary gives small messages,
+# which have no repetition of their own yet, the same head start as the tail of a large one. Changing it means a new
+# COMPRESSED tag and COMPRESSION name.
+DICTIONARY_KEYS = [
+    'service', 'msg', 'id', 'codecs', 'reply', 'name', 'arg', 'response', 'ok',
+    'transactions', 'timestamp', 'signature', 'sender', 'input_hash', 'metadata', 'payload', 'contract',
+    'function', 'kwargs', 'nonce', 'processor', 'stamps_supplied', 'hash', 'number', 'previous', 'subblocks',
+    'subblock', 'merkle_tree', 'leaves', 'signatures', 'signer', 'transaction', 'result', 'stamps_used', 'state',
+    'key', 'value', 'status', 'currency', 'transfer', 'amount', 'to', '__fixed__'
+]
+
+DICTIONARY_JSON = (
+    '{"hash":"","number":,"previous":"","subblocks":[{"input_hash":"","merkle_tree":{"leaves":["'
+    '"],"signature":""},"signatures":[{"signature":"","signer":""}],"subblock":0,"transactions":[{"hash":"'
+    '","result":"None","stamps_used":,"state":[{"key":"currency.balances:","value":{"__fixed__":"'
+    '"}}],"status":0,"transaction":{"metadata":{"signature":"","timestamp":},"payload":{"contract":"currency",'
+    '"function":"transfer","kwargs":{"amount":{"__fixed__":""},"to":""},"nonce":,"processor":"","sender":"",'
+    '"stamps_supplied":}}}]}]}{"service":"work","msg":{"transactions":[{"metadata":{"signature":"'
+)
+
+DICTIONARY = b''.join(msgpack.packb(key) for key in DICTIONARY_KEYS) + DICTIONARY_JSON.encode()
+
+FIXED_EXT = 1
+TIME_EXT = 2
+DELTA_EXT = 3
+
+# Ints msgpack has no room for. JSON has no limit on them, so neither can this.
+INT_EXT = 4
+
+
+def default(o):
+    if isinstance(o, ContractingDecimal):
+        return msgpack.ExtType(FIXED_EXT, str(fix_precision(o._d)).encode())
+    elif isinstance(o, decimal.Decimal):
+        return msgpack.ExtType(FIXED_EXT, str(fix_precision(o)).encode())
+    elif isinstance(o, Datetime):
+        return msgpack.ExtType(TIME_EXT, msgpack.packb(
+            [o.year, o.month, o.day, o.hour, o.minute, o.second, o.microsecond]
+        ))
+    elif isinstance(o, Timedelta):
+        return msgpack.ExtType(DELTA_EXT, msgpack.packb([o._timedelta.days, o._timedelta.seconds]))
+    elif isinstance(o, int):
+        return msgpack.ExtType(INT_EXT, str(o).encode())
+
+    raise TypeError(f'Cannot pack {type(o)}')
+
+
+def floats_as_decimals(o):
+    # msgpack packs floats itself without asking default. JSON reads them back as ContractingDecimal, so they are made
+    # decimals first and packed as FIXED_EXT, and read back the same whichever format a peer uses.
+    t = type(o)
+
+    if t == float:
+        return decimal.Decimal(repr(o)) if math.isfinite(o) else o
+    elif t == dict:
+        return {k: floats_as_decimals(v) for k, v in o.items()}
+    elif t == list or t == tuple:
+        return [floats_as_decimals(v) for v in o]
+
+    return o
+
+
+def ext_hook(code, data):
+    if code == FIXED_EXT:
+        return ContractingDecimal(data.decode())
+    elif code == TIME_EXT:
+        return Datetime(*msgpack.unpackb(data))
+    elif code == DELTA_EXT:
+        days, seconds = msgpack.unpackb(data)
+        return Timedelta(days=days, seconds=seconds)
+    elif code == INT_EXT:
+        return int(data.decode())
+
+    return msgpack.ExtType(code, data)
+
+
+def object_hook(d):
+    # Documents read back from storage hold the JSON forms of contracting's types, which are all single key dicts.
+    # Turn them into objects like the JSON decoder does.
+    if len(d) == 1:
+        return as_object(d)
+    return d
+
+
+def dumps(o, codec=JSON, compress=False):
+    data = None
+
+    if codec == BINARY:
+        try:
+            data = BINARY_V1 + msgpack.packb(floats_as_decimals(o), default=default, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError, RecursionError):
+            # Anything msgpack cannot take is sent as JSON, which every node can read
+            data = None
+
+    if data is None:
+        data = encode(o).encode()
+
+    if compress and len(data) >= COMPRESSION_THRESHOLD:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=DICTIONARY)
+        data = COMPRESSED_V1 + compressor.compress(data) + compressor.flush()
+
+    return data
+
+
+def decompress(data):
+    decompressor = zlib.decompressobj(zdict=DICTIONARY)
+
+    try:
+        data = decompressor.decompress(data, MAX_MESSAGE_SIZE)
+    except zlib.error:
+        return None
+
+    if decompressor.unconsumed_tail or data[:1] == COMPRESSED_V1:
+        return None
+
+    return data
+
+
+def accepts_compression(msg):
+    return type(msg) == dict and type(msg.get('codecs')) == list and COMPRESSION in msg['codecs']
+
+
+def loads(data):
+    return unpack(data)[0]
+
+
+def unpack(data):
+    # Returns the message and the format it came in, so a reply can be sent back in the same format. A message that
+    # cannot be decoded, like one with a malformed number or time in it, is returned as None.
+    if data[:1] == COMPRESSED_V1:
+        data = decompress(data[1:])
+
+        if data is None:
+            return None, JSON
+
+    if data[:1] == BINARY_V1:
+        try:
+            return msgpack.unpackb(
+                data[1:],
+                raw=False,
+                ext_hook=ext_hook,
+                object_hook=object_hook,
+                strict_map_key=False
+            ), BINARY
+        except Exception:
+            return None, BINARY
+
+    try:
+        return decode(data), JSON
+    except Exception:
+        return None, JSON
@@ -9,6 +9,9 @@ if DATA_DIR is None:
     DATA_DIR = '/usr/local/db/lamden'
 
 
+BLOCK_DIR = DATA_DIR + '/blocks'
+SNAPSHOT_DIR = DATA_DIR + '/snapshots'
+
 MONGO_DIR = DATA_DIR + '/mongo'
 MONGO_LOG_PATH = MONGO_DIR + '/logs/mongo.log'
 
@@ -0,0 +1,65 @@
+from contracting.client import ContractingClient
+
+
+class GovernanceCache:
+    # Caches governance variables between blocks. They only change when a block writes them, so every value read is
+    # kept until a block that writes its key is applied. Reads have the same signature as ContractingClient.get_var.
+    def __init__(self, client: ContractingClient):
+        self.client = client
+        self.values = {}
+
+        # Member lists as sets, for membership checks
+        self.sets = {}
+
+    def key(self, contract, variable, arguments=[]):
+        return self.client.raw_driver.make_key(contract, variable, arguments)
+
+    def get_var(self, contract, variable, arguments=[], mark=False):
+        key = self.key(contract, variable, arguments)
+
+        if key not in self.values:
+            self.values[key] = self.client.get_var(contract=contract, variable=variable, arguments=arguments)
+
+        return self.values[key]
+
+    def members(self, contract):
+        members = self.get_var(contract, 'S', ['members'])
+        return members if members is not None else []
+
+    def member_set(self, contract):
+        key = self.key(contract, 'S', ['members'])
+
+        if key not in self.sets:
+            self.sets[key] = set(self.members(contract))
+
+        return self.sets[key]
+
+    def masternodes(self):
+        return self.members('masternodes')
+
+    def delegates(self):
+        return self.members('delegates')
+
+    def is_member(self, vk):
+        return vk in self.member_set('masternodes') or vk in self.member_set('delegates')
+
+    def update(self, block):
+        # Forgets the values the block wrote. Returns whether any cached value changed.
+        written = set()
+
+        for sb in block.get('subblocks') or []:
+            for tx in sb['transactions']:
+                for delta in tx.get('state') or []:
+                    written.add(delta['key'])
+
+        stale = [key for key in written if key in self.values]
+        for key in stale:
+            del self.values[key]
+            self.sets.pop(key, None)
+
+        return len(stale) > 0
+
+    def clear(self):
+        # For state changed outside of blocks, like restoring a snapshot
+        self.values.clear()
+        self.sets.clear()
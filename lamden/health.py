@@ -0,0 +1,90 @@
+import time
+
+# Weight of a new round trip time in the smoothed one. Same as TCP uses.
+ALPHA = 0.125
+
+
+class Peer:
+    def __init__(self):
+        # Smoothed round trip time in seconds. None until the peer answers something.
+        self.rtt = None
+
+        # Failures in a row. Any answer resets it.
+        self.failures = 0
+        self.last_seen = None
+        self.height = None
+
+    def to_dict(self):
+        return {
+            'rtt': self.rtt,
+            'failures': self.failures,
+            'last_seen': self.last_seen,
+            'height': self.height
+        }
+
+
+class PeerTable:
+    def __init__(self, max_failures=3, unknown_rtt=1.0):
+        self.max_failures = max_failures
+
+        # What peers that have not answered anything yet are ranked as. Slower than a healthy peer, faster than one
+        # that only answers at the end of a timeout.
+        self.unknown_rtt = unknown_rtt
+
+        self.peers = {}
+
+    def get(self, vk):
+        peer = self.peers.get(vk)
+        if peer is None:
+            peer = Peer()
+            self.peers[vk] = peer
+
+        return peer
+
+    def succeeded(self, vk, rtt, now=None):
+        peer = self.get(vk)
+
+        if peer.rtt is None:
+            peer.rtt = rtt
+        else:
+            peer.rtt += ALPHA * (rtt - peer.rtt)
+
+        peer.failures = 0
+        peer.last_seen = time.time() if now is None else now
+
+    def failed(self, vk):
+        self.get(vk).failures += 1
+
+    def saw_height(self, vk, height):
+        self.get(vk).height = height
+
+    def alive(self, vk):
+        peer = self.peers.get(vk)
+        return peer is None or peer.failures < self.max_failures
+
+    def rank(self, peers: dict):
+        # Live peers first, then fastest first. Sorting is stable, so peers that tie keep the order they came in.
+        def key(vk):
+            peer = self.peers.get(vk)
+            if peer is None or peer.rtt is None:
+                return not self.alive(vk), self.unknown_rtt
+
+            return not self.alive(vk), peer.rtt
+
+        return {vk: peers[vk] for vk in sorted(peers.keys(), key=key)}
+
+    def best(self, peers: dict):
+        # The verifying key of the best live peer, or None if they are all dead
+        for vk in self.rank(peers).keys():
+            if self.alive(vk):
+                return vk
+
+    def snapshot(self):
+        return {vk: peer.to_dict() for vk, peer in self.peers.items()}
+
+    def clear(self):
+        self.peers.clear()
+
+
+# Health of every peer this process talks to. Socket pools record into it on every request.
+TABLE = PeerTable()
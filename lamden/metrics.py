@@ -0,0 +1,94 @@
+from collections import defaultdict
+import bisect
+
+# Upper bounds of the histogram buckets in seconds. They double from 0.1ms to about 13s.
+BUCKETS = [0.0001 * 2 ** i for i in range(18)]
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket the quantile falls in, so at most one bucket off
+        if self.count == 0:
+            return 0
+
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+
+        return self.max
+
+    def bounds(self):
+        return [f'{bound:g}' for bound in self.buckets] + ['inf']
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': {bound: count for bound, count in zip(self.bounds(), self.counts) if count > 0}
+        }
+
+
+def label_key(labels: dict):
+    return ','.join(f'{k}={v}' for k, v in sorted(labels.items()))
+
+
+class Registry:
+    def __init__(self):
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.histograms = defaultdict(dict)
+
+    def inc(self, name, value=1, **labels):
+        self.counters[name][label_key(labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = label_key(labels)
+
+        histogram = self.histograms[name].get(key)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name][key] = histogram
+
+        histogram.observe(value)
+
+    def counter(self, name, **labels):
+        return self.counters[name].get(label_key(labels), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms[name].get(label_key(labels))
+
+    def snapshot(self):
+        return {
+            'counters': {name: dict(values) for name, values in self.counters.items()},
+            'histograms': {
+                name: {key: histogram.to_dict() for key, histogram in values.items()}
+                for name, values in self.histograms.items()
+            }
+        }
+
+    def clear(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+
+# Metrics for everything in this process. The masternode webserver serves them at /metrics.
+REGISTRY = Registry()
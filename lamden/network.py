@@ -2,12 +2,14 @@ import time
 import hashlib
 import asyncio
 import os
+import random
 import zmq.asyncio
 from contracting.db.encoder import encode
 
 from lamden.formatting import rules, primatives
 from lamden.crypto.wallet import Wallet, verify
-from lamden import router
+from lamden import router, health
+from lamden.router import LOW
 from lamden.logger.base import get_logger
 
 PROOF_EXPIRY = 15
@@ -113,11 +115,53 @@ class JoinProcessor(router.Processor):
 #    ip: vk
 # }
 
+class Backoff:
+    # Exponential backoff per key. Every failure doubles the wait before the key is tried again, up to maximum
+    # seconds. A success brings it back to minimum.
+    def __init__(self, minimum=0.25, maximum=8):
+        self.minimum = minimum
+        self.maximum = maximum
+
+        self.delays = {}
+        self.next_attempt = {}
+
+    def ready(self, key, now):
+        return self.next_attempt.get(key, 0) <= now
+
+    def failed(self, key, now):
+        delay = min(self.delays.get(key, self.minimum / 2) * 2, self.maximum)
+        self.delays[key] = delay
+
+        # Jitter keeps nodes that started together from retrying in lockstep
+        self.next_attempt[key] = now + delay * random.uniform(0.75, 1)
+
+    def succeeded(self, key, now):
+        self.delays[key] = self.minimum
+        self.next_attempt[key] = now + self.minimum
+
+    def wait_time(self, keys, now):
+        # Seconds until the first of keys can be tried again
+        waits = [self.next_attempt.get(key, 0) - now for key in keys]
+        return max(min(waits, default=self.minimum), 0)
+
+
 class Network:
-    def __init__(self, wallet: Wallet, ip_string: str, ctx: zmq.asyncio.Context, router: router.Router, pepper: str=PEPPER):
+    def __init__(self, wallet: Wallet, ip_string: str, ctx: zmq.asyncio.Context, router: router.Router, pepper: str=PEPPER,
+                 min_delay=0.25, max_delay=8, heartbeat_interval=5):
         self.wallet = wallet
         self.ctx = ctx
 
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+        # Keeps looking for the peers that were not found yet when start returned at a quorum
+        self.discovery = None
+
+        # Every peer is pinged this often so their round trip times and liveness stay current
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeats = None
+        self.health = health.TABLE
+
         self.peers = {
             self.wallet.verifying_key: ip_string
         }
@@ -130,9 +174,10 @@ class Network:
         self.peer_processor = PeerProcessor(peers=self.peers)
         self.log = get_logger('Peers')
 
-        router.add_service(JOIN_SERVICE, self.join_processor)
+        # Peer discovery can wait behind consensus messages
+        router.add_service(JOIN_SERVICE, self.join_processor, priority=LOW, max_queue=100)
         router.add_service(IDENTITY_SERVICE, self.identity_processor)
-        router.add_service(PEER_SERVICE, self.peer_processor)
+        router.add_service(PEER_SERVICE, self.peer_processor, priority=LOW, max_queue=100)
 
         self.join_msg = {
             'ip': ip_string,
@@ -143,37 +188,114 @@ class Network:
         for peer in peers['peers']:
             self.peers[peer['vk']] = peer['ip']
 
-    async def start(self, bootnodes: dict, vks: list):
-        # Join all bootnodes
-        while not self.all_vks_found(vks):
+    async def start(self, bootnodes: dict, vks: list, quorum=1.0):
+        # Returns once quorum (a fraction) of vks are found. The rest are looked for in the background.
+        await self.discover(bootnodes, vks, quorum)
+
+        if not self.all_vks_found(vks):
+            self.log.info(f'Quorum found. Looking for the rest of the peers in the background.')
+            self.discovery = asyncio.ensure_future(self.discover(bootnodes, vks))
+        else:
+            self.log.info(f'All peers found. Continuing startup process.')
+
+    async def discover(self, bootnodes: dict, vks: list, quorum=1.0):
+        joins = Backoff(minimum=self.min_delay, maximum=self.max_delay)
+        probes = Backoff(minimum=self.min_delay, maximum=self.max_delay)
+
+        while not self.quorum_found(vks, quorum):
+            due = {vk: ip for vk, ip in bootnodes.items() if joins.ready(vk, time.time())}
+
+            peers = await self.join(due, joins)
+
+            # Only new peers are asked for an identity proof, and ones that did not answer wait out their backoff
+            now = time.time()
+            peers = {
+                vk: ip for vk, ip in peers.items() if self.peers.get(vk) is None and probes.ready((vk, ip), now)
+            }
+
+            await self.probe(peers, probes)
+
+            self.log.info(f'{len(self.found(vks))}/{len(vks)} peers found.')
+
+            if not self.quorum_found(vks, quorum):
+                await asyncio.sleep(max(joins.wait_time(bootnodes.keys(), time.time()), self.min_delay))
+
+    async def join(self, bootnodes: dict, backoff: Backoff):
+        # Returns the peers the bootnodes know about, by verifying key
+        vks = list(bootnodes.keys())
+
+        coroutines = [router.secure_request(msg=self.join_msg, service=JOIN_SERVICE, wallet=self.wallet,
+                                            ctx=self.ctx, ip=bootnodes[vk], vk=vk) for vk in vks]
+
+        results = await asyncio.gather(*coroutines)
+
+        peers = {}
+        for vk, result in zip(vks, results):
+            if type(result) != dict or type(result.get('peers')) != list:
+                backoff.failed(vk, time.time())
+                continue
+
+            backoff.succeeded(vk, time.time())
+
+            for peer in result['peers']:
+                peers[peer.get('vk')] = peer.get('ip')
+
+        return peers
+
+    async def probe(self, peers: dict, backoff: Backoff):
+        # Requests to the same node share its connection, so every identity proof can be asked for at once
+        vks = list(peers.keys())
+
+        coroutines = [router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet,
+                                            vk=vk, ip=peers[vk], ctx=self.ctx) for vk in vks]
+
+        responses = await asyncio.gather(*coroutines)
+
+        for vk, response in zip(vks, responses):
+            if response is None:
+                LOGGER.error(f'No response for identity proof for {peers[vk]}')
+                backoff.failed((vk, peers[vk]), time.time())
+                continue
+
+            backoff.succeeded((vk, peers[vk]), time.time())
+
+            self.peers[vk] = peers[vk]
+            self.log.info(f'{vk} -> {peers[vk]}')
 
-            coroutines = [router.secure_request(msg=self.join_msg, service=JOIN_SERVICE, wallet=self.wallet,
-                                                ctx=self.ctx, ip=ip, vk=vk) for vk, ip, in bootnodes.items()]
+    def start_heartbeat(self):
+        if self.heartbeats is None or self.heartbeats.done():
+            self.heartbeats = asyncio.ensure_future(self.heartbeat())
 
-            results = await asyncio.gather(*coroutines)
+    async def heartbeat(self):
+        while True:
+            await self.ping()
+            await asyncio.sleep(self.heartbeat_interval)
 
-            for result in results:
-                if result is None or result == {'response': 'ok'}:
-                    continue
+    async def ping(self):
+        # Socket pools record the round trip time or failure of every request in the health table
+        peers = {vk: ip for vk, ip in self.peers.items() if vk != self.vk}
 
-                self.log.info(result)
+        await asyncio.gather(*[
+            router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet, vk=vk, ip=ip, ctx=self.ctx)
+            for vk, ip in peers.items()
+        ])
 
-                for peer in result['peers']:
+    def best_peer(self, vks):
+        # The healthiest, fastest of vks that has been found, other than ourselves
+        return self.health.best({vk: self.peers[vk] for vk in self.found(vks) if vk != self.vk})
 
-                    response = await router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet,
-                                                           vk=peer.get('vk'),
-                                                           ip=peer.get('ip'), ctx=self.ctx)
+    def found(self, vks):
+        return [vk for vk in vks if self.peers.get(vk) is not None]
 
-                    if response is None:
-                        LOGGER.error(f'No response for identity proof for {peer.get("ip")}')
-                        continue
+    def quorum_found(self, vks, quorum=1.0):
+        return len(self.found(vks)) >= quorum * len(vks)
 
-                    if self.peers.get(peer['vk']) is None:
-                        self.peers[peer['vk']] = peer['ip']
-                        self.log.info(f'{peer["vk"]} -> {peer["ip"]}')
+    def stop(self):
+        if self.discovery is not None:
+            self.discovery.cancel()
 
-            self.log.info(f'{len(self.peers)}/{len(vks)} peers found.')
-        self.log.info(f'All peers found. Continuing startup process.')
+        if self.heartbeats is not None:
+            self.heartbeats.cancel()
 
     def all_vks_found(self, vks):
         for vk in vks:
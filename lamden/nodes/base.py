@@ -1,12 +1,12 @@
-from lamden import storage, network, router, authentication, rewards, upgrade
+from lamden import storage, network, router, authentication, rewards, upgrade, relay, governance
 from lamden.crypto import canonical
 from lamden.crypto.wallet import Wallet
 from lamden.contracts import sync
-from contracting.db.driver import ContractDriver, encode
+from contracting.db.driver import ContractDriver
 import lamden
 import zmq.asyncio
 import asyncio
-import json
+from collections import deque
 from contracting.client import ContractingClient
 import uvloop
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -18,9 +18,15 @@ BLOCK_SERVICE = 'catchup'
 NEW_BLOCK_SERVICE = 'new_blocks'
 WORK_SERVICE = 'work'
 CONTENDER_SERVICE = 'contenders'
+SNAPSHOT_SERVICE = 'snapshots'
 
 GET_BLOCK = 'get_block'
+GET_BLOCKS = 'get_blocks'
 GET_HEIGHT = 'get_height'
+GET_SNAPSHOT = 'get_snapshot'
+GET_SNAPSHOT_CHUNK = 'get_snapshot_chunk'
+
+FAILED_BLOCK_HASH = 'f' * 64
 
 
 async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
@@ -59,18 +65,75 @@ async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.a
     return response
 
 
+async def get_blocks(start: int, end: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
+    msg = {
+        'name': GET_BLOCKS,
+        'arg': [start, end]
+    }
+
+    response = await router.secure_request(
+        ip=ip,
+        vk=vk,
+        wallet=wallet,
+        service=BLOCK_SERVICE,
+        msg=msg,
+        ctx=ctx,
+    )
+
+    return response
+
+
+async def get_snapshot(wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
+    msg = {
+        'name': GET_SNAPSHOT,
+        'arg': ''
+    }
+
+    response = await router.secure_request(
+        ip=ip,
+        vk=vk,
+        wallet=wallet,
+        service=SNAPSHOT_SERVICE,
+        msg=msg,
+        ctx=ctx,
+    )
+
+    return response
+
+
+async def get_snapshot_chunk(height: int, part: str, index: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
+    msg = {
+        'name': GET_SNAPSHOT_CHUNK,
+        'arg': [height, part, index]
+    }
+
+    response = await router.secure_request(
+        ip=ip,
+        vk=vk,
+        wallet=wallet,
+        service=SNAPSHOT_SERVICE,
+        msg=msg,
+        ctx=ctx,
+    )
+
+    return response
+
+
 class NewBlock(router.Processor):
     def __init__(self, driver: ContractDriver):
         self.q = []
         self.driver = driver
         self.log = get_logger('NBN')
 
+        self.notifier = router.Notifier()
+
     async def process_message(self, msg):
         self.q.append(msg)
+        self.notifier.notify()
 
     async def wait_for_next_nbn(self):
         while len(self.q) <= 0:
-            await asyncio.sleep(0)
+            await self.notifier.wait()
 
         nbn = self.q.pop(0)
 
@@ -82,6 +145,162 @@ class NewBlock(router.Processor):
         self.q = [nbn for nbn in self.q if nbn['number'] > height]
 
 
+class CatchupManager:
+    def __init__(self, fetch, process, peers: dict, window=100, buffer_size=1000, max_failures=3, depth=2):
+        # fetch(start, end, vk, ip) is a coroutine returning a list of blocks. process(block) applies a single block.
+        self.fetch = fetch
+        self.process = process
+        self.peers = peers
+
+        # Blocks requested per call, and how far past the next block to apply fetching may run ahead
+        self.window = window
+        self.buffer_size = buffer_size
+        self.max_failures = max_failures
+
+        # Requests in flight per peer. They share the peer's connection.
+        self.depth = depth
+
+        self.windows = deque()
+        self.buffer = {}
+        self.failures = {}
+
+        self.height = 0
+        self.latest = 0
+        self.previous_hash = None
+        self.fetching = 0
+        self.condition = None
+
+        self.log = get_logger('Catchup')
+
+    async def run(self, start, latest, previous_hash):
+        self.windows = deque(
+            (s, min(s + self.window, latest + 1)) for s in range(start, latest + 1, self.window)
+        )
+        self.buffer = {}
+        self.failures = {vk: 0 for vk in self.peers.keys()}
+
+        self.height = start
+        self.latest = latest
+        self.previous_hash = previous_hash
+        self.fetching = len(self.peers) * self.depth
+        self.condition = asyncio.Condition()
+
+        # Fetchers for every peer fill the buffer while the applier drains it in height order
+        await asyncio.gather(
+            self.apply_blocks(),
+            *[self.fetch_blocks(vk, ip) for vk, ip in self.peers.items() for _ in range(self.depth)]
+        )
+
+        return self.height - 1
+
+    def can_fetch(self):
+        if self.height > self.latest:
+            return True
+
+        return len(self.windows) > 0 and self.windows[0][0] < self.height + self.buffer_size
+
+    def can_apply(self):
+        return self.height in self.buffer or self.fetching == 0
+
+    async def fetch_blocks(self, vk, ip):
+        try:
+            while self.failures[vk] < self.max_failures:
+                async with self.condition:
+                    await self.condition.wait_for(self.can_fetch)
+
+                    if self.height > self.latest:
+                        return
+
+                    start, end = self.windows.popleft()
+
+                try:
+                    blocks = await self.fetch(start, end, vk, ip)
+                except Exception as e:
+                    self.log.error(f'Could not get blocks {start}-{end - 1} from {vk}: {e}')
+                    blocks = None
+
+                async with self.condition:
+                    self.receive(start, end, blocks, vk)
+                    self.condition.notify_all()
+
+            self.log.error(f'Too many bad responses from {vk}. No longer fetching from it.')
+        finally:
+            async with self.condition:
+                self.fetching -= 1
+                self.condition.notify_all()
+
+    def receive(self, start, end, blocks, vk):
+        if type(blocks) != list:
+            blocks = []
+
+        blocks = blocks[:end - start]
+
+        if len(blocks) == 0 or not blocks_are_linked(start, blocks):
+            self.log.error(f'Bad response for blocks {start}-{end - 1} from {vk}.')
+            self.failures[vk] += 1
+            self.windows.appendleft((start, end))
+            return
+
+        received = start + len(blocks)
+        for block in blocks:
+            self.buffer[block['number']] = (block, vk, received)
+
+        # Responses are capped in size, so request whatever is left of the window again
+        if received < end:
+            self.windows.appendleft((received, end))
+
+    async def apply_blocks(self):
+        while self.height <= self.latest:
+            async with self.condition:
+                await self.condition.wait_for(self.can_apply)
+
+                if self.height not in self.buffer:
+                    self.log.error(f'No peers left to catch up from. Stopped at block {self.height - 1}.')
+                    return
+
+                block, vk, received = self.buffer.pop(self.height)
+
+                # Blocks were checked against each other on arrival. Check this one against what was applied last.
+                if block['previous'] != self.previous_hash:
+                    self.log.error(f'Block {self.height} from {vk} does not link to the previous block.')
+                    self.failures[vk] += 1
+
+                    for number in range(self.height + 1, received):
+                        self.buffer.pop(number, None)
+
+                    self.windows.appendleft((self.height, received))
+                    self.condition.notify_all()
+                    continue
+
+            self.process(block)
+
+            if block['hash'] != FAILED_BLOCK_HASH:
+                self.previous_hash = block['hash']
+
+            async with self.condition:
+                self.height += 1
+                self.condition.notify_all()
+
+            # Let the fetchers run between blocks
+            await asyncio.sleep(0)
+
+
+def blocks_are_linked(start, blocks):
+    previous_hash = None
+
+    for i, block in enumerate(blocks):
+        if type(block) != dict or block.get('number') != start + i:
+            return False
+
+        if previous_hash is not None and block.get('previous') != previous_hash:
+            return False
+
+        if block.get('hash') != FAILED_BLOCK_HASH:
+            previous_hash = block.get('hash')
+
+    return True
+
+
 def ensure_in_constitution(verifying_key: str, constitution: dict):
     masternodes = constitution['masternodes']
     delegates = constitution['delegates']
@@ -93,9 +312,18 @@ def ensure_in_constitution(verifying_key: str, constitution: dict):
 
 
 class Node:
-    def __init__(self, socket_base, ctx: zmq.asyncio.Context, wallet, constitution: dict, bootnodes={}, blocks=storage.BlockStorage(),
+    def __init__(self, socket_base, ctx: zmq.asyncio.Context, wallet, constitution: dict, bootnodes={}, blocks: storage.BlockStore=None,
                  driver=ContractDriver(), debug=True, store=False, seed=None, bypass_catchup=False, node_type=None,
-                 genesis_path=lamden.contracts.__path__[0], reward_manager=rewards.RewardManager(), nonces=storage.NonceStorage()):
+                 genesis_path=lamden.contracts.__path__[0], reward_manager=rewards.RewardManager(), nonces=None,
+                 use_snapshots=True, discovery_quorum=1.0):
+
+        # Storage is created here rather than as default arguments because it creates its indexes on construction,
+        # which needs Mongo to be running
+        if blocks is None:
+            blocks = storage.BlockStorage()
+
+        if nonces is None:
+            nonces = storage.CachedNonceStorage()
 
         self.driver = driver
         self.nonces = nonces
@@ -121,13 +349,21 @@ class Node:
         self.bootnodes = bootnodes
         self.constitution = constitution
 
+        # Fraction of the constitution that has to be found before startup continues
+        self.discovery_quorum = discovery_quorum
+
         self.seed_genesis_contracts()
 
+        # Members, stamp cost, reward ratios and upgrade state are read every round but change rarely
+        self.governance = governance.GovernanceCache(client=self.client)
+
         self.socket_authenticator = authentication.SocketAuthenticator(
-            bootnodes=self.bootnodes, ctx=self.ctx, client=self.client
+            bootnodes=self.bootnodes, ctx=self.ctx, client=self.client, governance=self.governance
         )
 
-        self.upgrade_manager = upgrade.UpgradeManager(client=self.client, wallet=self.wallet, node_type=node_type)
+        self.upgrade_manager = upgrade.UpgradeManager(
+            client=self.client, wallet=self.wallet, node_type=node_type, governance=self.governance
+        )
 
         self.router = router.Router(
             socket_id=socket_base,
@@ -144,7 +380,21 @@ class Node:
         )
 
         self.new_block_processor = NewBlock(driver=self.driver)
-        self.router.add_service(NEW_BLOCK_SERVICE, self.new_block_processor)
+        # Only the latest block notifications matter, so old ones make room for new ones
+        self.router.add_service(
+            NEW_BLOCK_SERVICE, self.new_block_processor, priority=router.HIGH, policy=router.DROP_OLDEST
+        )
+
+        # Blocks and work can reach us through other nodes when masternodes fan them out through a relay tree
+        self.relay_processor = relay.RelayProcessor(
+            router=self.router,
+            ctx=self.ctx,
+            wallet=self.wallet,
+            services=[NEW_BLOCK_SERVICE, WORK_SERVICE],
+            peers=self.network.peers,
+            cert_dir=self.socket_authenticator.cert_dir
+        )
+        self.router.add_service(relay.RELAY_SERVICE, self.relay_processor, priority=router.HIGH)
 
         self.running = False
         self.upgrade = False
@@ -156,6 +406,10 @@ class Node:
 
         self.bypass_catchup = bypass_catchup
 
+        # Restore the seed's latest state snapshot during catchup instead of replaying every block. Nodes that store
+        # blocks never do this, because they need the full chain to serve catchup to others.
+        self.use_snapshots = use_snapshots and not store
+
     def seed_genesis_contracts(self):
         self.log.info('Setting up genesis contracts.')
         sync.setup_genesis_contracts(
@@ -170,12 +424,10 @@ class Node:
         # Get the current latest block stored and the latest block of the network
         self.log.info('Running catchup.')
         current = self.current_height
-        latest = await get_latest_block_height(
-            ip=mn_seed,
-            vk=mn_vk,
-            wallet=self.wallet,
-            ctx=self.ctx
-        )
+
+        peers = self.catchup_peers(mn_seed=mn_seed, mn_vk=mn_vk)
+        mn_vk, latest = await self.latest_block_height(peers)
+        mn_seed = peers.get(mn_vk, mn_seed)
 
         self.log.info(f'Current block: {current}, Latest available block: {latest}')
 
@@ -183,33 +435,143 @@ class Node:
             self.log.info('No need to catchup. Proceeding.')
             return
 
-        # Increment current by one. Don't count the genesis block.
-        if current == 0:
-            current = 1
+        if self.use_snapshots:
+            await self.restore_snapshot(mn_seed=mn_seed, mn_vk=mn_vk)
+            current = self.current_height
 
-        # Find the missing blocks process them
-        for i in range(current, latest + 1):
-            block = await get_block(
-                block_num=i,
-                ip=mn_seed,
-                vk=mn_vk,
-                wallet=self.wallet,
-                ctx=self.ctx
-            )
-            self.process_new_block(block)
+        # Fetch from every masternode we know about while applying blocks in order
+        manager = CatchupManager(
+            fetch=self.fetch_blocks,
+            process=self.process_new_block,
+            peers=peers
+        )
+
+        # Start after the current block. Don't count the genesis block.
+        await manager.run(
+            start=current + 1,
+            latest=latest,
+            previous_hash=self.current_hash
+        )
 
         # Process any blocks that were made while we were catching up
         while len(self.new_block_processor.q) > 0:
             block = self.new_block_processor.q.pop(0)
             self.process_new_block(block)
 
+    async def restore_snapshot(self, mn_seed, mn_vk):
+        header = await get_snapshot(ip=mn_seed, vk=mn_vk, wallet=self.wallet, ctx=self.ctx)
+
+        if type(header) != dict or not all(k in header for k in ('height', 'hash', 'content_hash', 'state', 'nonces')):
+            self.log.info('Seed has no snapshot. Replaying all blocks.')
+            return False
+
+        if header['height'] <= self.current_height:
+            self.log.info(f'Snapshot at block #{header["height"]} is not ahead of us. Skipping it.')
+            return False
+
+        self.log.info(f'Downloading snapshot at block #{header["height"]}.')
+
+        snapshot = {
+            'height': header['height'],
+            'hash': header['hash'],
+            'content_hash': header['content_hash'],
+            'state': [],
+            'nonces': []
+        }
+
+        for part in ('state', 'nonces'):
+            for index in range(header[part]):
+                chunk = await get_snapshot_chunk(
+                    height=header['height'],
+                    part=part,
+                    index=index,
+                    ip=mn_seed,
+                    vk=mn_vk,
+                    wallet=self.wallet,
+                    ctx=self.ctx
+                )
+
+                if type(chunk) != list:
+                    self.log.error(f'Could not get snapshot chunk {part} {index}. Replaying all blocks.')
+                    return False
+
+                snapshot[part].extend(chunk)
+
+        if not storage.restore_snapshot(snapshot=snapshot, driver=self.driver, nonces=self.nonces):
+            return False
+
+        self.driver.clear_pending_state()
+
+        self.current_height = storage.get_latest_block_height(self.driver)
+        self.current_hash = storage.get_latest_block_hash(self.driver)
+
+        self.governance.clear()
+        self.socket_authenticator.refresh_governance_sockets()
+
+        self.log.info(f'Restored snapshot at block #{self.current_height}.')
+
+        return True
+
+    def catchup_peers(self, mn_seed, mn_vk):
+        # The seed first, then the other masternodes we know about from healthiest to least. Dead ones are left out.
+        others = {}
+
+        for vk in self.constitution['masternodes']:
+            ip = self.network.peers.get(vk)
+            if ip is not None and vk != self.wallet.verifying_key and vk != mn_vk and self.network.health.alive(vk):
+                others[vk] = ip
+
+        return {mn_vk: mn_seed, **self.network.health.rank(others)}
+
+    async def latest_block_height(self, peers: dict):
+        # Ask every peer at once so a seed that is down or slow does not hold us up. Returns the first peer with the
+        # highest block and that height, or the seed and None if nobody answered.
+        heights = await asyncio.gather(*[
+            get_latest_block_height(ip=ip, vk=vk, wallet=self.wallet, ctx=self.ctx) for vk, ip in peers.items()
+        ])
+
+        seed, latest = next(iter(peers.keys())), None
+        for vk, height in zip(peers.keys(), heights):
+            if type(height) != int:
+                continue
+
+            self.network.health.saw_height(vk, height)
+
+            if latest is None or height > latest:
+                seed, latest = vk, height
+
+        return seed, latest
+
+    async def fetch_blocks(self, start, end, vk, ip):
+        blocks = await get_blocks(
+            start=start,
+            end=end,
+            ip=ip,
+            vk=vk,
+            wallet=self.wallet,
+            ctx=self.ctx
+        )
+
+        # Seeds that do not know GET_BLOCKS reply with the default OK. Fall back to one block at a time.
+        if type(blocks) != list:
+            block = await get_block(
+                block_num=start,
+                ip=ip,
+                vk=vk,
+                wallet=self.wallet,
+                ctx=self.ctx
+            )
+            blocks = [block]
+
+        return blocks
+
     def should_process(self, block):
         self.log.info(f'Processing block #{block.get("number")}')
         # Test if block failed immediately
         if block == {'response': 'ok'}:
             return False
 
-        if block['hash'] == 'f' * 64:
+        if block['hash'] == FAILED_BLOCK_HASH:
             self.log.error('Failed Block! Not storing.')
             return False
 
@@ -257,12 +619,14 @@ class Node:
                 driver=self.driver,
                 nonces=self.nonces
             )
+            self.governance.update(block)
 
             self.log.info('Issuing rewards.')
             # Calculate and issue the rewards for the governance nodes
             self.reward_manager.issue_rewards(
                 block=block,
-                client=self.client
+                client=self.client,
+                governance=self.governance
             )
 
         self.log.info('Updating metadata.')
@@ -274,14 +638,15 @@ class Node:
     def process_new_block(self, block):
         # Update the state and refresh the sockets so new nodes can join
         self.update_state(block)
-        self.socket_authenticator.refresh_governance_sockets()
+        members = self.socket_authenticator.refresh_governance_sockets()
+
+        # Stop holding sockets open to nodes that have left
+        for pool in router.wallet_pools(ctx=self.ctx, wallet=self.wallet):
+            pool.retain(members)
 
         # Store the block if it's a masternode
         if self.store:
-            encoded_block = encode(block)
-            encoded_block = json.loads(encoded_block)
-
-            self.blocks.store_block(encoded_block)
+            self.blocks.store_block(storage.to_document(block))
 
         # Prepare for the next block by flushing out driver and notification state
         # self.new_block_processor.clean()
@@ -304,7 +669,8 @@ class Node:
         self.socket_authenticator.configure()
 
         # Use it to boot up the network
-        await self.network.start(bootnodes=self.bootnodes, vks=vks)
+        await self.network.start(bootnodes=self.bootnodes, vks=vks, quorum=self.discovery_quorum)
+        self.network.start_heartbeat()
 
         if not self.bypass_catchup:
             masternode_ip = None
@@ -317,8 +683,11 @@ class Node:
                         masternode = k
                         masternode_ip = v
             else:
-                masternode = self.constitution['masternodes'][0]
-                masternode_ip = self.network.peers[masternode]
+                # Starting at a quorum may leave some masternodes unfound, so take the best one that was found
+                masternode = self.network.best_peer(self.constitution['masternodes'])
+                if masternode is None:
+                    masternode = self.constitution['masternodes'][0]
+                masternode_ip = self.network.peers.get(masternode)
 
             self.log.info(f'Masternode Seed VK: {masternode}')
 
@@ -334,14 +703,16 @@ class Node:
     def stop(self):
         # Kill the router and throw the running flag to stop the loop
         self.router.stop()
+        self.network.stop()
+        for pool in router.wallet_pools(ctx=self.ctx, wallet=self.wallet):
+            pool.close()
         self.running = False
 
+        # Wake anything waiting for blocks so it sees the node has stopped
+        self.new_block_processor.notifier.notify()
+
     def _get_member_peers(self, contract_name):
-        members = self.client.get_var(
-            contract=contract_name,
-            variable='S',
-            arguments=['members']
-        )
+        members = self.governance.members(contract_name)
 
         member_peers = dict()
 
@@ -10,6 +10,7 @@ from lamden.crypto import transaction
 from contracting.client import ContractingClient
 from lamden import storage
 from collections import defaultdict
+from functools import partial
 WORK_SERVICE = 'work'
 
 
@@ -28,6 +29,8 @@ class WorkProcessor(router.Processor):
         self.client = client
         self.nonces = nonces
 
+        self.notifier = router.Notifier()
+
     async def process_message(self, msg):
         self.log.info(f'Received work from {msg["sender"][:8]}')
         if msg['sender'] not in self.masters:
@@ -44,11 +47,15 @@ class WorkProcessor(router.Processor):
 
         if not verify(vk=msg['sender'], msg=msg['input_hash'], signature=msg['signature']):
             self.log.error(f'Invalidly signed TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            self.new_work[msg['sender']].append(shim)
+            self.notifier.notify()
+            return
 
         if int(time.time()) - msg['timestamp'] > self.expired_batch:
             self.log.error(f'Expired TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            self.new_work[msg['sender']].append(shim)
+            self.notifier.notify()
+            return
 
         # Add padded!
         # Iterate and delete transactions from list that fail
@@ -71,43 +78,52 @@ class WorkProcessor(router.Processor):
         msg['transactions'] = good_transactions
 
         self.new_work[msg['sender']].append(msg)
+        self.notifier.notify()
         self.log.info(f'{msg["sender"][:8]} has {len(self.new_work[msg["sender"]])} batches of work to do.')
 
     async def gather_transaction_batches(self, masters: list, timeout=10):
         # Wait until the queue is filled before starting timeout
         self.masters = masters
 
-        ready = False
-        while not ready:
-            for master in masters:
-                if len(self.new_work[master]) > 0:
-                    ready = True
-            await asyncio.sleep(0)
+        while not any(len(self.new_work[master]) > 0 for master in masters):
+            await self.notifier.wait()
 
         # Now wait until the rest come in or the timeout is triggered
         next_work = []
         start = time.time()
-        while len(next_work) < len(masters) and time.time() - start < timeout:
+        while len(next_work) < len(masters):
             for master in masters:
                 if len(self.new_work[master]) > 0:
                     next_work.append(self.new_work[master].pop(0))
-            await asyncio.sleep(0)
+
+            remaining = timeout - (time.time() - start)
+            if len(next_work) >= len(masters) or remaining <= 0:
+                break
+
+            await self.notifier.wait(timeout=remaining)
 
         return next_work
 
 
 class Delegate(base.Node):
-    def __init__(self, parallelism=4, *args, **kwargs):
+    def __init__(self, parallelism=4, workers=0, *args, **kwargs):
 
         super().__init__(*args, **kwargs)
 
         # Number of core / processes we push to
         self.parallelism = parallelism
         self.executor = Executor(driver=self.driver)
-        self.transaction_executor = execution.SerialExecutor(executor=self.executor)
+
+        # Processes to run each batch of work in. Transactions that do not touch the same state run side by side.
+        if workers > 1:
+            self.transaction_executor = execution.ParallelExecutor(executor=self.executor, workers=workers)
+        else:
+            self.transaction_executor = execution.SerialExecutor(executor=self.executor)
+
+        self.execution = execution.ExecutionProcess(transaction_executor=self.transaction_executor, wallet=self.wallet)
 
         self.work_processor = WorkProcessor(client=self.client, nonces=self.nonces)
-        self.router.add_service(WORK_SERVICE, self.work_processor)
+        self.router.add_service(WORK_SERVICE, self.work_processor, priority=router.HIGH)
 
         self.upgrade_manager.node_type = 'delegate'
 
@@ -117,13 +133,15 @@ class Delegate(base.Node):
         self.log.debug('Starting')
         await super().start()
 
-        members = self.driver.get_var(contract='delegates', variable='S', arguments=['members'])
-        assert self.wallet.verifying_key in members, 'You are not a delegate!'
+        assert self.wallet.verifying_key in self.governance.delegates(), 'You are not a delegate!'
+
+        # Forked once the state is caught up, so every contract is loaded before the first round
+        self.execution.start()
 
         asyncio.ensure_future(self.run())
 
     async def acquire_work(self):
-        current_masternodes = self.client.get_var(contract='masternodes', variable='S', arguments=['members'])
+        current_masternodes = self.governance.masternodes()
 
         w = await self.work_processor.gather_transaction_batches(masters=current_masternodes)
 
@@ -136,10 +154,9 @@ class Delegate(base.Node):
 
     async def update_sockets(self):
         mns = self.get_masternode_peers()
-        iterator = iter(mns.items())
-        vk, ip = next(iterator)
 
-        peers = await router.secure_request(
+        # Ask every masternode at once so one that is down does not stop us from learning about new peers
+        coroutines = [router.secure_request(
             msg={},
             service=network.PEER_SERVICE,
             cert_dir=self.socket_authenticator.cert_dir,
@@ -147,10 +164,11 @@ class Delegate(base.Node):
             ctx=self.ctx,
             vk=vk,
             ip=ip
-        )
+        ) for vk, ip in mns.items()]
 
-        if peers is not None:
-            self.network.update_peers(peers=peers)
+        for peers in await asyncio.gather(*coroutines):
+            if peers is not None and peers != router.OK:
+                self.network.update_peers(peers=peers)
 
     async def wait_for_new_block_confirmation(self):
         self.log.info('Waiting for block confirmation...')
@@ -172,25 +190,34 @@ class Delegate(base.Node):
             block = self.new_block_processor.q.pop(0)
             self.process_new_block(block)
 
-        results = self.transaction_executor.execute_work(
-            driver=self.driver,
-            work=filtered_work,
-            wallet=self.wallet,
-            previous_block_hash=self.current_hash,
-            current_height=self.current_height,
-            stamp_cost=self.client.get_var(contract='stamp_cost', variable='S', arguments=['value'])
-        )
-
-        await router.secure_multicast(
-            msg=results,
-            service=base.CONTENDER_SERVICE,
-            cert_dir=self.socket_authenticator.cert_dir,
-            wallet=self.wallet,
-            peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
-        )
-
-        self.log.info(f'Work execution complete. Sending to masters.')
+        # Executes in another process, so the router keeps answering and taking in the next round's work meanwhile.
+        # Everything execution writes is thrown away after this round, so nothing has to come back but the results.
+        self.execution.start()
+
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(None, partial(
+                self.execution.execute_work,
+                work=filtered_work,
+                previous_block_hash=self.current_hash,
+                current_height=self.current_height,
+                stamp_cost=self.governance.get_var(contract='stamp_cost', variable='S', arguments=['value'])
+            ))
+        except Exception as e:
+            # Masters go on without this delegate's subblocks, like it was offline for the round
+            self.log.error(f'Could not execute work: {e}. Skipping this round.')
+            results = None
+
+        if results is not None:
+            await router.secure_multicast(
+                msg=results,
+                service=base.CONTENDER_SERVICE,
+                cert_dir=self.socket_authenticator.cert_dir,
+                wallet=self.wallet,
+                peer_map=self.get_masternode_peers(),
+                ctx=self.ctx
+            )
+
+            self.log.info(f'Work execution complete. Sending to masters.')
 
         self.new_block_processor.clean(self.current_height)
         self.driver.clear_pending_state()
@@ -210,4 +237,5 @@ class Delegate(base.Node):
             await self.loop()
 
     def stop(self):
-        self.router.stop()
+        super().stop()
+        self.execution.stop()
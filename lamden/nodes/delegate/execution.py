@@ -1,4 +1,6 @@
 from contracting.execution.executor import Executor
+from contracting.db.driver import ContractDriver, Driver, COMPILED_KEY
+from contracting.execution.module import MODULE_CACHE
 from contracting.stdlib.bridge.time import Datetime
 from contracting.db.encoder import encode, safe_repr
 from lamden.crypto.canonical import tx_hash_from_tx, format_dictionary, merklize
@@ -6,9 +8,12 @@ from lamden.logger.base import get_logger
 from datetime import datetime
 
 import multiprocessing as mp
-import copy
-from time import time, sleep
+from multiprocessing import connection
+import signal
+import pymongo
+import marshal
 import queue
+from time import time, sleep
 
 log = get_logger('EXE')
 log.propagate = False
@@ -19,17 +24,20 @@ __N_WORKER__ = __N_WORKER_PER_DELEGATES__ * __N_DELEGATES__
 
 
 PoolExecutor = None
-stop_cmd = None
 pool = []
-busy_pool = []
+
+# Indexes of the workers in the pool that are not running a batch
+free_workers = queue.Queue()
+
+# The coordinator's end of the pipe to each worker in the pool
+pipes = []
 
 N_TEST = 8
-WORKER_SLEEP = 0.0001
-RESULT_SLEEP = 0.01
-POOL_WAIT_SLEEP = 0.01
 
-TX_RERUN_SLEEP = 1
-N_TRY_PER_TX = 3
+# Seconds to wait for a round of work, and for the speculation workers within it. Speculation runs inside the process
+# that executes the work, so it has to give up first.
+PROCESS_TIMEOUT = 10
+SPECULATION_TIMEOUT = 5
 
 
 class TransactionExecutor:
@@ -51,6 +59,9 @@ class ConflictResolutionExecutor(TransactionExecutor):
         self.workers = workers
         self.executor = PoolExecutor
 
+        self.reruns = 0
+        self.failures = 0
+
     def execute_tx(self, transaction, stamp_cost, environment: dict = {}, tx_number=0):
         #global PoolExecutor
         #executor = PoolExecutor
@@ -83,6 +94,19 @@ class ConflictResolutionExecutor(TransactionExecutor):
         self.executor.driver.pending_writes.clear()  # add
         return tx_output
 
+    def failed_tx(self, transaction, tx_number):
+        # Same for every node, so that a tx no worker could run fails the same way everywhere
+        tx_output = {
+            'hash': tx_hash_from_tx(transaction),
+            'transaction': transaction,
+            'status': 1,
+            'state': [],
+            'stamps_used': 0,
+            'result': safe_repr('Transaction could not be executed'),
+            'tx_number': tx_number
+        }
+        return format_dictionary(tx_output)
+
     def generate_environment(self, driver, timestamp, input_hash, bhash='0' * 64, num=1):
         now = Datetime._from_datetime(
             datetime.utcfromtimestamp(timestamp)
@@ -96,16 +120,11 @@ class ConflictResolutionExecutor(TransactionExecutor):
         }
 
     def start_pool(self):
-        global stop_cmd
-        stop_cmd = mp.Value('i', 0)
-
         for i in range(__N_WORKER__):
-            queue_in1 = mp.Queue()
-            queue_out1 = mp.Queue()
-            p = ProcessThread(queue_in1, queue_out1, stop_cmd, executor=self)
-            pool.append(p)
-            busy_pool.append(0)
-            p.start()
+            pool.append(None)
+            pipes.append(None)
+            self.start_worker(i)
+            free_workers.put(i)
 
         for i in range(5):
             n_proc = 0
@@ -119,6 +138,17 @@ class ConflictResolutionExecutor(TransactionExecutor):
         log.error(f" Can't start workers")
         return False
 
+    def start_worker(self, i):
+        pipe, conn = mp.Pipe()
+        p = ProcessThread(conn, executor=self)
+        p.start()
+
+        # Only the worker holds its end, so sending to a worker that died fails instead of filling the pipe
+        conn.close()
+
+        pool[i] = p
+        pipes[i] = pipe
+
     def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
 
         environment = self.generate_environment(driver, timestamp, input_hash, bhash, num)
@@ -129,56 +159,39 @@ class ConflictResolutionExecutor(TransactionExecutor):
             self.start_pool()
             log.debug(f'Initialyze pool {len(pool)}')
 
-        work_pool, active_workers = self.get_pool(len(batch['transactions']))
-        i = 0
+        transactions = batch['transactions']
+        tasks = [(transaction, stamp_cost, environment, i) for i, transaction in enumerate(transactions)]
+
         s = time()
-        global result_list2
-        result_list2 = []
-        log.debug(f"Start Pool len={active_workers}  prc={work_pool}")
+        tx_data = {tx['tx_number']: tx for tx in self.run_tasks(tasks)}
 
-        for transaction in batch['transactions']:
-            log.debug(f'Transaction {i}   {type(self.executor)}')
-            it = (transaction, stamp_cost, environment, i)
-            i_prc = work_pool[i % active_workers]
-            pool[i_prc].q_in.put(it)
-            i += 1
+        # Txs a worker could not return are run again with the ones that failed
+        tx_bad = [i for i in range(len(tasks)) if i not in tx_data or tx_data[i]['status'] != 0]
+        log.debug(f"tx_data={len(tx_data)}  tx_bad={tx_bad} duration= {time() - s}")
 
-        N_tx = i
-        result_list2 = self.wait_tx_result(N_tx, work_pool)
-        self.free_pool(work_pool)
+        if len(tx_bad) > 0:
+            log.debug(f'Bad transactions {len(tx_bad)}. Try to rerun')
+            self.reruns += len(tx_bad)
 
-        log.debug(f"End of pool. result_list={result_list2}")
+            for tx in self.run_tasks([tasks[i] for i in tx_bad]):
+                tx_data[tx['tx_number']] = tx
 
-        tx_data = copy.deepcopy(result_list2)
-        result_list2 = []
-        tx_done_ok = [tx['tx_number'] for tx in tx_data]
-        tx_bad = [tx['tx_number'] for tx in tx_data if tx['status'] != 0]
-        log.debug(f"tx_data={len(tx_data)}  tx_done_ok={tx_done_ok}  tx_bad={tx_bad} duration= {time() - s}")
+        for i in range(len(tasks)):
+            if i not in tx_data:
+                log.error(f'Transaction {i} could not be executed after a rerun. Returning it as failed.')
+                self.failures += 1
+                tx_data[i] = self.failed_tx(transactions[i], i)
 
-        if len(tx_bad) > 0:
-            self.free_pool(work_pool)
-            work_pool, active_workers = self.get_pool(len(tx_bad))
-
-            log.debug(f'Bad transactions {len(tx_bad)}. Try to rerun {active_workers}  {work_pool}')
-            sleep(TX_RERUN_SLEEP)
-            i = 0
-            for transaction in batch['transactions']:
-                if i in tx_bad:
-                    log.debug(f'rerun Transaction {i}')
-                    it = (transaction, stamp_cost, environment, i)
-                    i_prc = work_pool[i % active_workers]
-                    pool[i_prc].q_in.put(it)
-
-                i += 1
-            N_tx_rerun = i
-            result_list2 = self.wait_tx_result(N_tx_rerun, work_pool)
-            log.debug(f"End of rerun. result_list={result_list2}")
-            self.free_pool(work_pool)
+        return [tx_data[i] for i in range(len(tasks))]
 
-            for r in result_list2:
-                tx_data.append(r)
+    def run_tasks(self, tasks):
+        work_pool, active_workers = self.get_pool(len(tasks))
+        log.debug(f"Start Pool len={active_workers}  prc={work_pool}")
 
-        return tx_data
+        try:
+            return self.wait_tx_result(self.send_tasks(tasks, work_pool))
+        finally:
+            self.free_pool(work_pool)
 
     def execute_work(self, driver, work, wallet, previous_block_hash, current_height=0, stamp_cost=20000,
                      parallelism=4):
@@ -226,90 +239,111 @@ class ConflictResolutionExecutor(TransactionExecutor):
         return subblocks
 
     def get_pool(self, n_needed):
+        # Blocks until a worker is free, then takes as many of the free workers as are needed
         rez_pool = {}
-        cnt = 0
-        n_step = 0
         if n_needed > 0:
             if n_needed > __N_WORKER_PER_DELEGATES__:
                 n_needed = __N_WORKER_PER_DELEGATES__
-            while n_step < 3:
-                for i in range(__N_WORKER__):
-                    if busy_pool[i] == 0:
-                        busy_pool[i] = 1
-                        rez_pool[cnt] = i
-                        cnt += 1
-                    if cnt >= n_needed:
-                        break
-                if cnt > 0:
+
+            rez_pool[0] = free_workers.get()
+            while len(rez_pool) < n_needed:
+                try:
+                    rez_pool[len(rez_pool)] = free_workers.get_nowait()
+                except queue.Empty:
                     break
-                else:
-                    sleep(POOL_WAIT_SLEEP)
-                    n_step += 1
-        return rez_pool, cnt
+        return rez_pool, len(rez_pool)
 
     def free_pool(self, rez_pool):
         for k, v in rez_pool.items():
-            busy_pool[v] = 0
+            free_workers.put(v)
 
     def stop_pool(self):
-        if pool is None:
+        if len(pool) == 0:
             return
-        global stop_cmd
-        stop_cmd.value = 1
         for i in range(__N_WORKER__):
-            pool[i].join()
+            try:
+                pipes[i].send(None)
+            except OSError:
+                pass
+            pool[i].join(timeout=1)
+
+            if pool[i].is_alive():
+                pool[i].kill()
+                pool[i].join()
+
+            pipes[i].close()
+        pool.clear()
+        pipes.clear()
+
+        while not free_workers.empty():
+            free_workers.get_nowait()
         log.info(f" Workers stopped OK")
 
-    def wait_tx_result(self, N_tx, work_pool):
+    def send_tasks(self, tasks, work_pool):
+        # Sends each worker all of its tasks at once. Returns the workers that have a reply coming.
         active_workers = len(work_pool)
-        kk = 0
-        k_step = 0
-        k_wait = N_tx * N_TRY_PER_TX
+        worker_tasks = {}
+        for i, task in enumerate(tasks):
+            worker_tasks.setdefault(work_pool[i % active_workers], []).append(task)
+
+        sent = []
+        for i_prc, t in worker_tasks.items():
+            if not pool[i_prc].is_alive():
+                log.error(f'Worker {i_prc} is not running. Starting it again.')
+                self.start_worker(i_prc)
+            try:
+                pipes[i_prc].send(t)
+                sent.append(i_prc)
+            except OSError as err:
+                log.error(f'Could not send {len(t)} tx(s) to worker {i_prc}: {err}')
+        return sent
+
+    def wait_tx_result(self, workers):
+        # Blocks until every worker sent its reply or stopped. Does not use any CPU while waiting.
+        waiting = {pipes[i]: i for i in workers}
         rez = []
-        while k_step < k_wait:
-            for i_tx in range(N_tx):
-                try:
-                    k_step += 1
-                    i_prc = work_pool[i_tx % active_workers]
-                    r = pool[i_prc].q_out.get_nowait()
-                    if r is not None:
-                        rez.append(r)
-                        kk += 1
-                except queue.Empty:
-                    sleep(RESULT_SLEEP)
-            if kk >= N_tx:
-                break
+        while len(waiting) > 0:
+            ready = connection.wait(list(waiting.keys()) + [pool[i].sentinel for i in waiting.values()])
+            for pipe, i in list(waiting.items()):
+                if pipe in ready:
+                    try:
+                        rez.extend(pipe.recv())
+                    except EOFError:
+                        log.error(f'Worker {i} stopped before sending its results')
+                    del waiting[pipe]
+                elif pool[i].sentinel in ready and not pipe.poll():
+                    log.error(f'Worker {i} stopped before sending its results')
+                    del waiting[pipe]
         return rez
 
 
 class ProcessThread(mp.Process):
-    def __init__(self, q_in, q_out, s_stop, executor: ConflictResolutionExecutor):
+    def __init__(self, conn, executor: ConflictResolutionExecutor):
         super(ProcessThread, self).__init__()
-        self.q_in = q_in
-        self.q_out = q_out
-        self.s_stop = s_stop
+        self.conn = conn
         self.executor = executor
 
     def run(self):
+        # Blocks until it is sent a list of tasks, and replies with one output for each tx it could execute. None or
+        # the coordinator going away stops it.
         while 1:
-            if (int(self.s_stop.value) == 1):
-                # print("Process stopped")
-                break
-            # print("Process run")
             try:
-                x = self.q_in.get_nowait()
-                if x is not None:
-                    # work()
-                    try:
-                        tx_input = x
-                        output = self.executor.execute_tx(tx_input[0], tx_input[1], environment= tx_input[2], tx_number=tx_input[3])
-                        self.q_out.put(output)
-                    except Exception as err:
-                        log.error(f"Worker stopped after exception={err}")
-                        break
-            except queue.Empty:
-                sleep(WORKER_SLEEP)
-        # print("Process exit")
+                tasks = self.conn.recv()
+            except EOFError:
+                break
+
+            if tasks is None:
+                break
+
+            outputs = []
+            for tx_input in tasks:
+                try:
+                    output = self.executor.execute_tx(tx_input[0], tx_input[1], environment= tx_input[2], tx_number=tx_input[3])
+                    outputs.append(output)
+                except Exception as err:
+                    log.error(f"Worker could not execute tx {tx_input[3]}. exception={err}")
+
+            self.conn.send(outputs)
         return
 
 
@@ -323,6 +357,11 @@ class SerialExecutor(TransactionExecutor):
         self.executor = executor
 
     def execute_tx(self, transaction, stamp_cost, environment: dict = {}):
+        return self.run_tx(transaction, stamp_cost, environment)[0]
+
+    def run_tx(self, transaction, stamp_cost, environment: dict = {}):
+        # Returns the tx output and every key the tx wrote. A failed tx only outputs its stamp deduction, but what it
+        # wrote before failing stays in the driver's cache, where the txs after it can read it.
         # Deserialize Kwargs. Kwargs should be serialized JSON moving into the future for DX.
 
         # Add AUXILIARY_SALT for more randomness
@@ -387,7 +426,7 @@ class SerialExecutor(TransactionExecutor):
 
         tx_output = format_dictionary(tx_output)
 
-        return tx_output
+        return tx_output, output['writes']
 
     def generate_environment(self, driver, timestamp, input_hash, bhash='0' * 64, num=1):
         now = Datetime._from_datetime(
@@ -458,3 +497,322 @@ class SerialExecutor(TransactionExecutor):
             i += 1
 
         return subblocks
+
+
+MISSING = object()
+
+
+class RecordingDriver(ContractDriver):
+    # Records every key a transaction reads, and puts back what it wrote once it is done, so every transaction runs
+    # against the state at the start of the batch
+    def __init__(self, driver, cache: dict):
+        super().__init__(driver=driver)
+        self.cache = cache
+
+        self.read_keys = set()
+        self.read_prefixes = set()
+        self.undo = {}
+
+    def get(self, key, mark=True):
+        self.read_keys.add(key)
+        return super().get(key, mark=mark)
+
+    def items(self, prefix=''):
+        # Hash iteration reads every key under the prefix, including ones an earlier transaction might add
+        self.read_prefixes.add(prefix)
+        return super().items(prefix=prefix)
+
+    def set(self, key, value, mark=True):
+        if key not in self.undo:
+            self.undo[key] = self.cache.get(key, MISSING)
+
+        super().set(key, value, mark=mark)
+
+    def reset(self):
+        for key, value in self.undo.items():
+            if value is MISSING:
+                self.cache.pop(key, None)
+            else:
+                self.cache[key] = value
+
+        self.undo.clear()
+        self.read_keys = set()
+        self.read_prefixes = set()
+        self.pending_writes.clear()
+
+
+def reset_signals():
+    # Signal handlers the node's event loop set up are inherited by forked processes, and would keep them from being
+    # stopped
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+
+def reconnect(driver):
+    # A MongoClient copied into a forked process can deadlock on locks the parent's threads held when it forked, so a
+    # forked process gives the drivers it uses a client of its own. The parent's is left alone.
+    if isinstance(driver, ContractDriver):
+        driver = driver.driver
+
+    # Only the Mongo driver itself reads through its client. InMemDriver subclasses it but keeps its state in a dict.
+    if type(driver) != Driver:
+        return
+
+    database, collection = driver.db.database.name, driver.db.name
+
+    driver.client = pymongo.MongoClient()
+    driver.db = driver.client[database][collection]
+
+
+# Set in the parent right before the workers are forked, so they start with it
+speculation = None
+
+
+def start_speculation():
+    # Runs once in each forked worker. Swaps the executor's driver for a recording one over the same cache and
+    # database. Nothing is committed from the worker, so the parent's state is never touched.
+    reset_signals()
+
+    executor = speculation['executor'].executor
+    reconnect(executor.driver)
+
+    executor.driver = RecordingDriver(driver=executor.driver.driver, cache=executor.driver.cache)
+
+
+def speculate(chunk):
+    tx_executor = speculation['executor']
+    driver = tx_executor.executor.driver
+
+    results = []
+    for i, transaction in chunk:
+        tx_output, writes = tx_executor.run_tx(
+            transaction=transaction,
+            stamp_cost=speculation['stamp_cost'],
+            environment=speculation['environment']
+        )
+
+        results.append((i, tx_output, writes, driver.read_keys, driver.read_prefixes))
+        driver.reset()
+
+    return results
+
+
+def conflicts(read_keys: set, read_prefixes: set, written: set):
+    if not read_keys.isdisjoint(written):
+        return True
+
+    return any(key.startswith(prefix) for prefix in read_prefixes for key in written)
+
+
+class ParallelExecutor(SerialExecutor):
+    # Runs the transactions of a batch speculatively in forked worker processes, each against the state at the start
+    # of the batch, and records what every transaction reads. The results are then taken in order. A transaction that
+    # read a key written by one before it in the batch is run again on the state so far, so the output is exactly
+    # what SerialExecutor gives. Batches with few conflicts use every worker.
+    def __init__(self, executor: Executor, workers=4, min_batch=16, timeout=SPECULATION_TIMEOUT):
+        super().__init__(executor=executor)
+        self.workers = workers
+        self.timeout = timeout
+
+        # Smaller batches are run serially, because forking costs more than it saves
+        self.min_batch = min_batch
+
+        self.reruns = 0
+
+    def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
+        transactions = batch['transactions']
+
+        # Writes pending from outside the batch would show up in the first transaction's writes only when run serially
+        if self.workers < 2 or len(transactions) < self.min_batch or len(self.executor.driver.pending_writes) > 0:
+            return super().execute_tx_batch(driver, batch, timestamp, input_hash, stamp_cost, bhash, num)
+
+        environment = self.generate_environment(driver, timestamp, input_hash, bhash, num)
+
+        # The first tx in a process uses a few more stamps than the rest. Running the first one here before forking
+        # means it is charged the same as in a serial run, and no worker is charged for it again.
+        tx_data = [self.run_tx(transaction=transactions[0], stamp_cost=stamp_cost, environment=environment)[0]]
+
+        try:
+            speculated = self.speculate(transactions[1:], stamp_cost, environment)
+        except Exception as e:
+            log.error(f'Speculative execution failed: {e}. Running the rest of the batch serially.')
+            for transaction in transactions[1:]:
+                tx_data.append(self.execute_tx(transaction=transaction, stamp_cost=stamp_cost, environment=environment))
+            return tx_data
+
+        cache = self.executor.driver.cache
+        written = set()
+
+        for i, transaction in enumerate(transactions[1:]):
+            _, tx_output, writes, read_keys, read_prefixes = speculated[i]
+
+            if conflicts(read_keys, read_prefixes, written):
+                # Runs on the real driver, which leaves the writes in its cache like a serial run would
+                tx_output, writes = self.run_tx(transaction=transaction, stamp_cost=stamp_cost, environment=environment)
+                self.reruns += 1
+            else:
+                cache.update(writes)
+
+            written.update(writes.keys())
+            tx_data.append(tx_output)
+
+        return tx_data
+
+    def speculate(self, transactions, stamp_cost, environment):
+        global speculation
+        speculation = {
+            'executor': self,
+            'stamp_cost': stamp_cost,
+            'environment': environment
+        }
+
+        # Contiguous chunks, one per worker
+        size = -(-len(transactions) // self.workers)
+        indexed = list(enumerate(transactions))
+        chunks = [indexed[i:i + size] for i in range(0, len(indexed), size)]
+
+        workers = mp.get_context('fork').Pool(len(chunks), initializer=start_speculation)
+        try:
+            results = workers.map_async(speculate, chunks).get(timeout=self.timeout)
+            workers.close()
+        except:
+            workers.terminate()
+            raise
+        finally:
+            workers.join()
+            speculation = None
+
+        return {result[0]: result for chunk in results for result in chunk}
+
+
+def warm_up(driver: ContractDriver):
+    # A process is charged for reading a contract's code the first time it runs the contract, and takes it from
+    # MODULE_CACHE after that. Loading every contract up front charges each tx the same as on a node that has been
+    # running for a while, however recently this process started.
+    for key in driver.driver.keys():
+        if not key.endswith(f'.{COMPILED_KEY}'):
+            continue
+
+        name = key[:-len(COMPILED_KEY) - 1]
+        if name in MODULE_CACHE:
+            continue
+
+        code = driver.driver.get(key)
+        if type(code) != bytes:
+            code = bytes.fromhex(code)
+
+        MODULE_CACHE[name] = marshal.loads(code)
+
+
+def serve_work(conn, transaction_executor: TransactionExecutor, wallet):
+    reset_signals()
+
+    driver = transaction_executor.executor.driver
+    reconnect(driver)
+    warm_up(driver)
+
+    # Blocks until it is sent a round of work, and replies with the subblocks. None or the node going away stops it.
+    while True:
+        try:
+            work = conn.recv()
+        except EOFError:
+            break
+
+        if work is None:
+            break
+
+        # Blocks processed since the last round are in the database, not in what is left of this process' cache
+        driver.clear_pending_state()
+
+        try:
+            conn.send((True, transaction_executor.execute_work(driver=driver, wallet=wallet, **work)))
+        except Exception as e:
+            conn.send((False, f'{type(e).__name__}: {e}'))
+
+        driver.clear_pending_state()
+
+    conn.close()
+
+
+class ExecutionProcess:
+    # Executes every round of work in one long-lived process, so the event loop keeps running meanwhile. The process
+    # is forked once, reads the state from the database with a client of its own, and keeps nothing from one round to
+    # the next but the contracts it has loaded.
+    def __init__(self, transaction_executor: TransactionExecutor, wallet, timeout=PROCESS_TIMEOUT):
+        self.transaction_executor = transaction_executor
+        self.wallet = wallet
+        self.timeout = timeout
+
+        self.process = None
+        self.conn = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        if self.is_alive():
+            return
+
+        self.stop()
+
+        self.conn, conn = mp.Pipe()
+        self.process = mp.get_context('fork').Process(
+            target=serve_work,
+            args=(conn, self.transaction_executor, self.wallet),
+            daemon=True
+        )
+        self.process.start()
+
+        # Only the process holds its end, so reading fails if it dies instead of waiting forever
+        conn.close()
+
+    def execute_work(self, work, previous_block_hash, current_height=0, stamp_cost=20000):
+        if not self.is_alive():
+            raise Exception('Execution process is not running')
+
+        self.conn.send({
+            'work': work,
+            'previous_block_hash': previous_block_hash,
+            'current_height': current_height,
+            'stamp_cost': stamp_cost
+        })
+
+        # Running the work again here could charge different stamps than the other nodes, so a round that takes too
+        # long is given up. The process is stopped, as it might never answer.
+        if not self.conn.poll(self.timeout):
+            self.stop()
+            raise Exception(f'Work was not executed within {self.timeout} seconds')
+
+        try:
+            ok, result = self.conn.recv()
+        except EOFError:
+            self.process.join()
+            code = self.process.exitcode
+            self.stop()
+            raise Exception(f'Execution process exited with code {code} before returning')
+
+        if not ok:
+            raise Exception(result)
+
+        return result
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+
+            self.process.join(timeout=1)
+
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+
+        self.conn.close()
+        self.process = None
+        self.conn = None
@@ -5,7 +5,6 @@ from lamden.crypto.canonical import merklize, block_from_subblocks
 from lamden.crypto.wallet import verify
 from lamden.logger.base import get_logger
 from lamden import storage
-import asyncio
 import time
 
 log = get_logger('Contender')
@@ -19,6 +18,8 @@ class SBCInbox(router.Processor):
 
         self.block_q = []
 
+        self.notifier = router.Notifier()
+
     async def process_message(self, msg):
         # Ignore bad message types
         # Ignore if not enough subblocks
@@ -33,6 +34,7 @@ class SBCInbox(router.Processor):
                 return
 
             self.q.append(msg)
+            self.notifier.notify()
 
     def sbc_is_valid(self, sbc, sb_idx=0):
         if sbc['subblock'] != sb_idx:
@@ -81,7 +83,7 @@ class SBCInbox(router.Processor):
     async def receive_sbc(self):
         self.log.debug('Receiving Subblock Contender...')
         while len(self.q) <= 0:
-            await asyncio.sleep(0)
+            await self.notifier.wait()
 
         return self.q.pop(0)
 
@@ -313,12 +315,15 @@ class Aggregator:
                 sbcs = await self.sbc_inbox.receive_sbc() # Can probably make this raw sync code
                 self.log.info('Pop it in there.')
                 contenders.add_sbcs(sbcs)
+                continue
 
             if time.time() - last_log > 5:
                 self.log.error(f'Waiting for contenders for {int(time.time() - started)}s.')
                 last_log = time.time()
 
-            await asyncio.sleep(0)
+            # Sleep until a contender comes in, the block times out or it is time to log again
+            timeout = min(self.seconds_to_timeout - (time.time() - started), 5 - (time.time() - last_log))
+            await self.sbc_inbox.notifier.wait(timeout=max(timeout, 0))
 
         if time.time() - started > self.seconds_to_timeout:
             self.log.error(f'Block timeout. Too many delegates are offline! Kick out the non-responsive ones! {block}')
@@ -1,13 +1,15 @@
 import asyncio
 import hashlib
 import time
-from lamden import router
+from functools import partial
+from lamden import router, relay
 from lamden.crypto.wallet import Wallet
-from lamden.storage import BlockStorage, get_latest_block_height
+from lamden.storage import BlockStore, SnapshotStorage, get_latest_block_height
 from lamden.nodes.masternode import contender, webserver
 from lamden.formatting import primatives
 from lamden.nodes import base
 from contracting.db.driver import ContractDriver
+from contracting.db.encoder import encode
 
 from lamden.logger.base import get_logger
 
@@ -17,16 +19,22 @@ BLOCK_SERVICE = 'service'
 
 
 class BlockService(router.Processor):
-    def __init__(self, blocks: BlockStorage=None, driver=ContractDriver()):
+    def __init__(self, blocks: BlockStore=None, driver=ContractDriver(), max_blocks=500, max_bytes=1_000_000):
         self.blocks = blocks
         self.driver = driver
 
+        # Bounds on a single GET_BLOCKS response
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+
     async def process_message(self, msg):
         response = None
         mn_logger.debug('Got a msg')
         if primatives.dict_has_keys(msg, keys={'name', 'arg'}):
             if msg['name'] == base.GET_BLOCK:
                 response = self.get_block(msg)
+            elif msg['name'] == base.GET_BLOCKS:
+                response = self.get_blocks(msg)
             elif msg['name'] == base.GET_HEIGHT:
                 response = get_latest_block_height(self.driver)
 
@@ -44,6 +52,78 @@ class BlockService(router.Processor):
 
         return block
 
+    def get_blocks(self, command):
+        arg = command.get('arg')
+        if type(arg) != list or len(arg) != 2:
+            return None
+
+        start, end = arg
+        if not primatives.number_is_formatted(start) or not primatives.number_is_formatted(end):
+            return None
+
+        end = min(end, start + self.max_blocks)
+
+        # Stop once the response is over max_bytes. The first block is always sent so that catchup makes progress.
+        blocks = []
+        size = 0
+        for block in self.blocks.get_blocks(start, end):
+            size += len(encode(block))
+            if len(blocks) > 0 and size > self.max_bytes:
+                break
+
+            blocks.append(block)
+
+        return blocks
+
+
+class SnapshotService(router.Processor):
+    def __init__(self, snapshots: SnapshotStorage, chunk_size=10_000):
+        self.snapshots = snapshots
+
+        # Entries of a snapshot part sent per GET_SNAPSHOT_CHUNK
+        self.chunk_size = chunk_size
+
+    async def process_message(self, msg):
+        response = None
+        if primatives.dict_has_keys(msg, keys={'name', 'arg'}):
+            if msg['name'] == base.GET_SNAPSHOT:
+                response = self.get_snapshot()
+            elif msg['name'] == base.GET_SNAPSHOT_CHUNK:
+                response = self.get_chunk(msg)
+
+        return response
+
+    def chunks(self, count):
+        return (count + self.chunk_size - 1) // self.chunk_size
+
+    def get_snapshot(self):
+        header = self.snapshots.get()
+
+        if header is None:
+            return None
+
+        return {
+            'height': header['height'],
+            'hash': header['hash'],
+            'content_hash': header['content_hash'],
+            'state': self.chunks(header['state']),
+            'nonces': self.chunks(header['nonces'])
+        }
+
+    def get_chunk(self, command):
+        arg = command.get('arg')
+        if type(arg) != list or len(arg) != 3:
+            return None
+
+        height, part, index = arg
+        if not primatives.number_is_formatted(height) or not primatives.number_is_formatted(index):
+            return None
+
+        if part not in ('state', 'nonces'):
+            return None
+
+        return self.snapshots.read(height, part, index * self.chunk_size, (index + 1) * self.chunk_size)
+
 
 class TransactionBatcher:
     def __init__(self, wallet: Wallet, queue):
@@ -85,14 +165,25 @@ class TransactionBatcher:
 
 
 class Masternode(base.Node):
-    def __init__(self, webserver_port=8080, *args, **kwargs):
+    def __init__(self, webserver_port=8080, snapshots: SnapshotStorage=None, snapshot_interval=1000, fanout=0, *args,
+                 **kwargs):
         super().__init__(store=True, *args, **kwargs)
+
+        # Blocks and work are sent to this many peers, which relay them on to the rest. 0 sends to every peer directly.
+        self.fanout = fanout
+
+        # Snapshots of the state are taken every snapshot_interval blocks and served to nodes catching up
+        self.snapshots = snapshots
+        self.snapshot_interval = snapshot_interval
+        self.snapshotting = None
+
         # Services
         self.webserver_port = webserver_port
         self.webserver = webserver.WebServer(
             contracting_client=self.client,
             driver=self.driver,
             blocks=self.blocks,
+            nonces=self.nonces,
             wallet=self.wallet,
             port=self.webserver_port
         )
@@ -102,22 +193,30 @@ class Masternode(base.Node):
         self.tx_batcher = TransactionBatcher(wallet=self.wallet, queue=[])
         self.webserver.queue = self.tx_batcher.queue
 
+        # New transactions wake the same waiters as new blocks, so hang can wait for either
+        self.webserver.notifier = self.new_block_processor.notifier
+
         self.aggregator = contender.Aggregator(
             driver=self.driver,
         )
 
-        self.router.add_service(base.CONTENDER_SERVICE, self.aggregator.sbc_inbox)
+        self.router.add_service(base.CONTENDER_SERVICE, self.aggregator.sbc_inbox, priority=router.HIGH)
 
         # Network upgrade flag
         self.active_upgrade = False
 
     async def start(self):
-        self.router.add_service(base.BLOCK_SERVICE, BlockService(self.blocks, self.driver))
+        # Catchup is served after consensus messages, and nodes that are catching up retry what gets dropped
+        self.router.add_service(base.BLOCK_SERVICE, BlockService(self.blocks, self.driver), priority=router.LOW,
+                                max_queue=100)
+
+        if self.snapshots is not None:
+            self.router.add_service(base.SNAPSHOT_SERVICE, SnapshotService(self.snapshots), priority=router.LOW,
+                                    max_queue=100)
 
         await super().start()
 
-        members = self.driver.get_var(contract='masternodes', variable='S', arguments=['members'], mark=False)
-        assert self.wallet.verifying_key in members, 'You are not a masternode!'
+        assert self.wallet.verifying_key in self.governance.masternodes(), 'You are not a masternode!'
 
         # Start the block server so others can run catchup using our node as a seed.
         # Start the block contender service to participate in consensus
@@ -148,7 +247,7 @@ class Masternode(base.Node):
             if not self.running:
                 return
 
-            await asyncio.sleep(0)
+            await self.new_block_processor.notifier.wait()
         mn_logger.debug('Work / blocks available. Continuing.')
 
     async def broadcast_new_blockchain_started(self):
@@ -156,16 +255,13 @@ class Masternode(base.Node):
         # If so, multicast a block notification to wake everyone up
         mn_logger.debug('Sending new blockchain started signal.')
         if len(self.tx_batcher.queue) > 0:
-            await router.secure_multicast(
+            await self.broadcast(
                 msg=get_genesis_block(),
                 service=base.NEW_BLOCK_SERVICE,
-                cert_dir=self.socket_authenticator.cert_dir,
-                wallet=self.wallet,
                 peer_map={
                     **self.get_delegate_peers(),
                     **self.get_masternode_peers()
-                },
-                ctx=self.ctx
+                }
             )
 
     async def new_blockchain_boot(self):
@@ -184,7 +280,7 @@ class Masternode(base.Node):
         while len(self.new_block_processor.q) <= 0:
             if not self.running:
                 return
-            await asyncio.sleep(0)
+            await self.new_block_processor.notifier.wait()
 
         block = self.new_block_processor.q.pop(0)
         self.process_new_block(block)
@@ -198,13 +294,11 @@ class Masternode(base.Node):
         # await self.hang()
         # await self.wait_for_block()
 
-        members = self.driver.get_var(contract='masternodes', variable='S', arguments=['members'], mark=False)
-
-        if len(members) > 1:
+        if len(self.governance.masternodes()) > 1:
             while len(self.new_block_processor.q) <= 0:
                 if not self.running:
                     return
-                await asyncio.sleep(0)
+                await self.new_block_processor.notifier.wait()
 
             block = self.new_block_processor.q.pop(0)
             self.process_new_block(block)
@@ -213,6 +307,30 @@ class Masternode(base.Node):
         while self.running:
             await self.loop()
 
+    async def broadcast(self, msg, service, peer_map: dict):
+        # Returns whether each peer, or each relay group when fanning out, could be sent the message
+        if self.fanout > 0:
+            return await relay.secure_relay(
+                msg=msg,
+                service=service,
+                cert_dir=self.socket_authenticator.cert_dir,
+                wallet=self.wallet,
+                peer_map=peer_map,
+                ctx=self.ctx,
+                fanout=self.fanout
+            )
+
+        outcomes = await router.secure_multicast(
+            msg=msg,
+            service=service,
+            cert_dir=self.socket_authenticator.cert_dir,
+            wallet=self.wallet,
+            peer_map=peer_map,
+            ctx=self.ctx
+        )
+
+        return list(outcomes.values())
+
     async def send_work(self):
         # Hangs until upgrade is done
         while self.upgrade_manager.upgrade:
@@ -228,22 +346,22 @@ class Masternode(base.Node):
             self.log.error('No one online!')
             return False
 
-        await router.secure_multicast(
+        reached = await self.broadcast(
             msg=tx_batch,
             service=base.WORK_SERVICE,
-            cert_dir=self.socket_authenticator.cert_dir,
-            wallet=self.wallet,
-            peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
+            peer_map=self.get_delegate_peers()
         )
 
+        if not any(reached):
+            self.log.error('Could not send work to any delegate!')
+
     async def get_work_processed(self):
         await asyncio.sleep(1)
 
         await self.send_work()
 
         # this really should just give us a block straight up
-        masters = self.driver.get_var(contract='masternodes', variable='S', arguments=['members'], mark=False)
+        masters = self.governance.masternodes()
 
         self.log.info('=== ENTERING BUILD NEW BLOCK STATE ===')
 
@@ -266,28 +384,37 @@ class Masternode(base.Node):
 
         block = await self.get_work_processed()
 
-        await router.secure_multicast(
-            msg=block,
-            service=base.NEW_BLOCK_SERVICE,
-            cert_dir=self.socket_authenticator.cert_dir,
-            wallet=self.wallet,
-            peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
-        )
+        await self.broadcast(msg=block, service=base.NEW_BLOCK_SERVICE, peer_map=self.get_delegate_peers())
 
         await self.hang()
 
-        await router.secure_multicast(
-            msg=block,
-            service=base.NEW_BLOCK_SERVICE,
-            cert_dir=self.socket_authenticator.cert_dir,
-            wallet=self.wallet,
-            peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
-        )
+        await self.broadcast(msg=block, service=base.NEW_BLOCK_SERVICE, peer_map=self.get_masternode_peers())
 
         # self.aggregator.sbc_inbox.q.clear()
 
+    def process_new_block(self, block):
+        super().process_new_block(block)
+
+        # Failed blocks leave the height where it was, so only snapshot when this block was applied
+        if self.snapshots is not None and self.snapshot_interval > 0 and block.get('number') == self.current_height \
+                and self.current_height > 0 and self.current_height % self.snapshot_interval == 0:
+            if self.snapshotting is not None and not self.snapshotting.done():
+                self.log.info(f'Still writing the last snapshot. Skipping block #{self.current_height}.')
+            else:
+                # Written in a thread, so block processing goes on while the state is read and streamed to disk
+                self.log.info(f'Taking state snapshot at block #{self.current_height}.')
+                self.snapshotting = asyncio.get_event_loop().run_in_executor(None, partial(
+                    self.take_snapshot,
+                    height=self.current_height,
+                    block_hash=self.current_hash
+                ))
+
+    def take_snapshot(self, height, block_hash):
+        try:
+            self.snapshots.take(height=height, block_hash=block_hash, driver=self.driver, nonces=self.nonces)
+        except Exception as e:
+            self.log.error(f'Could not take state snapshot at block #{height}: {e}')
+
     def stop(self):
         super().stop()
         self.router.socket.close()
@@ -6,7 +6,7 @@ from contracting.client import ContractingClient
 from contracting.db.encoder import encode, decode
 from contracting.db.driver import ContractDriver
 from contracting.compilation import parser
-from lamden import storage
+from lamden import storage, router, metrics, health
 from lamden.crypto.canonical import tx_hash_from_tx
 from lamden.crypto.transaction import TransactionException
 import decimal
@@ -29,7 +29,7 @@ class ByteEncoder(_json.JSONEncoder):
 
 
 class WebServer:
-    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks, queue=[], port=8080, ssl_port=443, ssl_enabled=False,
+    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks: storage.BlockStore, nonces=None, queue=[], port=8080, ssl_port=443, ssl_enabled=False,
                  ssl_cert_file='~/.ssh/server.csr',
                  ssl_key_file='~/.ssh/server.key',
                  workers=2, debug=True, access_log=False,
@@ -48,7 +48,11 @@ class WebServer:
         # Initialize the backend data interfaces
         self.client = contracting_client
         self.driver = driver
-        self.nonces = storage.NonceStorage()
+        # Share the node's nonce storage so its cache sees the nonces committed by each block
+        if nonces is None:
+            nonces = storage.CachedNonceStorage()
+
+        self.nonces = nonces
         self.blocks = blocks
 
         self.static_headers = {}
@@ -57,6 +61,12 @@ class WebServer:
         self.queue = queue
         self.max_queue_len = max_queue_len
 
+        # Notified whenever a transaction is added to the queue
+        self.notifier = router.Notifier()
+
+        self.metrics = metrics.REGISTRY
+        self.health = health.TABLE
+
         self.port = port
 
         self.ssl_port = ssl_port
@@ -77,6 +87,7 @@ class WebServer:
         self.app.add_route(self.submit_transaction, '/', methods=['POST', 'OPTIONS'])
         self.app.add_route(self.ping, '/ping', methods=['GET', 'OPTIONS'])
         self.app.add_route(self.get_id, '/id', methods=['GET'])
+        self.app.add_route(self.get_metrics, '/metrics', methods=['GET'])
         self.app.add_route(self.get_nonce, '/nonce/<vk>', methods=['GET'])
 
         # State Routes
@@ -174,6 +185,7 @@ class WebServer:
 
         # Add TX to the processing queue
         self.queue.append(tx)
+        self.notifier.notify()
 
         # Return the TX hash to the user so they can track it
         tx_hash = tx_hash_from_tx(tx)
@@ -187,6 +199,13 @@ class WebServer:
     async def ping(self, request):
         return response.json({'status': 'online'}, headers={'Access-Control-Allow-Origin': '*'})
 
+    # Message counts, sizes and timings of the node's network traffic
+    async def get_metrics(self, request):
+        return response.json(
+            {**self.metrics.snapshot(), 'peers': self.health.snapshot()},
+            headers={'Access-Control-Allow-Origin': '*'}
+        )
+
     # Get VK of this Masternode for Nonces
     async def get_id(self, request):
         return response.json({'verifying_key': self.wallet.verifying_key}, headers={'Access-Control-Allow-Origin': '*'})
@@ -271,7 +290,7 @@ class WebServer:
     #     return response.json({'values': values, 'next': values[-1]}, status=200)
 
     async def get_latest_block(self, request):
-        index = self.blocks.get_last_n(n=1, collection=storage.BlockStorage.BLOCK)
+        index = self.blocks.get_last_n(n=1, collection=storage.BlockStore.BLOCK)
         if len(index) == 0:
             block = {
                 'hash': (b'\x00' * 32).hex(),
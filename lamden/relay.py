@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+from collections import deque
+from contracting.db.encoder import encode
+
+from lamden import router, metrics
+from lamden.crypto.wallet import Wallet
+from lamden.logger.base import get_logger
+import zmq.asyncio
+
+RELAY_SERVICE = 'relay'
+
+# Upper bound on the fan out a relayed message can ask for, so a sender cannot make a relay send to everyone
+MAX_FANOUT = 16
+
+log = get_logger('Relay')
+
+# A message to relay to a tree of peers:
+# {
+#    'service': service the payload is for,
+#    'msg': payload,
+#    'peers': [vk, ...] the receiver passes the message on to,
+#    'fanout': number of peers each node sends to
+# }
+
+
+def split(peers: list, fanout):
+    # Splits peers into at most fanout groups of nearly the same size. The first peer in each group is sent the
+    # message, and relays it to the rest of its group the same way. Egress per node stays at fanout messages and
+    # the tree is log(n) deep.
+    fanout = max(min(fanout, len(peers)), 1)
+    size, extra = divmod(len(peers), fanout)
+
+    groups = []
+    start = 0
+    for i in range(fanout):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            groups.append(peers[start:end])
+        start = end
+
+    return groups
+
+
+def digest(service, msg):
+    h = hashlib.sha3_256()
+    h.update(encode([service, msg]).encode())
+    return h.hexdigest()
+
+
+async def send_to_groups(pool: router.SocketPool, service, msg, peers: list, peer_map: dict, fanout):
+    # Returns whether each group was reached. If a group's first peer cannot be sent to, the next one takes its place.
+    # Peers are sent to at the ip in our own peer map, never one from a message, so a relayed message cannot point
+    # the pool's sockets somewhere else. Peers not in the map are left out.
+    peers = [vk for vk in peers if vk in peer_map]
+
+    async def send_to_group(group):
+        for i, vk in enumerate(group):
+            message = router.build_message(service=RELAY_SERVICE, message={
+                'service': service,
+                'msg': msg,
+                'peers': group[i + 1:],
+                'fanout': fanout
+            })
+
+            if await pool.send(vk=vk, ip=peer_map[vk], message=message):
+                return True
+
+        return False
+
+    return await asyncio.gather(*[send_to_group(group) for group in split(peers, fanout)])
+
+
+async def secure_relay(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, fanout=4,
+                       linger=500, cert_dir=router.DEFAULT_DIR):
+    # Like secure_multicast, but only fanout peers are sent the message and they pass it on. Healthy, fast peers are
+    # put where they relay to others, and ones that are likely down are put at the leaves.
+    pool = router.get_pool(ctx=ctx, wallet=wallet, cert_dir=cert_dir, linger=linger)
+
+    peers = list(pool.health.rank(peer_map).keys())
+
+    reached = await send_to_groups(pool, service, msg, peers, peer_map, fanout)
+
+    if not all(reached):
+        log.debug(f'Could not relay {service} to {reached.count(False)} of {len(reached)} groups')
+
+    return reached
+
+
+def relay_message_is_formatted(msg):
+    if type(msg) != dict or type(msg.get('service')) != str or 'msg' not in msg:
+        return False
+
+    if type(msg.get('fanout')) != int or type(msg.get('peers')) != list:
+        return False
+
+    for peer in msg['peers']:
+        if type(peer) != str:
+            return False
+
+    return True
+
+
+class RelayProcessor(router.Processor):
+    def __init__(self, router: router.Router, ctx: zmq.asyncio.Context, wallet: Wallet, services: list, peers: dict,
+                 cert_dir=router.DEFAULT_DIR, remember=1000):
+        self.router = router
+        self.ctx = ctx
+        self.wallet = wallet
+        self.cert_dir = cert_dir
+
+        # The node's own peer table, where the ips of the peers to pass messages on to are looked up
+        self.peers = peers
+
+        # Only these services can be relayed, so the relay cannot be used to reach anything else on a node
+        self.services = set(services)
+
+        # Digests of recent messages. The same message can arrive again if a sender retries or a relay is restarted.
+        self.seen = set()
+        self.order = deque()
+        self.remember = remember
+
+        self.metrics = metrics.REGISTRY
+
+    def first_time(self, key):
+        if key in self.seen:
+            return False
+
+        self.seen.add(key)
+        self.order.append(key)
+
+        if len(self.order) > self.remember:
+            self.seen.discard(self.order.popleft())
+
+        return True
+
+    async def process_message(self, msg):
+        if not relay_message_is_formatted(msg) or msg['service'] not in self.services:
+            return
+
+        service = msg['service']
+
+        if not self.first_time(digest(service, msg['msg'])):
+            self.metrics.inc('relay_duplicates', service=service)
+            return
+
+        # Pass it on before handling it, so handling does not hold up the rest of the tree
+        peers = [vk for vk in msg['peers'] if vk != self.wallet.verifying_key and vk in self.peers]
+
+        if len(peers) > 0:
+            pool = router.get_pool(ctx=self.ctx, wallet=self.wallet, cert_dir=self.cert_dir)
+            fanout = max(min(msg['fanout'], MAX_FANOUT), 1)
+
+            await send_to_groups(pool, service, msg['msg'], peers, self.peers, fanout)
+            self.metrics.inc('relay_forwarded', min(fanout, len(peers)), service=service)
+
+        self.router.dispatch_message({'service': service, 'msg': msg['msg']})
@@ -71,21 +71,24 @@ class RewardManager:
         return rounded_reward
 
     @staticmethod
-    def calculate_all_rewards(block, client: ContractingClient):
+    def calculate_all_rewards(block, client: ContractingClient, governance=None):
+        # Governance variables are read through the node's cache when it passes one
+        reader = client if governance is None else governance
+
         total_stamps_to_split = RewardManager.stamps_in_block(block)
 
         master_ratio, delegate_ratio, burn_ratio, foundation_ratio, developer_ratio = \
-            client.get_var(contract='rewards', variable='S', arguments=['value'])
+            reader.get_var(contract='rewards', variable='S', arguments=['value'])
 
         master_reward = RewardManager.calculate_participant_reward(
             participant_ratio=master_ratio,
-            number_of_participants=len(client.get_var(contract='masternodes', variable='S', arguments=['members'])),
+            number_of_participants=len(reader.get_var(contract='masternodes', variable='S', arguments=['members'])),
             total_stamps_to_split=total_stamps_to_split
         )
 
         delegate_reward = RewardManager.calculate_participant_reward(
             participant_ratio=delegate_ratio,
-            number_of_participants=len(client.get_var(contract='delegates', variable='S', arguments=['members'])),
+            number_of_participants=len(reader.get_var(contract='delegates', variable='S', arguments=['members'])),
             total_stamps_to_split=total_stamps_to_split
         )
 
@@ -102,8 +105,11 @@ class RewardManager:
         return master_reward, delegate_reward, foundation_reward, developer_mapping
 
     @staticmethod
-    def distribute_rewards(master_reward, delegate_reward, foundation_reward, developer_mapping, client: ContractingClient):
-        stamp_cost = client.get_var(contract='stamp_cost', variable='S', arguments=['value'])
+    def distribute_rewards(master_reward, delegate_reward, foundation_reward, developer_mapping, client: ContractingClient,
+                           governance=None):
+        reader = client if governance is None else governance
+
+        stamp_cost = reader.get_var(contract='stamp_cost', variable='S', arguments=['value'])
 
         master_reward /= stamp_cost
         delegate_reward /= stamp_cost
@@ -113,13 +119,13 @@ class RewardManager:
                  f'Delegate reward: {format(delegate_reward, ".4f")}t per delegate. '
                  f'Foundation reward: {format(foundation_reward, ".4f")}t.')
 
-        for m in client.get_var(contract='masternodes', variable='S', arguments=['members']):
+        for m in reader.get_var(contract='masternodes', variable='S', arguments=['members']):
             RewardManager.add_to_balance(vk=m, amount=master_reward, client=client)
 
-        for d in client.get_var(contract='delegates', variable='S', arguments=['members']):
+        for d in reader.get_var(contract='delegates', variable='S', arguments=['members']):
             RewardManager.add_to_balance(vk=d, amount=delegate_reward, client=client)
 
-        foundation_wallet = client.get_var(contract='foundation', variable='owner')
+        foundation_wallet = reader.get_var(contract='foundation', variable='owner')
         RewardManager.add_to_balance(vk=foundation_wallet, amount=foundation_reward, client=client)
 
         # Send rewards to each developer calculated from the block
@@ -130,13 +136,14 @@ class RewardManager:
         log.info(f'Remainder is burned.')
 
     @staticmethod
-    def issue_rewards(block, client: ContractingClient):
+    def issue_rewards(block, client: ContractingClient, governance=None):
         rewards = RewardManager.calculate_all_rewards(
             client=client,
-            block=block
+            block=block,
+            governance=governance
         )
 
-        RewardManager.distribute_rewards(*rewards, client=client)
+        RewardManager.distribute_rewards(*rewards, client=client, governance=governance)
 
     @staticmethod
     def create_to_send_map(block, developer_ratio, client: ContractingClient):
@@ -2,12 +2,16 @@ import asyncio
 from lamden.crypto.wallet import Wallet
 import zmq
 import zmq.asyncio
-from contracting.db.encoder import encode, decode
 from zmq.error import ZMQBaseError
 from zmq.auth.certs import load_certificate
 from lamden.logger.base import get_logger
+from lamden import codec, health, metrics
+from collections import deque
+import itertools
 import pathlib
 import os
+import time
+import weakref
 CERT_DIR = 'cilsocks'
 DEFAULT_DIR = pathlib.Path.home() / CERT_DIR
 
@@ -17,6 +21,27 @@ OK = {
     'response': 'ok'
 }
 
+# Sent back for messages that were dropped because their service's queue was full
+BUSY = {
+    'response': 'busy'
+}
+
+# Service priorities. When the Router is at its concurrency limit, queued messages for higher priority services are
+# handled first.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+# What a service does with a message that arrives when its queue is full
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+
+# Messages a pooled socket holds for its peer before sends to it fail
+SEND_HWM = 1000
+
+# Milliseconds a send waits for a pooled socket that is still connecting
+CONNECT_TIMEOUT = 500
+
 
 def build_message(service, message):
     return {
@@ -30,6 +55,34 @@ class Processor:
         raise NotImplementedError
 
 
+class Notifier:
+    # Wakes coroutines waiting for something to arrive, so they do not have to poll. Waiters make their futures when
+    # they start waiting, so it works with whichever event loop they run in.
+    def __init__(self):
+        self.waiters = []
+
+    def notify(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+
+        self.waiters.clear()
+
+    async def wait(self, timeout=None):
+        # Returns False if nothing arrived before the timeout, in seconds
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+
 class QueueProcessor(Processor):
     def __init__(self):
         self.q = []
@@ -38,6 +91,53 @@ class QueueProcessor(Processor):
         self.q.append(msg)
 
 
+class ServiceQueue:
+    def __init__(self, priority=NORMAL, max_queue=1000, concurrency=8, policy=DROP_NEWEST):
+        self.priority = priority
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.policy = policy
+
+        self.q = deque()
+        self.active = 0
+
+        self.received = 0
+        self.handled = 0
+        self.dropped = 0
+        self.peak = 0
+
+    def put(self, item):
+        # Returns the item that was dropped to keep the queue bounded, if any
+        self.received += 1
+
+        dropped = None
+        if len(self.q) >= self.max_queue:
+            self.dropped += 1
+
+            if self.policy != DROP_OLDEST:
+                return item
+
+            dropped = self.q.popleft()
+
+        self.q.append(item)
+        self.peak = max(self.peak, len(self.q))
+
+        return dropped
+
+    def ready(self):
+        return len(self.q) > 0 and self.active < self.concurrency
+
+    def stats(self):
+        return {
+            'depth': len(self.q),
+            'active': self.active,
+            'received': self.received,
+            'handled': self.handled,
+            'dropped': self.dropped,
+            'peak': self.peak
+        }
+
+
 '''
 Router takes messages in the following format:
 {
@@ -52,7 +152,7 @@ a message to the requester.
 
 
 class AsyncInbox:
-    def __init__(self, socket_id, ctx: zmq.Context, wallet=None, linger=1000, poll_timeout=50):
+    def __init__(self, socket_id, ctx: zmq.Context, wallet=None, linger=1000, poll_timeout=50, max_batch=1000):
         if socket_id.startswith('tcp'):
             _, _, port = socket_id.split(':')
             self.address = f'tcp://*:{port}'
@@ -68,6 +168,9 @@ class AsyncInbox:
         self.linger = linger
         self.poll_timeout = poll_timeout
 
+        # Most messages taken off the socket per wake up, so a flood cannot keep the loop from running anything else
+        self.max_batch = max_batch
+
         self.running = False
 
     async def serve(self):
@@ -79,19 +182,38 @@ class AsyncInbox:
             try:
                 event = await self.socket.poll(timeout=self.poll_timeout, flags=zmq.POLLIN)
                 if event:
-                    _id, msg = await self.receive_message()
-                    asyncio.ensure_future(self.handle_msg(_id, msg))
+                    self.dispatch_batch(self.receive_messages())
             except zmq.error.ZMQError:
                 self.socket.close()
                 self.setup_socket()
 
         self.socket.close()
 
-    async def receive_message(self):
-        _id = await self.socket.recv()
-        msg = await self.socket.recv()
+    def receive_messages(self):
+        # Take every message that is ready without waiting
+        messages = []
+
+        while len(messages) < self.max_batch:
+            try:
+                frames = self.socket.recv_multipart(flags=zmq.NOBLOCK)
+
+                # Asyncio sockets return a future, which NOBLOCK has already completed
+                if isinstance(frames, asyncio.Future):
+                    frames = frames.result()
+            except zmq.error.Again:
+                break
+
+            if len(frames) == 2:
+                messages.append(tuple(frames))
+
+        return messages
 
-        return _id, msg
+    def dispatch_batch(self, messages):
+        for _id, msg in messages:
+            self.dispatch(_id, msg)
+
+    def dispatch(self, _id, msg):
+        asyncio.ensure_future(self.handle_msg(_id, msg))
 
     async def handle_msg(self, _id, msg):
         await self.return_msg(_id, msg)
@@ -137,26 +259,175 @@ class JSONAsyncInbox(AsyncInbox):
         self.socket.setsockopt(zmq.LINGER, self.linger)
         self.socket.bind(self.address)
 
-    async def receive_message(self):
-        _id = await self.socket.recv()
-        msg = await self.socket.recv()
+    async def handle_msg(self, _id, msg):
+        msg, fmt = codec.unpack(msg)
+        await self.reply(_id, msg, fmt)
 
-        return _id, decode(msg)
+    async def reply(self, _id, msg, fmt):
+        # Returns the size of the reply in bytes. Messages that did not come in on the socket have no one to reply to.
+        response = await self.respond(msg)
 
-    async def return_msg(self, _id, msg):
-        msg = encode(msg).encode()
-        await super().return_msg(_id, msg)
+        if _id is None:
+            return 0
+
+        return await self.return_msg(_id, response, fmt, compress=codec.accepts_compression(msg))
+
+    async def respond(self, msg):
+        return msg
+
+    async def return_msg(self, _id, msg, fmt=codec.JSON, compress=False):
+        data = codec.dumps(msg, fmt, compress=compress)
+        await super().return_msg(_id, data)
+        return len(data)
 
 
 class Router(JSONAsyncInbox):
-    def __init__(self, debug=True, *args, **kwargs):
+    def __init__(self, debug=True, concurrency=16, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.services = {}
         self.log = get_logger(self.address)
         self.log.propagate = debug
 
-    async def handle_msg(self, _id, msg):
+        # Messages are queued per service and handled by at most this many tasks at once across all services
+        self.queues = {}
+        self.concurrency = concurrency
+        self.active = 0
+
+        self.metrics = metrics.REGISTRY
+
+    def dispatch_batch(self, messages):
+        # Queue the whole batch before starting anything, so priorities apply across it
+        for _id, msg in messages:
+            self.enqueue(_id, msg)
+
+        self.schedule()
+
+    def dispatch(self, _id, msg):
+        self.enqueue(_id, msg)
+        self.schedule()
+
+    def enqueue(self, _id, data):
+        received = time.perf_counter()
+
+        # One bad frame from a peer must not stop the receive loop, or the rest of the batch is lost
+        try:
+            msg, fmt = codec.unpack(data)
+        except Exception as e:
+            self.log.error(f'Could not decode message: {e}')
+            msg, fmt = None, codec.JSON
+
+        decoded = time.perf_counter()
+
+        if type(msg) == dict and msg.get('service') in self.queues:
+            self.metrics.inc('router_bytes_in', len(data), service=msg['service'])
+            self.metrics.observe('router_decode_seconds', decoded - received, service=msg['service'])
+
+        self.enqueue_message(_id, msg, fmt, received)
+
+    def enqueue_message(self, _id, msg, fmt=codec.JSON, received=None):
+        if received is None:
+            received = time.perf_counter()
+
+        queue = self.queues.get(msg.get('service')) if type(msg) == dict else None
+
+        # Messages that no service will handle are answered right away
+        if queue is None:
+            self.metrics.inc('router_unhandled')
+            asyncio.ensure_future(self.reply(_id, msg, fmt))
+            return
+
+        service = msg['service']
+        self.metrics.inc('router_messages_in', service=service)
+
+        dropped = queue.put((_id, msg, fmt, received))
+
+        if dropped is not None:
+            self.log.debug(f'Queue for {service} is full. Dropping message.')
+            self.metrics.inc('router_dropped', service=service)
+            asyncio.ensure_future(self.reject(*dropped))
+
+    def dispatch_message(self, msg):
+        # Queues a message that did not come in on the socket, like one passed on by a relay, with the same bounds,
+        # priorities and drop policy as the rest. Nothing is sent back for it.
+        self.enqueue_message(None, msg)
+        self.schedule()
+
+    def next_queue(self):
+        ready = [queue for queue in self.queues.values() if queue.ready()]
+
+        if len(ready) == 0:
+            return None
+
+        return min(ready, key=lambda q: q.priority)
+
+    def schedule(self):
+        while self.active < self.concurrency:
+            queue = self.next_queue()
+
+            if queue is None:
+                return
+
+            queue.active += 1
+            self.active += 1
+
+            asyncio.ensure_future(self.handle_queued(queue))
+
+    async def handle_queued(self, queue: ServiceQueue):
+        # Keeps handling the service's messages while it is still the most important one with work waiting, rather
+        # than starting a task per message
+        try:
+            while len(queue.q) > 0:
+                _id, msg, fmt, received = queue.q.popleft()
+                size = await self.reply(_id, msg, fmt)
+                queue.handled += 1
+
+                # From the message coming off the socket to the reply going out, including time spent queued
+                self.metrics.inc('router_bytes_out', size, service=msg['service'])
+                self.metrics.observe('router_response_seconds', time.perf_counter() - received, service=msg['service'])
+
+                queue.active -= 1
+                following = self.next_queue()
+                queue.active += 1
+
+                if following is not None and following.priority < queue.priority:
+                    break
+        finally:
+            queue.active -= 1
+            self.active -= 1
+
+            self.schedule()
+
+    async def reject(self, _id, msg, fmt, received=None):
+        if _id is None:
+            return
+
+        # Requests get no reply value, like one that timed out, so callers do not mistake BUSY for an answer
+        response = None if msg.get('id') is not None else BUSY
+        await self.return_msg(_id, self.envelope(msg, response), fmt, compress=codec.accepts_compression(msg))
+
+    async def respond(self, msg):
+        if type(msg) != dict:
+            self.log.debug('Could not decode message.')
+            return OK
+
+        response = await self.process(msg)
+
+        return self.envelope(msg, response)
+
+    def envelope(self, msg, response):
+        # Requests sent through a SocketPool carry an id. It is sent back with the response so that many requests
+        # can share one connection. The formats we can read are sent along so the peer can switch to a better one.
+        if msg.get('id') is not None:
+            response = {
+                'id': msg['id'],
+                'reply': response,
+                'codecs': codec.SUPPORTED
+            }
+
+        return response
+
+    async def process(self, msg):
         service = msg.get('service')
         request = msg.get('msg')
 
@@ -164,116 +435,369 @@ class Router(JSONAsyncInbox):
 
         if service is None:
             self.log.debug('No service found for message.')
-            await super().return_msg(_id, OK)
-            return
+            return OK
 
         if request is None:
             self.log.debug('No request found in message.')
-            await super().return_msg(_id, OK)
-            return
+            return OK
 
         processor = self.services.get(service)
 
         if processor is None:
-            await super().return_msg(_id, OK)
-            return
+            return OK
 
+        started = time.perf_counter()
         response = await processor.process_message(request)
+        self.metrics.observe('router_process_seconds', time.perf_counter() - started, service=service)
 
         if response is None:
-            await super().return_msg(_id, OK)
-            return
+            return OK
 
-        await super().return_msg(_id, response)
+        return response
 
-    def add_service(self, name: str, processor: Processor):
+    def add_service(self, name: str, processor: Processor, priority=NORMAL, max_queue=1000, concurrency=8,
+                    policy=DROP_NEWEST):
         self.services[name] = processor
+        self.queues[name] = ServiceQueue(
+            priority=priority,
+            max_queue=max_queue,
+            concurrency=concurrency,
+            policy=policy
+        )
 
+    def stats(self):
+        return {name: queue.stats() for name, queue in self.queues.items()}
 
-async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
-    #if wallet.verifying_key == vk:
-    #    return
 
-    socket = ctx.socket(zmq.DEALER)
-    socket.setsockopt(zmq.LINGER, linger)
-    socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+class SocketPool:
+    # Keeps one connected DEALER socket per peer open so messages skip the socket setup, certificate load and CURVE
+    # handshake. Sends and requests use separate sockets because the Router answers every send with OK, and those
+    # replies must not be read as the response to a request.
+    # Requests are tagged with an id. A reader task per request socket hands each reply to the request with the same
+    # id, so any number of requests to a peer can be in flight on one socket. Older nodes do not send the id back, so
+    # their replies go to the request in flight to them, as long as there is only one.
+    SEND = 0
+    REQUEST = 1
 
-    socket.curve_secretkey = wallet.curve_sk
-    socket.curve_publickey = wallet.curve_vk
+    def __init__(self, ctx: zmq.asyncio.Context, wallet: Wallet, cert_dir=DEFAULT_DIR, linger=500):
+        # Weak so that pools kept in POOLS do not keep destroyed contexts alive
+        self.ctx = weakref.ref(ctx)
+        self.wallet = wallet
+        self.cert_dir = pathlib.Path(cert_dir)
+        self.linger = linger
 
-    filename = str(cert_dir / f'{vk}.key')
-    if not os.path.exists(filename):
-        return None
+        self.sockets = {}
 
-    server_pub, _ = load_certificate(filename)
+        self.ids = itertools.count()
+        self.pending = {}
+        self.in_flight = {}
+        self.readers = {}
 
-    socket.curve_serverkey = server_pub
+        # Format to send to each peer in, and whether it reads compressed messages. JSON and uncompressed until the
+        # peer says it can read something better.
+        self.codecs = {}
+        self.compression = set()
 
-    try:
-        socket.connect(ip)
-    except ZMQBaseError:
-        socket.close()
-        return None
+        self.metrics = metrics.REGISTRY
+        self.health = health.TABLE
 
-    message = build_message(service=service, message=msg)
+    def connect(self, vk, ip, kind):
+        entry = self.sockets.get((vk, kind))
 
-    payload = encode(message).encode()
+        if entry is not None:
+            socket_ip, socket = entry
+            if socket_ip == ip and not socket.closed:
+                return socket
 
-    await socket.send(payload, flags=zmq.NOBLOCK)
-    socket.close()
+            self.discard(vk, kind)
 
+        ctx = self.ctx()
+        if ctx is None or ctx.closed:
+            return None
 
-async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context,
-                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR):
-    #if wallet.verifying_key == vk:
-    #    return
+        filename = str(self.cert_dir / f'{vk}.key')
+        if not os.path.exists(filename):
+            return None
 
-    socket = ctx.socket(zmq.DEALER)
-    socket.setsockopt(zmq.LINGER, linger)
-    socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        server_pub, _ = load_certificate(filename)
 
-    socket.curve_secretkey = wallet.curve_sk
-    socket.curve_publickey = wallet.curve_vk
+        socket = ctx.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, self.linger)
+        socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
 
-    filename = str(cert_dir / f'{vk}.key')
-    if not os.path.exists(filename):
-        return None
+        # Only queue messages while the peer is connected, and only so many. Otherwise sends to a peer that is down
+        # look like they went through, and are delivered long after when it comes back.
+        socket.setsockopt(zmq.IMMEDIATE, 1)
+        socket.setsockopt(zmq.SNDHWM, SEND_HWM)
 
-    server_pub, _ = load_certificate(filename)
+        socket.curve_secretkey = self.wallet.curve_sk
+        socket.curve_publickey = self.wallet.curve_vk
+        socket.curve_serverkey = server_pub
 
-    socket.curve_serverkey = server_pub
+        try:
+            socket.connect(ip)
+        except ZMQBaseError:
+            logger.debug(f'Could not connect to {ip}')
+            socket.close()
+            return None
 
-    try:
-        socket.connect(ip)
-    except ZMQBaseError:
-        logger.debug(f'Could not connect to {ip}')
-        socket.close()
-        return None
+        self.sockets[(vk, kind)] = (ip, socket)
 
-    message = build_message(service=service, message=msg)
+        return socket
+
+    def discard(self, vk, kind=None):
+        kinds = (SocketPool.SEND, SocketPool.REQUEST) if kind is None else (kind, )
+
+        for k in kinds:
+            entry = self.sockets.pop((vk, k), None)
+            if entry is not None:
+                entry[1].close()
+
+            reader = self.readers.pop((vk, k), None)
+            if reader is not None:
+                reader.cancel()
+
+    def retain(self, vks):
+        # Close the sockets of peers that are no longer in the network
+        for vk, kind in list(self.sockets.keys()):
+            if vk not in vks:
+                self.discard(vk, kind)
+
+    def close(self):
+        for vk, kind in list(self.sockets.keys()):
+            self.discard(vk, kind)
+
+    def codec(self, vk):
+        return self.codecs.get(vk, codec.JSON)
+
+    def learn_codec(self, vk, codecs):
+        if codec.COMPRESSION in codecs:
+            self.compression.add(vk)
+        else:
+            self.compression.discard(vk)
+
+        for fmt in codec.FORMATS:
+            if fmt in codecs:
+                self.codecs[vk] = fmt
+                return
+
+    def dumps(self, vk, message):
+        return codec.dumps(message, self.codec(vk), compress=vk in self.compression)
+
+    async def send(self, vk, ip, message: dict):
+        return await self.send_payload(vk, ip, self.dumps(vk, message), service=message.get('service'))
+
+    async def multicast(self, peers: dict, message: dict):
+        # Encode once per format in use rather than once per peer. Every peer reading the same format gets the same
+        # bytes, which zmq sends without copying.
+        # Healthy, fast peers are handed their message first.
+        peers = self.health.rank(peers)
+
+        payloads = {}
+        for vk in peers.keys():
+            fmt = self.codec(vk), vk in self.compression
+            if fmt not in payloads:
+                payloads[fmt] = codec.dumps(message, *fmt)
+
+        service = message.get('service')
+        outcomes = await asyncio.gather(*[
+            self.send_payload(vk, ip, payloads[(self.codec(vk), vk in self.compression)], service=service)
+            for vk, ip in peers.items()
+        ])
+
+        return dict(zip(peers.keys(), outcomes))
+
+    async def send_on(self, socket, payload: bytes, timeout=CONNECT_TIMEOUT):
+        # Raises zmq.Again if the peer is not connected within timeout, or has SEND_HWM messages waiting already
+        try:
+            await socket.send(payload, flags=zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            if not await socket.poll(timeout, zmq.POLLOUT):
+                raise
+
+            await socket.send(payload, flags=zmq.NOBLOCK, copy=False)
+
+    async def send_payload(self, vk, ip, payload: bytes, service=None):
+        socket = self.connect(vk, ip, SocketPool.SEND)
+
+        if socket is None:
+            self.metrics.inc('pool_send_failures', service=service, peer=vk)
+            return False
+
+        try:
+            # Throw away the OKs the Router sent back for earlier messages
+            while socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                await socket.recv()
+
+            await self.send_on(socket, payload)
+        except zmq.Again:
+            # The socket keeps trying to connect, so it is kept
+            self.metrics.inc('pool_send_failures', service=service, peer=vk)
+            return False
+        except ZMQBaseError:
+            self.discard(vk, SocketPool.SEND)
+            self.metrics.inc('pool_send_failures', service=service, peer=vk)
+            return False
+
+        self.metrics.inc('pool_messages_out', service=service, peer=vk)
+        self.metrics.inc('pool_bytes_out', len(payload), service=service, peer=vk)
+
+        return True
+
+    async def read(self, vk, socket):
+        while not socket.closed:
+            try:
+                data = await socket.recv()
+            except ZMQBaseError:
+                return
+
+            started = time.perf_counter()
+            reply = codec.loads(data)
+
+            self.metrics.inc('pool_bytes_in', len(data), peer=vk)
+            self.metrics.observe('pool_decode_seconds', time.perf_counter() - started, peer=vk)
+
+            if type(reply) == dict and type(reply.get('codecs')) == list:
+                self.learn_codec(vk, reply.pop('codecs'))
+
+            if type(reply) == dict and reply.get('id') is not None:
+                future = self.pending.get(reply['id'])
+            else:
+                future = self.only_in_flight(vk)
+
+            # Responses that come in after their request timed out are dropped here
+            if future is None or future.done():
+                continue
 
-    payload = encode(message).encode()
+            if type(reply) != dict or reply.get('id') is None:
+                future.set_result(reply)
+            elif 'reply' in reply:
+                future.set_result(reply['reply'])
+            else:
+                # Inboxes that hand back the whole message return the id without wrapping the response
+                del reply['id']
+                future.set_result(reply)
 
-    await socket.send(payload)
+    def only_in_flight(self, vk):
+        request_ids = self.in_flight.get(vk)
 
-    event = await socket.poll(timeout=timeout, flags=zmq.POLLIN)
-    msg = None
-    if event:
-        #logger.debug(f'Message received on {ip}')
-        response = await socket.recv()
+        if request_ids is None or len(request_ids) != 1:
+            return None
 
-        msg = decode(response)
+        return self.pending.get(next(iter(request_ids)))
 
-    socket.close()
+    async def request(self, vk, ip, message: dict, timeout=1000):
+        socket = self.connect(vk, ip, SocketPool.REQUEST)
 
-    return msg
+        if socket is None:
+            self.health.failed(vk)
+            return None
+
+        reader = self.readers.get((vk, SocketPool.REQUEST))
+        if reader is None or reader.done():
+            self.readers[(vk, SocketPool.REQUEST)] = asyncio.ensure_future(self.read(vk, socket))
+
+        request_id = next(self.ids)
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        self.in_flight.setdefault(vk, set()).add(request_id)
+
+        service = message.get('service')
+        payload = self.dumps(vk, {**message, 'id': request_id, 'codecs': codec.SUPPORTED})
+
+        self.metrics.inc('pool_requests', service=service, peer=vk)
+        self.metrics.inc('pool_bytes_out', len(payload), service=service, peer=vk)
+
+        started = time.perf_counter()
+
+        try:
+            await self.send_on(socket, payload, timeout=timeout)
+            remaining = timeout / 1000 - (time.perf_counter() - started)
+            response = await asyncio.wait_for(future, timeout=max(remaining, 0))
+
+            elapsed = time.perf_counter() - started
+            self.metrics.observe('pool_request_seconds', elapsed, service=service, peer=vk)
+            self.health.succeeded(vk, elapsed)
+
+            return response
+        except asyncio.TimeoutError:
+            self.metrics.inc('pool_request_timeouts', service=service, peer=vk)
+            self.health.failed(vk)
+            return None
+        except zmq.Again:
+            self.metrics.inc('pool_request_failures', service=service, peer=vk)
+            self.health.failed(vk)
+            return None
+        except ZMQBaseError:
+            self.discard(vk, SocketPool.REQUEST)
+            self.metrics.inc('pool_request_failures', service=service, peer=vk)
+            self.health.failed(vk)
+            return None
+        finally:
+            self.pending.pop(request_id, None)
+
+            request_ids = self.in_flight.get(vk)
+            request_ids.discard(request_id)
+            if len(request_ids) == 0:
+                del self.in_flight[vk]
+
+
+# Socket pools by context, then by the wallet and certificate directory they send with
+POOLS = weakref.WeakKeyDictionary()
+
+
+def get_pool(ctx: zmq.asyncio.Context, wallet: Wallet, cert_dir=DEFAULT_DIR, linger=500):
+    pools = POOLS.get(ctx)
+    if pools is None:
+        pools = {}
+        POOLS[ctx] = pools
+
+    key = (wallet.verifying_key, str(cert_dir))
+
+    pool = pools.get(key)
+    if pool is None:
+        pool = SocketPool(ctx=ctx, wallet=wallet, cert_dir=cert_dir, linger=linger)
+        pools[key] = pool
+
+    return pool
+
+
+def wallet_pools(ctx: zmq.asyncio.Context, wallet: Wallet):
+    pools = POOLS.get(ctx, {})
+    return [pool for (vk, _), pool in pools.items() if vk == wallet.verifying_key]
+
+
+async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
+    #if wallet.verifying_key == vk:
+    #    return
+
+    message = build_message(service=service, message=msg)
+
+    pool = get_pool(ctx=ctx, wallet=wallet, cert_dir=cert_dir, linger=linger)
+    await pool.send(vk=vk, ip=ip, message=message)
+
+
+async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context,
+                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR):
+    #if wallet.verifying_key == vk:
+    #    return
+
+    message = build_message(service=service, message=msg)
+
+    pool = get_pool(ctx=ctx, wallet=wallet, cert_dir=cert_dir, linger=linger)
+    return await pool.request(vk=vk, ip=ip, message=message, timeout=timeout)
 
 
 async def secure_multicast(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
-    coroutines = []
-    for vk, ip in peer_map.items():
-        coroutines.append(
-            secure_send(msg=msg, service=service, cert_dir=cert_dir, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger)
-        )
+    # Returns whether the message could be handed to each peer's socket, by verifying key
+    message = build_message(service=service, message=msg)
+
+    pool = get_pool(ctx=ctx, wallet=wallet, cert_dir=cert_dir, linger=linger)
+    outcomes = await pool.multicast(peers=peer_map, message=message)
+
+    failed = [vk for vk, sent in outcomes.items() if not sent]
+    if len(failed) > 0:
+        logger.debug(f'Could not send {service} to {failed}')
 
-    await asyncio.gather(*coroutines)
+    return outcomes
@@ -1,7 +1,18 @@
+from collections import OrderedDict
 from contracting.db.driver import ContractDriver
-from pymongo import MongoClient, DESCENDING
+from contracting.db.encoder import Encoder, encode, decode
+from pymongo import MongoClient, IndexModel, UpdateOne, DeleteOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import pathlib
 
 import lamden
+from lamden import db_config
 from lamden.logger.base import get_logger
 
 BLOCK_HASH_KEY = '_current_block_hash'
@@ -9,11 +20,94 @@ BLOCK_NUM_HEIGHT = '_current_block_height'
 NONCE_KEY = '__n'
 PENDING_NONCE_KEY = '__pn'
 
+DUPLICATE_KEY_ERROR = 11000
+
 log = get_logger('STATE')
 
+DOCUMENT_ENCODER = Encoder()
+
+
+def partial_unique_index(field, direction=ASCENDING):
+    # Partial so that documents without the field do not collide on null
+    return IndexModel(
+        [(field, direction)],
+        name=field,
+        unique=True,
+        partialFilterExpression={field: {'$exists': True}}
+    )
+
+
+def create_indexes(collection, indexes):
+    # A unique index cannot be built over a collection that already has duplicates in it, which databases written by
+    # older versions can. The node still starts, without the constraint, until `lamden indexes --create` dedupes them.
+    # create_indexes is a no-op for indexes that already exist, so this is safe on every startup.
+    try:
+        collection.create_indexes(indexes)
+        return True
+    except OperationFailure as e:
+        log.error(f'Could not create indexes on {collection.name}: {e}. Run `lamden indexes --create` to remove '
+                  f'duplicates and build them.')
+        return False
+
+
+def remove_duplicates(collection, fields, keep_highest=None):
+    # Deletes all but one document for every value of fields that more than one document has. Keeps the one with the
+    # highest keep_highest if given, otherwise the first one stored. Returns how many were deleted.
+    key = {field: f'${field}' for field in fields}
+    order = {keep_highest: DESCENDING, '_id': ASCENDING} if keep_highest is not None else {'_id': ASCENDING}
+
+    duplicates = collection.aggregate([
+        {'$match': {field: {'$exists': True} for field in fields}},
+        {'$sort': order},
+        {'$group': {'_id': key, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)
+
+    removed = 0
+    for duplicate in duplicates:
+        removed += collection.delete_many({'_id': {'$in': duplicate['ids'][1:]}}).deleted_count
+
+    return removed
+
+
+def missing_indexes(collection, indexes):
+    existing = collection.index_information()
+    return [index.document['name'] for index in indexes if index.document['name'] not in existing]
+
+
+def query_plan(cursor):
+    # Flattens the winning plan into its stages, i.e. ['FETCH', 'IXSCAN'] or ['COLLSCAN']
+    plan = cursor.explain()['queryPlanner']['winningPlan']
+
+    stages = []
+    while plan is not None:
+        stages.append(plan['stage'])
+        plan = plan.get('inputStage')
+
+    return stages
+
+
+def to_document(o):
+    # Produces the same structure as json.loads(encode(o)) without serializing to a string and parsing it back
+    if isinstance(o, dict):
+        return {str(k): to_document(v) for k, v in o.items()}
+
+    if isinstance(o, (list, tuple)):
+        return [to_document(v) for v in o]
+
+    if o is None or isinstance(o, (str, int, float)):
+        return o
+
+    return to_document(DOCUMENT_ENCODER.default(o))
+
 
 class NonceStorage:
-    def __init__(self, port=27027, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces', config_path=lamden.__path__[0]):
+    INDEXES = [
+        IndexModel([('sender', ASCENDING), ('processor', ASCENDING)], name='sender_processor', unique=True)
+    ]
+
+    def __init__(self, port=27027, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces', config_path=lamden.__path__[0],
+                 ensure_indexes=True):
         self.config_path = config_path
 
         self.port = port
@@ -23,6 +117,33 @@ class NonceStorage:
         self.nonces = self.db[nonce_collection]
         self.pending_nonces = self.db[pending_collection]
 
+        if ensure_indexes:
+            self.create_indexes()
+
+    def create_indexes(self):
+        create_indexes(self.nonces, NonceStorage.INDEXES)
+        create_indexes(self.pending_nonces, NonceStorage.INDEXES)
+
+    def remove_duplicates(self):
+        return {
+            collection.name: remove_duplicates(collection, ['sender', 'processor'], keep_highest='value')
+            for collection in (self.nonces, self.pending_nonces)
+        }
+
+    def index_report(self):
+        return {
+            self.nonces.name: missing_indexes(self.nonces, NonceStorage.INDEXES),
+            self.pending_nonces.name: missing_indexes(self.pending_nonces, NonceStorage.INDEXES)
+        }
+
+    def query_plans(self):
+        q = {'sender': '', 'processor': ''}
+
+        return {
+            'get_nonce': query_plan(self.nonces.find(q)),
+            'get_pending_nonce': query_plan(self.pending_nonces.find(q))
+        }
+
     @staticmethod
     def get_one(sender, processor, db):
         v = db.find_one(
@@ -64,6 +185,33 @@ class NonceStorage:
     def set_pending_nonce(self, sender, processor, value):
         self.set_one(sender, processor, value, self.pending_nonces)
 
+    @staticmethod
+    def set_many(values, db):
+        # values maps (sender, processor) to a nonce. Written with a single bulk request.
+        if len(values) == 0:
+            return
+
+        db.bulk_write([
+            UpdateOne(
+                {
+                    'sender': sender,
+                    'processor': processor
+                },
+                {
+                    '$set':
+                        {
+                            'value': value
+                        }
+                }, upsert=True
+            ) for (sender, processor), value in values.items()
+        ], ordered=False)
+
+    def set_nonces(self, values):
+        self.set_many(values, self.nonces)
+
+    def set_pending_nonces(self, values):
+        self.set_many(values, self.pending_nonces)
+
     def get_latest_nonce(self, sender, processor):
         latest_nonce = self.get_pending_nonce(sender=sender, processor=processor)
 
@@ -78,9 +226,77 @@ class NonceStorage:
     def flush(self):
         self.nonces.drop()
         self.pending_nonces.drop()
+        self.create_indexes()
 
     def flush_pending(self):
         self.pending_nonces.drop()
+        create_indexes(self.pending_nonces, NonceStorage.INDEXES)
+
+
+class CachedNonceStorage(NonceStorage):
+    # Write-through cache. Reads are served from memory, writes go to memory and Mongo.
+    # Senders that have not been seen recently are evicted once more than max_senders are cached.
+    # Only safe if this is the only writer to the nonce collections, so one instance should be shared per node.
+    def __init__(self, *args, max_senders=100_000, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.max_senders = max_senders
+
+        self.nonce_cache = OrderedDict()
+        self.pending_nonce_cache = OrderedDict()
+
+    def get_cached(self, sender, processor, db, cache):
+        key = (sender, processor)
+
+        # None is a valid cached value, so membership has to be checked explicitly
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        value = self.get_one(sender, processor, db)
+        self.cache(key, value, cache)
+
+        return value
+
+    def cache(self, key, value, cache):
+        cache[key] = value
+        cache.move_to_end(key)
+
+        while len(cache) > self.max_senders:
+            cache.popitem(last=False)
+
+    def get_nonce(self, sender, processor):
+        return self.get_cached(sender, processor, self.nonces, self.nonce_cache)
+
+    def get_pending_nonce(self, sender, processor):
+        return self.get_cached(sender, processor, self.pending_nonces, self.pending_nonce_cache)
+
+    def set_nonce(self, sender, processor, value):
+        super().set_nonce(sender, processor, value)
+        self.cache((sender, processor), value, self.nonce_cache)
+
+    def set_pending_nonce(self, sender, processor, value):
+        super().set_pending_nonce(sender, processor, value)
+        self.cache((sender, processor), value, self.pending_nonce_cache)
+
+    def set_nonces(self, values):
+        super().set_nonces(values)
+        for key, value in values.items():
+            self.cache(key, value, self.nonce_cache)
+
+    def set_pending_nonces(self, values):
+        super().set_pending_nonces(values)
+        for key, value in values.items():
+            self.cache(key, value, self.pending_nonce_cache)
+
+    def flush(self):
+        super().flush()
+        self.nonce_cache.clear()
+        self.pending_nonce_cache.clear()
+
+    def flush_pending(self):
+        super().flush_pending()
+        self.pending_nonce_cache.clear()
 
 
 def get_latest_block_hash(driver: ContractDriver):
@@ -105,54 +321,386 @@ def set_latest_block_height(h, driver: ContractDriver):
     driver.driver.set(BLOCK_NUM_HEIGHT, h)
 
 
-def update_state_with_transaction(tx, driver: ContractDriver, nonces: NonceStorage):
-    nonces_to_delete = []
+def set_state(deltas, driver: ContractDriver):
+    # Writes straight to the database underneath the cache, like driver.driver.set, but in one request if possible
+    if len(deltas) == 0:
+        return
+
+    db = getattr(driver.driver, 'db', None)
+
+    if not hasattr(db, 'bulk_write'):
+        for key, value in deltas.items():
+            driver.driver.set(key, value)
+        return
+
+    requests = []
+    for key, value in deltas.items():
+        if value is None:
+            requests.append(DeleteOne({'_id': key}))
+        else:
+            requests.append(UpdateOne({'_id': key}, {'$set': {'v': encode(value)}}, upsert=True))
 
+    db.bulk_write(requests, ordered=False)
+
+
+def collect_transaction_updates(tx, deltas: dict, new_nonces: dict):
+    # Later writes to the same key or nonce replace earlier ones, so applying the result once is the same as
+    # applying every transaction in order
     if tx['state'] is not None and len(tx['state']) > 0:
         for delta in tx['state']:
-            driver.driver.set(delta['key'], delta['value'])
-            # log.debug(f"{delta['key']} -> {delta['value']}")
+            deltas[delta['key']] = delta['value']
+
+        payload = tx['transaction']['payload']
+        new_nonces[(payload['sender'], payload['processor'])] = payload['nonce'] + 1
 
-            nonces.set_nonce(
-                sender=tx['transaction']['payload']['sender'],
-                processor=tx['transaction']['payload']['processor'],
-                value=tx['transaction']['payload']['nonce'] + 1
-            )
 
-            nonces_to_delete.append((tx['transaction']['payload']['sender'], tx['transaction']['payload']['processor']))
+def apply_updates(deltas: dict, new_nonces: dict, driver: ContractDriver, nonces: NonceStorage):
+    set_state(deltas, driver)
+
+    nonces.set_nonces(new_nonces)
+    nonces.set_pending_nonces({key: None for key in new_nonces.keys()})
+
+
+def update_state_with_transaction(tx, driver: ContractDriver, nonces: NonceStorage):
+    deltas = {}
+    new_nonces = {}
 
-    for n in nonces_to_delete:
-        nonces.set_pending_nonce(*n, value=None)
+    collect_transaction_updates(tx, deltas, new_nonces)
+    apply_updates(deltas, new_nonces, driver, nonces)
 
 
 def update_state_with_block(block, driver: ContractDriver, nonces: NonceStorage, set_hash_and_height=True):
+    deltas = {}
+    new_nonces = {}
+
     if block.get('subblocks') is not None:
         for sb in block['subblocks']:
             for tx in sb['transactions']:
-                update_state_with_transaction(tx, driver, nonces)
+                collect_transaction_updates(tx, deltas, new_nonces)
 
     # Update our block hash and block num
     if set_hash_and_height:
-        set_latest_block_hash(block['hash'], driver=driver)
-        set_latest_block_height(block['number'], driver=driver)
+        deltas[BLOCK_HASH_KEY] = block['hash']
+        deltas[BLOCK_NUM_HEIGHT] = block['number']
+
+    apply_updates(deltas, new_nonces, driver, nonces)
+
+
+def dump_state(driver: ContractDriver):
+    # Yields (key, encoded value) pairs in key order, read from the database underneath the cache
+    db = getattr(driver.driver, 'db', None)
+
+    if hasattr(db, 'find'):
+        for document in db.find({}).sort('_id', ASCENDING):
+            yield document['_id'], document['v']
+        return
+
+    for key in driver.driver.keys():
+        yield key, encode(driver.driver.get(key))
+
+
+def dump_nonces(nonces: NonceStorage):
+    for document in nonces.nonces.find({}).sort([('sender', ASCENDING), ('processor', ASCENDING)]):
+        yield document['sender'], document['processor'], document['value']
+
+
+def snapshot_content_hash(state, nonces):
+    h = hashlib.sha3_256()
+
+    for entry in state:
+        h.update(encode(list(entry)).encode())
+
+    for entry in nonces:
+        h.update(encode(list(entry)).encode())
+
+    return h.hexdigest()
+
+
+def make_snapshot(driver: ContractDriver, nonces: NonceStorage):
+    # Only consistent between blocks, once the last block has been committed
+    height = get_latest_block_height(driver)
+    block_hash = get_latest_block_hash(driver)
+
+    state = [[key, value] for key, value in dump_state(driver)]
+    nonce_list = [[sender, processor, value] for sender, processor, value in dump_nonces(nonces)]
+
+    return {
+        'height': height,
+        'hash': block_hash,
+        'content_hash': snapshot_content_hash(state, nonce_list),
+        'state': state,
+        'nonces': nonce_list
+    }
+
+
+def restore_snapshot(snapshot, driver: ContractDriver, nonces: NonceStorage, batch_size=10_000):
+    if snapshot_content_hash(snapshot['state'], snapshot['nonces']) != snapshot['content_hash']:
+        log.error(f'Snapshot at block #{snapshot["height"]} does not match its content hash. Not restoring.')
+        return False
+
+    driver.flush()
+
+    db = getattr(driver.driver, 'db', None)
+
+    if hasattr(db, 'insert_many'):
+        # Values are already encoded, so they go into the database as is
+        for i in range(0, len(snapshot['state']), batch_size):
+            db.insert_many(
+                [{'_id': key, 'v': value} for key, value in snapshot['state'][i:i + batch_size]],
+                ordered=False
+            )
+    else:
+        for key, value in snapshot['state']:
+            driver.driver.set(key, decode(value))
 
+    # Snapshots are written while later blocks are committed, so the state can hold some of their changes, and a
+    # later height. Every block after the snapshot's height is replayed, which sets those keys again.
+    set_latest_block_height(snapshot['height'], driver)
+    set_latest_block_hash(snapshot['hash'], driver)
 
-class BlockStorage:
+    nonces.flush()
+    nonces.flush_pending()
+    nonces.set_nonces({(sender, processor): value for sender, processor, value in snapshot['nonces']})
+
+    return True
+
+
+class SnapshotStorage:
+    # State snapshots saved as a small JSON header and a file of entries, one JSON line each, with the state first and
+    # the nonces after it. Snapshots are streamed to and from disk, so one is never held in memory. The header is
+    # written last, so only complete snapshots are seen. Only the newest `keep` snapshots are kept on disk.
+    PREFIX = 'snapshot-'
+    SUFFIX = '.json'
+    ENTRIES = '.entries'
+
+    def __init__(self, root=db_config.SNAPSHOT_DIR, keep=2, stride=1000):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.keep = keep
+
+        # The header lists where every stride'th entry starts in the file, so reading a chunk seeks close to it
+        self.stride = stride
+
+        # The last header read or written, so serving chunks does not read it for every request
+        self.cached = None
+
+    def path(self, height):
+        return self.root / f'{self.PREFIX}{height:012d}{self.SUFFIX}'
+
+    def entries_path(self, height):
+        return self.path(height).with_suffix(self.ENTRIES)
+
+    def heights(self):
+        heights = []
+        for path in self.root.iterdir():
+            if path.name.startswith(self.PREFIX) and path.name.endswith(self.SUFFIX) and \
+                    path.with_suffix(self.ENTRIES).exists():
+                heights.append(int(path.name[len(self.PREFIX):-len(self.SUFFIX)]))
+
+        return sorted(heights)
+
+    def write(self, height, block_hash, state, nonces):
+        # Takes iterables of state and nonce entries and returns the header
+        content = hashlib.sha3_256()
+        offsets = []
+        counts = {'state': 0, 'nonces': 0}
+
+        # Write then rename so a crash never leaves a partial snapshot behind
+        entries = self.entries_path(height)
+        tmp = entries.with_suffix('.tmp')
+
+        with open(tmp, 'w') as f:
+            line = 0
+            for part, part_entries in (('state', state), ('nonces', nonces)):
+                for entry in part_entries:
+                    if line % self.stride == 0:
+                        offsets.append(f.tell())
+
+                    encoded = encode(list(entry))
+                    content.update(encoded.encode())
+                    f.write(encoded + '\n')
+
+                    counts[part] += 1
+                    line += 1
+
+        os.replace(tmp, entries)
+
+        header = {
+            'height': height,
+            'hash': block_hash,
+            'content_hash': content.hexdigest(),
+            'state': counts['state'],
+            'nonces': counts['nonces'],
+            'stride': self.stride,
+            'offsets': offsets
+        }
+
+        path = self.path(height)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            f.write(encode(header))
+
+        os.replace(tmp, path)
+
+        self.cached = header
+
+        for old in self.heights()[:-self.keep]:
+            self.remove(old)
+
+        return header
+
+    def save(self, snapshot):
+        return self.write(snapshot['height'], snapshot['hash'], snapshot['state'], snapshot['nonces'])
+
+    def take(self, height, block_hash, driver: ContractDriver, nonces: NonceStorage):
+        # Reads the state straight from the database and the nonces from their collection, so it can run off the
+        # event loop. Blocks committed meanwhile are covered by replaying every block after height on restore.
+        return self.write(height, block_hash, dump_state(driver), dump_nonces(nonces))
+
+    def get(self, height=None):
+        # Returns the header of the snapshot
+        if height is None:
+            heights = self.heights()
+            if len(heights) == 0:
+                return None
+            height = heights[-1]
+
+        if self.cached is not None and self.cached['height'] == height:
+            return self.cached
+
+        try:
+            with open(self.path(height)) as f:
+                self.cached = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        return self.cached
+
+    def read(self, height, part, start, end):
+        # Returns entries start up to, but not including, end of the state or nonces
+        header = self.get(height)
+
+        if header is None:
+            return None
+
+        first = 0 if part == 'state' else header['state']
+        start = first + max(min(start, header[part]), 0)
+        end = first + max(min(end, header[part]), 0)
+
+        entries = []
+
+        try:
+            with open(self.entries_path(height)) as f:
+                if start < end:
+                    f.seek(header['offsets'][start // header['stride']])
+
+                line = start - start % header['stride']
+                while line < end:
+                    entry = f.readline()
+                    if line >= start:
+                        entries.append(json.loads(entry))
+                    line += 1
+        except FileNotFoundError:
+            return None
+
+        return entries
+
+    def remove(self, height):
+        # The header goes first, so the snapshot is no longer seen before its entries are gone
+        for path in (self.path(height), self.entries_path(height)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        for path in self.root.iterdir():
+            if path.name.startswith(self.PREFIX):
+                path.unlink()
+
+        self.cached = None
+
+
+class BlockStore:
+    # Interface every block storage backend implements. Blocks are looked up by number (int) or hash (str).
     BLOCK = 0
     TX = 1
 
-    def __init__(self, port=27027, config_path=lamden.__path__[0], db='lamden', blocks_collection='blocks', tx_collection='tx'):
+    def store_block(self, block):
+        raise NotImplementedError
+
+    def get_block(self, v=None):
+        raise NotImplementedError
+
+    def get_last_n(self, n, collection=BLOCK):
+        raise NotImplementedError
+
+    def get_blocks(self, start, end):
+        # Iterates over the blocks numbered start up to, but not including, end in ascending order
+        raise NotImplementedError
+
+    def get_tx(self, h):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+
+class BlockStorage(BlockStore):
+    BLOCK_INDEXES = [
+        partial_unique_index('number', DESCENDING),
+        partial_unique_index('hash')
+    ]
+
+    TX_INDEXES = [
+        partial_unique_index('hash')
+    ]
+
+    def __init__(self, port=27027, config_path=lamden.__path__[0], db='lamden', blocks_collection='blocks', tx_collection='tx',
+                 atomic=False, ensure_indexes=True):
         # Setup configuration file to read constants
         self.config_path = config_path
 
         self.port = port
 
+        # Atomic writes wrap each block in a Mongo transaction. Requires Mongo to run as a replica set.
+        self.atomic = atomic
+
         self.client = MongoClient()
         self.db = self.client.get_database(db)
 
         self.blocks = self.db[blocks_collection]
         self.txs = self.db[tx_collection]
 
+        if ensure_indexes:
+            self.create_indexes()
+
+    def create_indexes(self):
+        create_indexes(self.blocks, BlockStorage.BLOCK_INDEXES)
+        create_indexes(self.txs, BlockStorage.TX_INDEXES)
+
+    def remove_duplicates(self):
+        # Older versions stored blocks again when they were received more than once, like after catchup
+        return {
+            self.blocks.name: remove_duplicates(self.blocks, ['number']) + remove_duplicates(self.blocks, ['hash']),
+            self.txs.name: remove_duplicates(self.txs, ['hash'])
+        }
+
+    def index_report(self):
+        return {
+            self.blocks.name: missing_indexes(self.blocks, BlockStorage.BLOCK_INDEXES),
+            self.txs.name: missing_indexes(self.txs, BlockStorage.TX_INDEXES)
+        }
+
+    def query_plans(self):
+        return {
+            'get_block_by_number': query_plan(self.blocks.find(self.q(0))),
+            'get_block_by_hash': query_plan(self.blocks.find(self.q(''))),
+            'get_last_n': query_plan(self.last_n_query(1)),
+            'get_tx': query_plan(self.txs.find({'hash': ''}))
+        }
+
     def q(self, v):
         if isinstance(v, int):
             return {'number': v}
@@ -170,29 +718,23 @@ class BlockStorage:
 
         return block
 
-    def put(self, data, collection=BLOCK):
+    def put(self, data, collection=BlockStore.BLOCK, session=None):
         if collection == BlockStorage.BLOCK:
-            _id = self.blocks.insert_one(data)
+            _id = self.blocks.insert_one(data, session=session)
             del data['_id']
         elif collection == BlockStorage.TX:
-            _id = self.txs.insert_one(data)
+            _id = self.txs.insert_one(data, session=session)
             del data['_id']
         else:
             return False
 
         return _id is not None
 
-    def get_last_n(self, n, collection=BLOCK):
-        if collection == BlockStorage.BLOCK:
-            c = self.blocks
-        else:
+    def get_last_n(self, n, collection=BlockStore.BLOCK):
+        if collection != BlockStorage.BLOCK:
             return None
 
-        block_query = c.find({}, {'_id': False}).sort(
-            'number', DESCENDING
-        ).limit(n)
-
-        blocks = [block for block in block_query]
+        blocks = [block for block in self.last_n_query(n)]
 
         if len(blocks) > 1:
             first_block_num = blocks[0].get('number')
@@ -202,6 +744,18 @@ class BlockStorage:
 
         return blocks
 
+    def get_blocks(self, start, end):
+        # The cursor fetches from Mongo in batches as it is iterated rather than loading the whole range
+        return self.blocks.find({'number': {'$gte': start, '$lt': end}}, {'_id': False}).sort(
+            'number', ASCENDING
+        )
+
+    def last_n_query(self, n):
+        # Filtering on number lets Mongo walk the partial number index instead of sorting the collection
+        return self.blocks.find({'number': {'$exists': True}}, {'_id': False}).sort(
+            'number', DESCENDING
+        ).limit(n)
+
     def get_tx(self, h, no_id=True):
         tx = self.txs.find_one({'hash': h})
 
@@ -213,21 +767,51 @@ class BlockStorage:
     def drop_collections(self):
         self.blocks.drop()
         self.txs.drop()
+        self.create_indexes()
 
     def flush(self):
         self.drop_collections()
 
     def store_block(self, block):
-        self.put(block, BlockStorage.BLOCK)
-        self.store_txs(block)
+        if not self.atomic:
+            self.write_block(block)
+            return
 
-    def store_txs(self, block):
+        with self.client.start_session() as session:
+            with session.start_transaction():
+                self.write_block(block, session=session)
+
+    def write_block(self, block, session=None):
+        # Transactions go in first so that a stored block always has its transactions available
+        self.store_txs(block, session=session)
+
+        try:
+            self.put(block, BlockStorage.BLOCK, session=session)
+        except DuplicateKeyError:
+            block.pop('_id', None)
+            log.warning(f'Block #{block.get("number")} is already stored.')
+
+    def store_txs(self, block, session=None):
         if block.get('subblocks') is None:
             return
 
-        for subblock in block['subblocks']:
-            for tx in subblock['transactions']:
-                self.put(tx, BlockStorage.TX)
+        txs = [tx for subblock in block['subblocks'] for tx in subblock['transactions']]
+
+        if len(txs) == 0:
+            return
+
+        # One bulk insert instead of a round trip per transaction. Unordered so that transactions already stored
+        # (i.e. a block received again during catchup) do not stop the rest from being written.
+        try:
+            self.txs.insert_many(txs, ordered=False, session=session)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] != DUPLICATE_KEY_ERROR:
+                    raise
+        finally:
+            # Mongo adds the _id to the original dicts, which are shared with the block
+            for tx in txs:
+                tx.pop('_id', None)
 
     def delete_tx(self, h):
         self.txs.delete_one({'hash': h})
@@ -243,3 +827,276 @@ class BlockStorage:
                 self.delete_tx(tx['hash'])
 
         self.blocks.delete_one({'_id': block['_id']})
+
+
+class MemoryBlockStorage(BlockStore):
+    # Keeps blocks in dictionaries. Meant for tests and tooling that should not need Mongo or a data directory.
+    def __init__(self):
+        self.blocks = {}
+        self.numbers = {}
+        self.txs = {}
+
+    def store_block(self, block):
+        if block.get('hash') in self.blocks or block.get('number') in self.numbers:
+            log.warning(f'Block #{block.get("number")} is already stored.')
+            return
+
+        # Copy so that later changes to the caller's dict do not leak into storage
+        block = to_document(block)
+
+        self.blocks[block.get('hash')] = block
+
+        if block.get('number') is not None:
+            self.numbers[block['number']] = block
+
+        for subblock in block.get('subblocks') or []:
+            for tx in subblock['transactions']:
+                self.txs[tx['hash']] = tx
+
+    def get_block(self, v=None):
+        if v is None:
+            return None
+
+        if isinstance(v, int):
+            block = self.numbers.get(v)
+        else:
+            block = self.blocks.get(v)
+
+        if block is None:
+            return None
+
+        return to_document(block)
+
+    def get_last_n(self, n, collection=BlockStore.BLOCK):
+        if collection != BlockStore.BLOCK:
+            return None
+
+        numbers = sorted(self.numbers.keys(), reverse=True)[:n]
+        return [to_document(self.numbers[number]) for number in numbers]
+
+    def get_blocks(self, start, end):
+        for number in sorted(self.numbers.keys()):
+            if start <= number < end:
+                yield to_document(self.numbers[number])
+
+    def get_tx(self, h):
+        tx = self.txs.get(h)
+
+        if tx is None:
+            return None
+
+        return to_document(tx)
+
+    def flush(self):
+        self.blocks.clear()
+        self.numbers.clear()
+        self.txs.clear()
+
+
+class FileBlockStorage(BlockStore):
+    # Embedded append-only storage. Blocks are appended as JSON to segment files that roll over at segment_size.
+    # Every block also gets a line in an index log with its segment, offset, length, number, hash and the
+    # position of each of its transactions. The index is loaded into memory on startup and block reads are
+    # sliced out of memory mapped segments, so they come straight from the page cache.
+    SEGMENT_PREFIX = 'segment-'
+    SEGMENT_SUFFIX = '.log'
+    INDEX_FILENAME = 'index.log'
+
+    def __init__(self, root=db_config.BLOCK_DIR, segment_size=64 * 1024 * 1024, sync=False):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.segment_size = segment_size
+
+        # fsync after every block. Off by default; a flush is enough to survive the process crashing.
+        self.sync = sync
+
+        self.load()
+
+    def segment_path(self, segment):
+        return self.root / f'{self.SEGMENT_PREFIX}{segment:06d}{self.SEGMENT_SUFFIX}'
+
+    def load(self):
+        self.numbers = {}
+        self.hashes = {}
+        self.txs = {}
+        self.heights = []
+        self.maps = {}
+
+        self.segment = 0
+        self.segment_end = 0
+
+        index_path = self.root / self.INDEX_FILENAME
+        index_end = 0
+
+        if index_path.exists():
+            with open(index_path, 'rb') as f:
+                for line in f:
+                    # A partially written last line means the node stopped mid write. Everything after it is dropped.
+                    if not line.endswith(b'\n'):
+                        break
+
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+
+                    self.add_to_index(entry)
+                    index_end += len(line)
+
+                    self.segment = entry['segment']
+                    self.segment_end = entry['offset'] + entry['length']
+
+        self.index_file = open(index_path, 'ab')
+        self.index_file.truncate(index_end)
+
+        # Drop any block data that was written without making it into the index. That includes whole segments, if the
+        # node stopped after rolling over to a new segment but before indexing a block in it.
+        for path in self.root.iterdir():
+            if path.name.startswith(self.SEGMENT_PREFIX) and path.name.endswith(self.SEGMENT_SUFFIX):
+                number = path.name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]
+                if number.isdigit() and int(number) > self.segment:
+                    path.unlink()
+
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+        self.segment_file.truncate(self.segment_end)
+
+    def add_to_index(self, entry):
+        location = (entry['segment'], entry['offset'], entry['length'])
+
+        if entry['hash'] is not None:
+            self.hashes[entry['hash']] = location
+
+        if entry['number'] is not None:
+            self.numbers[entry['number']] = location
+            bisect.insort(self.heights, entry['number'])
+
+        for tx_hash, subblock, i in entry['txs']:
+            self.txs[tx_hash] = (location, subblock, i)
+
+    def roll_segment(self):
+        self.write(self.segment_file)
+        self.segment_file.close()
+
+        self.segment += 1
+        self.segment_end = 0
+
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+        self.segment_file.truncate(0)
+
+    def write(self, f):
+        f.flush()
+
+        if self.sync:
+            os.fsync(f.fileno())
+
+    def store_block(self, block):
+        if block.get('hash') in self.hashes or block.get('number') in self.numbers:
+            log.warning(f'Block #{block.get("number")} is already stored.')
+            return
+
+        data = encode(block).encode()
+
+        if self.segment_end > 0 and self.segment_end + len(data) > self.segment_size:
+            self.roll_segment()
+
+        txs = []
+        for subblock_index, subblock in enumerate(block.get('subblocks') or []):
+            for tx_index, tx in enumerate(subblock['transactions']):
+                txs.append([tx['hash'], subblock_index, tx_index])
+
+        entry = {
+            'segment': self.segment,
+            'offset': self.segment_end,
+            'length': len(data),
+            'number': block.get('number'),
+            'hash': block.get('hash'),
+            'txs': txs
+        }
+
+        # The block has to be on disk before the index points at it
+        self.segment_file.write(data)
+        self.write(self.segment_file)
+        self.segment_end += len(data)
+
+        self.index_file.write(encode(entry).encode() + b'\n')
+        self.write(self.index_file)
+
+        self.add_to_index(entry)
+
+    def read(self, location):
+        segment, offset, length = location
+
+        m = self.maps.get(segment)
+
+        # A map only covers the file as it was when it was created, so remap once the segment has grown past it
+        if m is None or len(m) < offset + length:
+            if m is not None:
+                m.close()
+
+            with open(self.segment_path(segment), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            self.maps[segment] = m
+
+        return json.loads(m[offset:offset + length])
+
+    def get_block(self, v=None):
+        if v is None:
+            return None
+
+        if isinstance(v, int):
+            location = self.numbers.get(v)
+        else:
+            location = self.hashes.get(v)
+
+        if location is None:
+            return None
+
+        return self.read(location)
+
+    def get_last_n(self, n, collection=BlockStore.BLOCK):
+        if collection != BlockStore.BLOCK:
+            return None
+
+        if n <= 0:
+            return []
+
+        return [self.read(self.numbers[number]) for number in reversed(self.heights[-n:])]
+
+    def get_blocks(self, start, end):
+        i = bisect.bisect_left(self.heights, start)
+
+        while i < len(self.heights) and self.heights[i] < end:
+            yield self.read(self.numbers[self.heights[i]])
+            i += 1
+
+    def get_tx(self, h):
+        position = self.txs.get(h)
+
+        if position is None:
+            return None
+
+        location, subblock, i = position
+
+        block = self.read(location)
+
+        return block['subblocks'][subblock]['transactions'][i]
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+
+        self.maps.clear()
+
+        self.segment_file.close()
+        self.index_file.close()
+
+    def flush(self):
+        self.close()
+
+        for path in self.root.iterdir():
+            if path.name == self.INDEX_FILENAME or path.name.startswith(self.SEGMENT_PREFIX):
+                path.unlink()
+
+        self.load()
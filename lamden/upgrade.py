@@ -22,8 +22,12 @@ def reload_module(module_name: str):
 
 
 class UpgradeManager:
-    def __init__(self, client: ContractingClient, wallet=None, node_type=None, constitution_filename=None, webserver_port=18080, testing=False):
+    def __init__(self, client: ContractingClient, wallet=None, node_type=None, constitution_filename=None, webserver_port=18080, testing=False,
+                 governance=None):
         self.client = client
+
+        # The upgrade state is read every round. Nodes read it through their governance cache.
+        self.governance = governance
         self.enabled = None
         self.log = get_logger('UPGRADE')
 
@@ -32,7 +36,8 @@ class UpgradeManager:
         self.webserver_port = webserver_port
         self.wallet = wallet
 
-        self.get = partial(self.client.get_var, contract='upgrade', variable='upgrade_state')
+        reader = self.client if self.governance is None else self.governance
+        self.get = partial(reader.get_var, contract='upgrade', variable='upgrade_state')
 
         self.locked = self.get(arguments=['locked'])
         self.consensus = self.get(arguments=['consensus'])
@@ -127,6 +132,10 @@ class UpgradeManager:
         self.client.raw_driver.driver.set('upgrade.upgrade_state:consensus', None)
         self.client.raw_driver.driver.set('upgrade.upgrade_state:locked', False)
 
+        # Written outside of a block, so cached values would be stale
+        if self.governance is not None:
+            self.governance.clear()
+
         self.log.info('Reset upgrade contract variables.')
 
     def restart_node(self, constitution):
@@ -0,0 +1,84 @@
+from lamden import router, codec
+import asyncio
+import time
+import zmq
+import zmq.asyncio
+
+# Measures how fast a Router takes messages off its socket and hands them to a processor.
+# Run with: python -m tests.inprog.bench_router
+
+ADDRESS = 'tcp://127.0.0.1:19000'
+
+
+def microseconds():
+    # Floats would be encoded as fixed point decimals
+    return int(time.perf_counter() * 1_000_000)
+
+
+class LatencyProcessor(router.Processor):
+    def __init__(self):
+        self.latencies = []
+
+    async def process_message(self, msg):
+        self.latencies.append(microseconds() - msg['sent'])
+
+
+async def drain_replies(socket, expected):
+    received = 0
+    while received < expected:
+        await socket.recv()
+        received += 1
+
+
+async def run(ctx, messages, burst):
+    r = router.Router(socket_id=ADDRESS, ctx=ctx, poll_timeout=50, concurrency=64)
+
+    processor = LatencyProcessor()
+    r.add_service('bench', processor, max_queue=messages)
+
+    server = asyncio.ensure_future(r.serve())
+
+    socket = ctx.socket(zmq.DEALER)
+    socket.connect(ADDRESS)
+
+    await asyncio.sleep(0.2)
+
+    replies = asyncio.ensure_future(drain_replies(socket, messages))
+
+    start = time.perf_counter()
+    for i in range(0, messages, burst):
+        for _ in range(min(burst, messages - i)):
+            await socket.send(codec.dumps(router.build_message('bench', {'sent': microseconds()})))
+
+        # Give the Router a chance to run between bursts like separate peers would
+        await asyncio.sleep(0)
+
+    await replies
+    elapsed = time.perf_counter() - start
+
+    r.stop()
+    await server
+    socket.close()
+
+    latencies = sorted(processor.latencies)
+
+    return {
+        'messages': messages,
+        'burst': burst,
+        'msgs/sec': int(messages / elapsed),
+        'p50 ms': round(latencies[len(latencies) // 2] / 1000, 2),
+        'p99 ms': round(latencies[int(len(latencies) * 0.99)] / 1000, 2)
+    }
+
+
+def main():
+    loop = asyncio.get_event_loop()
+
+    for burst in (1, 10, 100):
+        ctx = zmq.asyncio.Context()
+        print(loop.run_until_complete(run(ctx, 20_000, burst)))
+        ctx.destroy()
+
+
+if __name__ == '__main__':
+    main()
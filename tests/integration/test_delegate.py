@@ -648,6 +648,30 @@ def get():
         self.assertEqual(w[1]['input_hash'], mw2.verifying_key)
         self.assertEqual(w[1]['signature'], '0' * 128)
 
+    def test_stop_stops_network_tasks(self):
+        dw = Wallet()
+        mw = Wallet()
+
+        dl = delegate.Delegate(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=dw,
+            constitution={
+                'masternodes': [mw.verifying_key],
+                'delegates': [dw.verifying_key]
+            },
+            driver=ContractDriver(driver=InMemDriver())
+        )
+
+        dl.running = True
+        dl.network.start_heartbeat()
+
+        dl.stop()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertFalse(dl.running)
+        self.assertTrue(dl.network.heartbeats.cancelled())
+
     def test_process_new_work_processes_tx_batch(self):
         ips = [
             'tcp://127.0.0.1:18001',
@@ -99,3 +99,70 @@ class TestAuthenticator(TestCase):
         self.assertTrue(os.path.exists(os.path.join(s.cert_dir, f'{w1.verifying_key}.key')))
         self.assertTrue(os.path.exists(os.path.join(s.cert_dir, f'{w2.verifying_key}.key')))
         self.assertTrue(os.path.exists(os.path.join(s.cert_dir, f'{w3.verifying_key}.key')))
+
+
+class TestKeyStore(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+
+        self.c = ContractingClient()
+        self.c.flush()
+
+        self.s = SocketAuthenticator(client=self.c, ctx=self.ctx)
+        self.s.flush_all_keys()
+
+    def tearDown(self):
+        self.s.authenticator.stop()
+        self.ctx.destroy()
+
+        self.c.flush()
+
+    def set_members(self, masternodes, delegates):
+        self.c.set_var(contract='masternodes', variable='S', arguments=['members'], value=masternodes)
+        self.c.set_var(contract='delegates', variable='S', arguments=['members'], value=delegates)
+
+    def test_callback_allows_only_added_keys(self):
+        w = Wallet()
+        self.s.add_verifying_key(w.verifying_key)
+
+        self.assertTrue(self.s.callback('*', self.s.keys[w.verifying_key]))
+        self.assertFalse(self.s.callback('*', b'0' * 40))
+
+        key = self.s.keys[w.verifying_key]
+        self.s.remove_verifying_key(w.verifying_key)
+
+        self.assertFalse(self.s.callback('*', key))
+        self.assertFalse(os.path.exists(os.path.join(self.s.cert_dir, f'{w.verifying_key}.key')))
+
+    def test_refresh_removes_keys_of_nodes_that_left(self):
+        mns = [Wallet().verifying_key, Wallet().verifying_key]
+        dels = [Wallet().verifying_key]
+
+        self.set_members(mns, dels)
+        self.s.refresh_governance_sockets()
+
+        self.set_members(mns[:1], dels)
+        members = self.s.refresh_governance_sockets()
+
+        self.assertListEqual(members, mns[:1] + dels)
+        self.assertSetEqual(set(self.s.keys.keys()), set(mns[:1] + dels))
+        self.assertFalse(os.path.exists(os.path.join(self.s.cert_dir, f'{mns[1]}.key')))
+        self.assertTrue(os.path.exists(os.path.join(self.s.cert_dir, f'{mns[0]}.key')))
+
+    def test_refresh_does_nothing_if_members_are_the_same(self):
+        added = []
+
+        class CountingAuthenticator(SocketAuthenticator):
+            def add_verifying_key(self, vk):
+                added.append(vk)
+                super().add_verifying_key(vk)
+
+        self.s.authenticator.stop()
+        self.s = CountingAuthenticator(client=self.c, ctx=self.ctx)
+
+        self.set_members([Wallet().verifying_key], [Wallet().verifying_key])
+
+        self.s.refresh_governance_sockets()
+        self.s.refresh_governance_sockets()
+
+        self.assertEqual(len(added), 2)
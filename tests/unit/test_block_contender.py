@@ -6,6 +6,7 @@ from lamden.crypto.wallet import Wallet
 from lamden.nodes.masternode import contender
 import asyncio
 import secrets
+import time
 
 from decimal import Decimal
 
@@ -559,6 +560,23 @@ class TestAggregator(TestCase):
 
         self.assertNotEqual(res['hash'], 'f' * 64)
 
+    def test_gather_subblocks_wakes_when_contenders_arrive(self):
+        a = contender.Aggregator(driver=ContractDriver(), seconds_to_timeout=10)
+
+        contenders = [[MockSBC(f'input_{i}', f'res_{i}', i).to_dict() for i in range(4)] for _ in range(4)]
+
+        async def deliver():
+            for c in contenders:
+                await asyncio.sleep(0.05)
+                a.sbc_inbox.q.append(c)
+                a.sbc_inbox.notifier.notify()
+
+        started = time.time()
+        res, _ = self.loop.run_until_complete(asyncio.gather(a.gather_subblocks(4), deliver()))
+
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(res['subblocks'][3]['merkle_leaves'][0], 'res_3')
+
 
 class TestSBCProcessor(TestCase):
     def test_subblock_with_bad_sb_idx_returns_false(self):
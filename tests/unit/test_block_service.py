@@ -5,6 +5,7 @@ from contracting.db.driver import ContractDriver
 from contracting.client import ContractingClient
 import zmq.asyncio
 import asyncio
+import tempfile
 from lamden.crypto.wallet import Wallet
 
 from unittest import TestCase
@@ -120,6 +121,75 @@ class TestBlockService(TestCase):
 
         self.assertIsNone(res)
 
+    def test_service_returns_block_range(self):
+        for i in range(1, 11):
+            self.b.blocks.store_block({
+                'hash': f'{i:064x}',
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': [3, 7]
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual([b['number'] for b in res], [3, 4, 5, 6])
+
+    def test_service_block_range_bounded_by_max_blocks(self):
+        self.b.max_blocks = 2
+
+        for i in range(1, 11):
+            self.b.blocks.store_block({
+                'hash': f'{i:064x}',
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': [1, 11]
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual([b['number'] for b in res], [1, 2])
+
+    def test_service_block_range_bounded_by_max_bytes_sends_at_least_one(self):
+        self.b.max_bytes = 1
+
+        for i in range(1, 11):
+            self.b.blocks.store_block({
+                'hash': f'{i:064x}',
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': [1, 11]
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual([b['number'] for b in res], [1])
+
+    def test_service_returns_none_if_block_range_malformed(self):
+        for arg in [1, [1], ['1', 2], [1, -2]]:
+            msg = {
+                'name': base.GET_BLOCKS,
+                'arg': arg
+            }
+
+            res = self.loop.run_until_complete(self.b.process_message(msg))
+
+            self.assertIsNone(res)
+
     def test_get_latest_block_height(self):
         storage.set_latest_block_height(1337, self.b.driver)
 
@@ -252,3 +322,81 @@ class TestBlockService(TestCase):
         _, res, _ = self.loop.run_until_complete(tasks)
 
         self.assertDictEqual(res, router.OK)
+
+
+class TestSnapshotService(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.snapshots = storage.SnapshotStorage(root=self.dir.name)
+        self.s = masternode.SnapshotService(snapshots=self.snapshots, chunk_size=2)
+
+        self.snapshot = {
+            'height': 100,
+            'hash': 'a' * 64,
+            'state': [['a', '1'], ['b', '2'], ['c', '3']],
+            'nonces': [['stu', 'mn1', 1]]
+        }
+
+    def tearDown(self):
+        self.loop.close()
+        self.dir.cleanup()
+
+    def test_get_snapshot_none_if_no_snapshots(self):
+        msg = {
+            'name': base.GET_SNAPSHOT,
+            'arg': ''
+        }
+
+        res = self.loop.run_until_complete(self.s.process_message(msg))
+
+        self.assertIsNone(res)
+
+    def test_get_snapshot_returns_header_with_chunk_counts(self):
+        self.snapshots.save(self.snapshot)
+
+        msg = {
+            'name': base.GET_SNAPSHOT,
+            'arg': ''
+        }
+
+        res = self.loop.run_until_complete(self.s.process_message(msg))
+
+        self.assertDictEqual(res, {
+            'height': 100,
+            'hash': 'a' * 64,
+            'content_hash': storage.snapshot_content_hash(self.snapshot['state'], self.snapshot['nonces']),
+            'state': 2,
+            'nonces': 1
+        })
+
+    def test_get_snapshot_chunks(self):
+        self.snapshots.save(self.snapshot)
+
+        chunks = []
+        for part, index in (('state', 0), ('state', 1), ('nonces', 0)):
+            msg = {
+                'name': base.GET_SNAPSHOT_CHUNK,
+                'arg': [100, part, index]
+            }
+
+            chunks.append(self.loop.run_until_complete(self.s.process_message(msg)))
+
+        self.assertListEqual(chunks, [
+            [['a', '1'], ['b', '2']],
+            [['c', '3']],
+            [['stu', 'mn1', 1]]
+        ])
+
+    def test_get_snapshot_chunk_none_if_malformed_or_missing(self):
+        self.snapshots.save(self.snapshot)
+
+        for arg in ([100, 'state'], [100, 'blocks', 0], ['100', 'state', 0], [99, 'state', 0], 100):
+            msg = {
+                'name': base.GET_SNAPSHOT_CHUNK,
+                'arg': arg
+            }
+
+            self.assertIsNone(self.loop.run_until_complete(self.s.process_message(msg)))
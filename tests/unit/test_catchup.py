@@ -0,0 +1,214 @@
+from lamden.nodes import base
+from lamden.crypto import canonical
+import asyncio
+
+from unittest import TestCase
+
+
+def generate_blocks(number_of_blocks):
+    previous_hash = '0' * 64
+    previous_number = 0
+
+    blocks = []
+    for i in range(number_of_blocks):
+        new_block = canonical.block_from_subblocks(
+            subblocks=[],
+            previous_hash=previous_hash,
+            block_num=previous_number + 1
+        )
+
+        blocks.append(new_block)
+
+        previous_hash = new_block['hash']
+        previous_number += 1
+
+    return blocks
+
+
+class MockPeer:
+    def __init__(self, blocks, limit=None, fail=False):
+        self.blocks = {block['number']: block for block in blocks}
+        self.limit = limit
+        self.fail = fail
+        self.requests = []
+
+    async def get_blocks(self, start, end):
+        self.requests.append((start, end))
+        await asyncio.sleep(0)
+
+        if self.fail:
+            return None
+
+        if self.limit is not None:
+            end = min(end, start + self.limit)
+
+        return [self.blocks[n] for n in range(start, end) if n in self.blocks]
+
+
+class TestCatchupManager(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.applied = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_catchup(self, peers, start=1, latest=20, previous_hash='0' * 64, **kwargs):
+        async def fetch(s, e, vk, ip):
+            return await peers[vk].get_blocks(s, e)
+
+        manager = base.CatchupManager(
+            fetch=fetch,
+            process=self.applied.append,
+            peers={vk: 'tcp://127.0.0.1:1800{}'.format(i) for i, vk in enumerate(peers.keys())},
+            **kwargs
+        )
+
+        height = self.loop.run_until_complete(manager.run(start=start, latest=latest, previous_hash=previous_hash))
+        return manager, height
+
+    def test_single_peer_applies_all_blocks_in_order(self):
+        blocks = generate_blocks(20)
+
+        _, height = self.run_catchup({'a': MockPeer(blocks)}, window=3)
+
+        self.assertEqual(height, 20)
+        self.assertListEqual(self.applied, blocks)
+
+    def test_windows_are_spread_over_peers(self):
+        blocks = generate_blocks(20)
+        peers = {'a': MockPeer(blocks), 'b': MockPeer(blocks), 'c': MockPeer(blocks)}
+
+        self.run_catchup(peers, window=2)
+
+        self.assertListEqual(self.applied, blocks)
+        for peer in peers.values():
+            self.assertGreater(len(peer.requests), 0)
+
+    def test_partial_responses_request_the_rest_of_the_window(self):
+        blocks = generate_blocks(20)
+        peer = MockPeer(blocks, limit=3)
+
+        self.run_catchup({'a': peer}, window=10)
+
+        self.assertListEqual(self.applied, blocks)
+        self.assertIn((4, 11), peer.requests)
+
+    def test_failing_peer_is_dropped_and_others_finish(self):
+        blocks = generate_blocks(20)
+        bad = MockPeer(blocks, fail=True)
+
+        manager, height = self.run_catchup({'bad': bad, 'good': MockPeer(blocks)}, window=4, max_failures=2)
+
+        self.assertEqual(height, 20)
+        self.assertListEqual(self.applied, blocks)
+        # Requests already in flight when the peer is dropped can still fail
+        self.assertGreaterEqual(manager.failures['bad'], 2)
+        self.assertLess(len(bad.requests), 2 + manager.depth)
+
+    def test_stops_when_no_peers_are_left(self):
+        blocks = generate_blocks(20)
+
+        _, height = self.run_catchup({'a': MockPeer(blocks[:10])}, window=5, max_failures=2)
+
+        self.assertEqual(height, 10)
+        self.assertListEqual(self.applied, blocks[:10])
+
+    def test_blocks_that_do_not_link_are_not_applied(self):
+        blocks = generate_blocks(20)
+        forked = generate_blocks(20)
+        forked[4]['previous'] = 'a' * 64
+
+        _, height = self.run_catchup({'a': MockPeer(forked)}, window=10, max_failures=1)
+
+        self.assertEqual(height, 0)
+        self.assertListEqual(self.applied, [])
+
+        self.applied.clear()
+        _, height = self.run_catchup({'a': MockPeer(forked), 'b': MockPeer(blocks)}, window=10, max_failures=1)
+
+        self.assertEqual(height, 20)
+        self.assertListEqual(self.applied, blocks)
+
+    def test_first_block_must_link_to_current_hash(self):
+        blocks = generate_blocks(20)
+
+        _, height = self.run_catchup({'a': MockPeer(blocks)}, window=5, previous_hash='b' * 64, max_failures=1)
+
+        self.assertEqual(height, 0)
+        self.assertListEqual(self.applied, [])
+
+    def test_starts_from_height_after_current(self):
+        blocks = generate_blocks(20)
+
+        _, height = self.run_catchup({'a': MockPeer(blocks)}, start=11, previous_hash=blocks[9]['hash'], window=4)
+
+        self.assertEqual(height, 20)
+        self.assertListEqual(self.applied, blocks[10:])
+
+    def test_fetching_stays_within_buffer(self):
+        blocks = generate_blocks(20)
+        peer = MockPeer(blocks)
+
+        applied_heights = []
+        fetched = []
+
+        manager = None
+
+        async def fetch(s, e, vk, ip):
+            fetched.append((s, manager.height))
+            return await peer.get_blocks(s, e)
+
+        def process(block):
+            applied_heights.append(block['number'])
+
+        manager = base.CatchupManager(fetch=fetch, process=process, peers={'a': 'ip'}, window=2, buffer_size=4)
+        self.loop.run_until_complete(manager.run(start=1, latest=20, previous_hash='0' * 64))
+
+        self.assertListEqual(applied_heights, list(range(1, 21)))
+        for start, height in fetched:
+            self.assertLess(start, height + 4)
+
+    def test_several_requests_in_flight_per_peer(self):
+        blocks = generate_blocks(20)
+        in_flight = []
+        peak = []
+
+        async def fetch(s, e, vk, ip):
+            in_flight.append(s)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(s)
+            return blocks[s - 1:e - 1]
+
+        manager = base.CatchupManager(fetch=fetch, process=self.applied.append, peers={'a': 'ip'}, window=2, depth=3)
+        self.loop.run_until_complete(manager.run(start=1, latest=20, previous_hash='0' * 64))
+
+        self.assertListEqual(self.applied, blocks)
+        self.assertEqual(max(peak), 3)
+
+    def test_no_blocks_to_fetch(self):
+        _, height = self.run_catchup({'a': MockPeer([])}, start=5, latest=4)
+
+        self.assertEqual(height, 4)
+        self.assertListEqual(self.applied, [])
+
+    def test_blocks_are_linked(self):
+        blocks = generate_blocks(5)
+        self.assertTrue(base.blocks_are_linked(1, blocks))
+        self.assertFalse(base.blocks_are_linked(2, blocks))
+        self.assertFalse(base.blocks_are_linked(1, [blocks[0], blocks[2]]))
+
+    def test_failed_blocks_do_not_break_the_link(self):
+        blocks = generate_blocks(2)
+        failed = {
+            'hash': base.FAILED_BLOCK_HASH,
+            'number': 2,
+            'previous': blocks[0]['hash'],
+            'subblocks': []
+        }
+        after = canonical.block_from_subblocks(subblocks=[], previous_hash=blocks[0]['hash'], block_num=3)
+
+        self.assertTrue(base.blocks_are_linked(1, [blocks[0], failed, after]))
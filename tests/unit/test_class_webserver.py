@@ -6,7 +6,7 @@ from contracting.client import ContractingClient
 from contracting.db.driver import ContractDriver, decode, encode
 from lamden.storage import BlockStorage
 from lamden.crypto.transaction import build_transaction
-from lamden import storage
+from lamden import storage, metrics, health
 
 n = ContractDriver()
 
@@ -35,6 +35,24 @@ class TestClassWebserver(TestCase):
         _, response = self.ws.app.test_client.get('/ping')
         self.assertDictEqual(response.json, {'status': 'online'})
 
+    def test_get_metrics(self):
+        self.ws.metrics = metrics.Registry()
+        self.ws.metrics.inc('router_messages_in', service='work')
+        self.ws.metrics.observe('router_process_seconds', 0.001, service='work')
+
+        _, response = self.ws.app.test_client.get('/metrics')
+
+        self.assertDictEqual(response.json['counters'], {'router_messages_in': {'service=work': 1}})
+        self.assertEqual(response.json['histograms']['router_process_seconds']['service=work']['count'], 1)
+
+    def test_get_metrics_includes_peer_health(self):
+        self.ws.health = health.PeerTable()
+        self.ws.health.succeeded('a', 0.01, now=1)
+
+        _, response = self.ws.app.test_client.get('/metrics')
+
+        self.assertDictEqual(response.json['peers'], {'a': {'rtt': 0.01, 'failures': 0, 'last_seen': 1, 'height': None}})
+
     def test_get_id(self):
         _, response = self.ws.app.test_client.get('/id')
         self.assertDictEqual(response.json, {'verifying_key': self.w.verifying_key})
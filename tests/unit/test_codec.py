@@ -0,0 +1,176 @@
+from lamden import codec
+from contracting.db.encoder import encode, decode
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+from contracting.stdlib.bridge.time import Datetime, Timedelta
+from unittest import TestCase
+import json
+import msgpack
+import zlib
+
+
+class TestCodec(TestCase):
+    def setUp(self):
+        self.msg = {
+            'service': 'work',
+            'msg': {
+                'transactions': [
+                    {
+                        'metadata': {
+                            'signature': 'a' * 128,
+                            'timestamp': 1600000000
+                        },
+                        'payload': {
+                            'contract': 'currency',
+                            'function': 'transfer',
+                            'kwargs': {
+                                'amount': ContractingDecimal('10.5'),
+                                'to': 'b' * 64,
+                                'when': Datetime(2020, 1, 1, 12),
+                                'for': Timedelta(days=1, seconds=30)
+                            },
+                            'nonce': 0,
+                            'processor': 'c' * 64,
+                            'sender': 'd' * 64,
+                            'stamps_supplied': 100
+                        }
+                    }
+                ],
+                'code': b'\x00\x01',
+                'empty': None,
+                'flag': True
+            }
+        }
+
+    def test_binary_round_trip_matches_json_round_trip(self):
+        binary = codec.loads(codec.dumps(self.msg, codec.BINARY))
+        text = decode(encode(self.msg))
+
+        self.assertEqual(binary, text)
+
+    def test_json_is_the_default_and_unchanged(self):
+        self.assertEqual(codec.dumps(self.msg), encode(self.msg).encode())
+
+    def test_unpack_tells_formats_apart(self):
+        _, fmt = codec.unpack(codec.dumps(self.msg, codec.BINARY))
+        self.assertEqual(fmt, codec.BINARY)
+
+        _, fmt = codec.unpack(codec.dumps(self.msg, codec.JSON))
+        self.assertEqual(fmt, codec.JSON)
+
+    def test_binary_is_tagged_with_version(self):
+        self.assertEqual(codec.dumps({}, codec.BINARY)[:1], codec.BINARY_V1)
+
+    def test_binary_is_smaller(self):
+        self.assertLess(len(codec.dumps(self.msg, codec.BINARY)), len(codec.dumps(self.msg, codec.JSON)))
+
+    def test_documents_from_storage_decode_to_objects(self):
+        document = json.loads(encode(self.msg))
+
+        binary = codec.loads(codec.dumps(document, codec.BINARY))
+
+        self.assertEqual(binary['msg']['transactions'][0]['payload']['kwargs']['amount'], ContractingDecimal('10.5'))
+        self.assertEqual(binary, decode(encode(document)))
+
+    def test_malformed_binary_returns_none(self):
+        msg, fmt = codec.unpack(codec.BINARY_V1 + b'\xc1')
+
+        self.assertIsNone(msg)
+        self.assertEqual(fmt, codec.BINARY)
+
+    def test_malformed_json_returns_none(self):
+        self.assertIsNone(codec.loads(b'{"a":'))
+
+    def test_ints_past_msgpack_range_round_trip(self):
+        msg = {'payload': {'kwargs': {'amount': 2 ** 64, 'debt': -2 ** 64 - 1, 'small': 5}}}
+
+        data = codec.dumps(msg, codec.BINARY)
+
+        self.assertEqual(data[:1], codec.BINARY_V1)
+        self.assertEqual(codec.unpack(data), (msg, codec.BINARY))
+
+    def test_floats_decode_the_same_in_both_formats(self):
+        msg = {'rate': 1.5, 'values': [0.1, (2.25, 3)], 'nested': {'small': 1e-05}}
+
+        binary = codec.loads(codec.dumps(msg, codec.BINARY))
+
+        self.assertEqual(binary, codec.loads(codec.dumps(msg, codec.JSON)))
+        self.assertEqual(type(binary['rate']), ContractingDecimal)
+        self.assertEqual(type(binary['values'][1][0]), ContractingDecimal)
+        self.assertEqual(binary['nested']['small'], ContractingDecimal('0.00001'))
+
+    def test_unpackable_binary_falls_back_to_json(self):
+        # Deeper than msgpack's nesting limit
+        msg = []
+        for i in range(600):
+            msg = [msg]
+
+        data = codec.dumps(msg, codec.BINARY)
+
+        self.assertEqual(codec.unpack(data), (msg, codec.JSON))
+
+    def test_malformed_extension_types_return_none(self):
+        for code, data in [
+            (codec.FIXED_EXT, b'not a number'),
+            (codec.TIME_EXT, b'\x93\x01\x02'),
+            (codec.TIME_EXT, b'\xc1'),
+            (codec.DELTA_EXT, b'\x91\x01'),
+            (codec.INT_EXT, b'\xff'),
+        ]:
+            packed = codec.BINARY_V1 + msgpack.packb({'a': msgpack.ExtType(code, data)})
+
+            self.assertEqual(codec.unpack(packed), (None, codec.BINARY))
+
+    def test_malformed_fixed_in_json_returns_none(self):
+        self.assertEqual(codec.unpack(b'{"a": {"__fixed__": "nope"}}'), (None, codec.JSON))
+        self.assertEqual(codec.unpack(b'{"a": {"__time__": "nope"}}'), (None, codec.JSON))
+
+    def batch(self, size):
+        return {'service': 'work', 'msg': {'transactions': self.msg['msg']['transactions'] * size}}
+
+    def test_compressed_round_trip_keeps_format(self):
+        batch = self.batch(20)
+
+        for fmt in (codec.JSON, codec.BINARY):
+            data = codec.dumps(batch, fmt, compress=True)
+
+            self.assertEqual(data[:1], codec.COMPRESSED_V1)
+            self.assertLess(len(data), len(codec.dumps(batch, fmt)))
+            self.assertEqual(codec.unpack(data), (codec.loads(codec.dumps(batch, fmt)), fmt))
+
+    def test_small_messages_are_not_compressed(self):
+        self.assertEqual(codec.dumps({'a': 1}, compress=True), codec.dumps({'a': 1}))
+
+    def test_dictionary_helps_messages_just_over_threshold(self):
+        batch = self.batch(2)
+
+        data = codec.dumps(batch)
+        self.assertGreaterEqual(len(data), codec.COMPRESSION_THRESHOLD)
+
+        compressor = zlib.compressobj(codec.COMPRESSION_LEVEL)
+        plain = compressor.compress(data) + compressor.flush()
+
+        self.assertLess(len(codec.dumps(batch, compress=True)), len(plain))
+
+    def test_malformed_compressed_returns_none(self):
+        self.assertEqual(codec.unpack(codec.COMPRESSED_V1 + b'garbage'), (None, codec.JSON))
+
+    def test_nested_compression_is_rejected(self):
+        data = codec.dumps(self.batch(2), compress=True)
+        self.assertEqual(data[:1], codec.COMPRESSED_V1)
+
+        compressor = zlib.compressobj(codec.COMPRESSION_LEVEL, zdict=codec.DICTIONARY)
+        nested = codec.COMPRESSED_V1 + compressor.compress(data) + compressor.flush()
+
+        self.assertIsNone(codec.loads(nested))
+
+    def test_oversized_decompression_is_rejected(self):
+        compressor = zlib.compressobj(codec.COMPRESSION_LEVEL, zdict=codec.DICTIONARY)
+        bomb = codec.COMPRESSED_V1 + compressor.compress(b' ' * (codec.MAX_MESSAGE_SIZE + 1)) + compressor.flush()
+
+        self.assertIsNone(codec.loads(bomb))
+
+    def test_accepts_compression(self):
+        self.assertTrue(codec.accepts_compression({'codecs': codec.SUPPORTED}))
+        self.assertFalse(codec.accepts_compression({'codecs': codec.FORMATS}))
+        self.assertFalse(codec.accepts_compression({'codecs': codec.COMPRESSION}))
+        self.assertFalse(codec.accepts_compression(None))
@@ -0,0 +1,474 @@
+from lamden.crypto import transaction
+from lamden.crypto.wallet import Wallet
+from contracting.db.driver import decode, ContractDriver, InMemDriver, Driver
+from contracting.client import ContractingClient
+from lamden.nodes.delegate import execution
+
+from unittest import TestCase
+from functools import partial
+import asyncio
+import threading
+import time
+import os
+
+test_contract = '''
+counts = Hash(default_value=0)
+
+@export
+def add(key: str):
+    counts[key] += 1
+
+@export
+def total():
+    return sum(counts.all())
+
+@export
+def fail(key: str):
+    counts[key] = 100
+    assert False, 'Failed'
+'''
+
+
+class TestParallelExecutor(TestCase):
+    def make_driver(self):
+        return ContractDriver(driver=InMemDriver())
+
+    def setUp(self):
+        self.driver = self.make_driver()
+        self.client = ContractingClient(driver=self.driver)
+        self.client.flush()
+
+        self.client.submit(test_contract, name='testing')
+
+        self.client.raw_driver.commit()
+        self.client.raw_driver.clear_pending_state()
+
+        self.wallets = [Wallet() for _ in range(4)]
+
+        for wallet in self.wallets:
+            self.driver.set(f'currency.balances:{wallet.verifying_key}', 100)
+
+        self.driver.commit()
+        self.driver.clear_pending_state()
+
+        self.client.executor.metering = True
+
+    def tearDown(self):
+        self.client.executor.metering = False
+        self.client.flush()
+
+    def build_tx(self, wallet, function, kwargs):
+        return decode(transaction.build_transaction(
+            wallet=wallet,
+            contract='testing',
+            function=function,
+            kwargs=kwargs,
+            stamps=100_000,
+            processor='0' * 64,
+            nonce=0
+        ))
+
+    def execute(self, exe, transactions):
+        return exe.execute_tx_batch(
+            driver=self.driver,
+            batch={'transactions': transactions},
+            timestamp=1600000000,
+            input_hash='A' * 64,
+            stamp_cost=20_000
+        )
+
+    def assert_same_as_serial(self, transactions, workers=4, timeout=execution.SPECULATION_TIMEOUT):
+        serial_exe = execution.SerialExecutor(executor=self.client.executor)
+
+        # The first tx a process runs uses more stamps, so compare runs after it
+        self.execute(serial_exe, transactions[:1])
+        self.driver.clear_pending_state()
+
+        serial = self.execute(serial_exe, transactions)
+        serial_cache = dict(self.driver.cache)
+
+        self.driver.clear_pending_state()
+
+        exe = execution.ParallelExecutor(executor=self.client.executor, workers=workers, min_batch=2,
+                                        timeout=timeout)
+        parallel = self.execute(exe, transactions)
+
+        self.assertEqual(parallel, serial)
+
+        # Keys only read by the workers are not cached in this process, which does not change any value
+        for k, v in self.driver.cache.items():
+            self.assertEqual(serial_cache.get(k), v)
+
+        return exe
+
+    def test_independent_transactions_are_not_rerun(self):
+        transactions = [self.build_tx(wallet, 'add', {'key': wallet.verifying_key}) for wallet in self.wallets]
+
+        exe = self.assert_same_as_serial(transactions)
+
+        self.assertEqual(exe.reruns, 0)
+
+    def test_transactions_writing_the_same_key_are_rerun(self):
+        transactions = [self.build_tx(self.wallets[i], 'add', {'key': 'same'}) for i in range(4)]
+
+        exe = self.assert_same_as_serial(transactions)
+
+        self.assertEqual(exe.reruns, 2)
+        self.assertEqual(self.driver.get_var('testing', 'counts', ['same']), 4)
+
+    def test_same_sender_is_rerun_because_of_stamps(self):
+        transactions = [self.build_tx(self.wallets[0], 'add', {'key': str(i)}) for i in range(4)]
+
+        exe = self.assert_same_as_serial(transactions)
+
+        self.assertEqual(exe.reruns, 2)
+
+    def test_reading_every_key_of_a_hash_conflicts_with_new_keys(self):
+        transactions = [
+            self.build_tx(self.wallets[0], 'add', {'key': 'a'}),
+            self.build_tx(self.wallets[1], 'add', {'key': 'b'}),
+            self.build_tx(self.wallets[2], 'total', {}),
+            self.build_tx(self.wallets[3], 'add', {'key': 'c'}),
+        ]
+
+        exe = self.assert_same_as_serial(transactions)
+
+        self.assertEqual(exe.reruns, 1)
+        self.assertEqual(self.driver.get_var('testing', 'counts', ['c']), 1)
+
+    def test_writes_of_failed_transactions_are_seen_like_serial(self):
+        transactions = [
+            self.build_tx(self.wallets[0], 'add', {'key': 'b'}),
+            self.build_tx(self.wallets[1], 'fail', {'key': 'a'}),
+            self.build_tx(self.wallets[2], 'add', {'key': 'a'}),
+        ]
+
+        exe = self.assert_same_as_serial(transactions)
+
+        self.assertEqual(exe.reruns, 1)
+
+        self.assertEqual(self.driver.get_var('testing', 'counts', ['a']), 101)
+
+    def test_batch_runs_serially_if_workers_do_not_answer_in_time(self):
+        transactions = [self.build_tx(wallet, 'add', {'key': wallet.verifying_key}) for wallet in self.wallets]
+
+        self.assert_same_as_serial(transactions, timeout=0)
+
+    def test_small_batches_run_serially(self):
+        transactions = [self.build_tx(wallet, 'add', {'key': 'same'}) for wallet in self.wallets]
+
+        exe = execution.ParallelExecutor(executor=self.client.executor, workers=4, min_batch=16)
+        self.execute(exe, transactions)
+
+        self.assertEqual(exe.reruns, 0)
+        self.assertEqual(self.driver.get_var('testing', 'counts', ['same']), 4)
+
+
+class TestParallelExecutorOnMongo(TestParallelExecutor):
+    # The driver nodes use. Workers connect to the database again after they are forked.
+    def make_driver(self):
+        return ContractDriver(driver=Driver())
+
+
+class TestConflictResolutionExecutor(TestCase):
+    def setUp(self):
+        self.driver = ContractDriver(driver=InMemDriver())
+        self.client = ContractingClient(driver=self.driver)
+        self.client.flush()
+
+        self.client.submit(test_contract, name='testing')
+
+        self.client.raw_driver.commit()
+        self.client.raw_driver.clear_pending_state()
+
+        execution.set_pool_executor(self.client.executor)
+        self.exe = execution.ConflictResolutionExecutor()
+
+    def tearDown(self):
+        self.exe.stop_pool()
+        execution.set_pool_executor(None)
+        self.client.flush()
+
+    def execute(self, transactions):
+        return self.exe.execute_tx_batch(
+            driver=self.driver,
+            batch={'transactions': transactions},
+            timestamp=1600000000,
+            input_hash='A' * 64,
+            stamp_cost=20_000
+        )
+
+    def build_txs(self, n, function='add'):
+        return [decode(transaction.build_transaction(
+            wallet=Wallet(),
+            contract='testing',
+            function=function,
+            kwargs={'key': str(i)},
+            stamps=100_000,
+            processor='0' * 64,
+            nonce=0
+        )) for i in range(n)]
+
+    def test_every_tx_is_returned(self):
+        results = self.execute(self.build_txs(10))
+
+        self.assertEqual(sorted(r['tx_number'] for r in results), list(range(10)))
+
+    def test_idle_workers_use_no_cpu(self):
+        self.execute(self.build_txs(1))
+
+        def cpu_ticks():
+            ticks = 0
+            for p in execution.pool:
+                with open(f'/proc/{p.pid}/stat') as f:
+                    stat = f.read().split(') ')[1].split()
+                    ticks += int(stat[11]) + int(stat[12])
+            return ticks
+
+        time.sleep(0.2)
+        before = cpu_ticks()
+        time.sleep(0.5)
+
+        self.assertEqual(cpu_ticks(), before)
+
+    def test_txs_of_a_worker_that_died_are_run_again(self):
+        self.exe.start_pool()
+
+        execution.pool[0].kill()
+        execution.pool[0].join()
+
+        results = self.execute(self.build_txs(8))
+
+        self.assertEqual(sorted(r['tx_number'] for r in results), list(range(8)))
+        self.assertTrue(execution.pool[0].is_alive())
+
+    def test_stop_pool_stops_every_worker(self):
+        self.execute(self.build_txs(4))
+
+        workers = list(execution.pool)
+        self.exe.stop_pool()
+
+        for p in workers:
+            self.assertFalse(p.is_alive())
+
+        self.assertEqual(len(execution.pool), 0)
+
+    def test_failed_txs_are_rerun_and_returned_once(self):
+        results = self.execute(self.build_txs(2) + self.build_txs(2, function='fail'))
+
+        self.assertEqual([r['tx_number'] for r in results], [0, 1, 2, 3])
+        self.assertEqual([r['status'] for r in results], [0, 0, 1, 1])
+        self.assertEqual(self.exe.reruns, 2)
+
+    def test_tx_no_worker_could_execute_is_returned_as_failed(self):
+        self.exe = RaisingExecutor()
+
+        txs = self.build_txs(3)
+        results = self.execute(txs)
+
+        self.assertEqual([r['tx_number'] for r in results], [0, 1, 2])
+        self.assertEqual([r['status'] for r in results], [0, 1, 0])
+        self.assertEqual(results[1]['state'], [])
+        self.assertEqual(results[1]['transaction'], txs[1])
+        self.assertEqual(self.exe.failures, 1)
+
+    def test_get_pool_blocks_until_a_worker_is_freed(self):
+        self.exe.start_pool()
+
+        taken = [self.exe.get_pool(execution.__N_WORKER_PER_DELEGATES__)[0]
+                 for _ in range(execution.__N_WORKER__ // execution.__N_WORKER_PER_DELEGATES__)]
+
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.exe.get_pool(2)))
+        waiter.start()
+
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+
+        self.exe.free_pool(taken[0])
+        waiter.join(1)
+
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(got[0][1], 2)
+
+        self.exe.free_pool(got[0][0])
+        for rez_pool in taken[1:]:
+            self.exe.free_pool(rez_pool)
+
+
+class RaisingExecutor(execution.ConflictResolutionExecutor):
+    def execute_tx(self, transaction, stamp_cost, environment: dict = {}, tx_number=0):
+        if tx_number == 1:
+            raise ValueError('Bad tx')
+        return super().execute_tx(transaction, stamp_cost, environment=environment, tx_number=tx_number)
+
+
+class SleepingExecutor(execution.SerialExecutor):
+    def __init__(self, executor, seconds):
+        super().__init__(executor=executor)
+        self.seconds = seconds
+
+    def execute_work(self, *args, **kwargs):
+        time.sleep(self.seconds)
+        return []
+
+
+class ExitingExecutor(execution.SerialExecutor):
+    def execute_work(self, *args, **kwargs):
+        os._exit(3)
+
+
+class FailingExecutor(execution.SerialExecutor):
+    def execute_work(self, *args, **kwargs):
+        raise ValueError('Bad work')
+
+
+class TestExecutionProcess(TestCase):
+    def setUp(self):
+        self.driver = ContractDriver(driver=InMemDriver())
+        self.client = ContractingClient(driver=self.driver)
+        self.client.flush()
+
+        self.client.submit(test_contract, name='testing')
+
+        self.client.raw_driver.commit()
+        self.client.raw_driver.clear_pending_state()
+
+        self.wallet = Wallet()
+
+        self.driver.set(f'currency.balances:{self.wallet.verifying_key}', 100)
+        self.driver.commit()
+        self.driver.clear_pending_state()
+
+        self.client.executor.metering = True
+
+        self.process = None
+
+    def tearDown(self):
+        if self.process is not None:
+            self.process.stop()
+
+        self.client.executor.metering = False
+        self.client.flush()
+
+    def start(self, transaction_executor, timeout=execution.PROCESS_TIMEOUT):
+        self.process = execution.ExecutionProcess(
+            transaction_executor=transaction_executor,
+            wallet=self.wallet,
+            timeout=timeout
+        )
+        self.process.start()
+
+        return self.process
+
+    def make_work(self):
+        return [{
+            'transactions': [decode(transaction.build_transaction(
+                wallet=self.wallet,
+                contract='testing',
+                function='add',
+                kwargs={'key': 'a'},
+                stamps=100_000,
+                processor='0' * 64,
+                nonce=0
+            ))],
+            'timestamp': 1600000000,
+            'input_hash': 'A' * 64
+        }]
+
+    def execute_here(self, transaction_executor, work):
+        results = transaction_executor.execute_work(
+            driver=self.driver,
+            work=work,
+            wallet=self.wallet,
+            previous_block_hash='0' * 64
+        )
+        self.driver.clear_pending_state()
+
+        return results
+
+    def test_first_round_is_charged_like_a_process_that_ran_the_contract_before(self):
+        serial = execution.SerialExecutor(executor=self.client.executor)
+        work = self.make_work()
+
+        execution.MODULE_CACHE.pop('testing', None)
+
+        process = self.start(serial)
+        results = process.execute_work(work=work, previous_block_hash='0' * 64)
+
+        cold = self.execute_here(serial, work)
+        warm = self.execute_here(serial, work)
+
+        self.assertNotEqual(cold, warm)
+        self.assertEqual(results, warm)
+
+    def test_rounds_start_from_the_state_in_the_database(self):
+        process = self.start(execution.SerialExecutor(executor=self.client.executor))
+        work = self.make_work()
+
+        first = process.execute_work(work=work, previous_block_hash='0' * 64)
+        second = process.execute_work(work=work, previous_block_hash='0' * 64)
+
+        self.assertEqual(first, second)
+        writes = {w['key']: w['value'] for w in first[0]['transactions'][0]['state']}
+        self.assertEqual(writes['testing.counts:a'], 1)
+
+    def test_round_taking_too_long_stops_the_process(self):
+        process = self.start(SleepingExecutor(executor=self.client.executor, seconds=10), timeout=0.2)
+        started = time.time()
+
+        with self.assertRaises(Exception) as e:
+            process.execute_work(work=[], previous_block_hash='0' * 64)
+
+        self.assertIn('not executed within', str(e.exception))
+        self.assertLess(time.time() - started, 5)
+        self.assertFalse(process.is_alive())
+
+    def test_process_dying_raises_instead_of_waiting(self):
+        process = self.start(ExitingExecutor(executor=self.client.executor))
+
+        with self.assertRaises(Exception) as e:
+            process.execute_work(work=[], previous_block_hash='0' * 64)
+
+        self.assertIn('code 3', str(e.exception))
+        self.assertFalse(process.is_alive())
+
+    def test_exception_is_raised_here_and_process_keeps_running(self):
+        process = self.start(FailingExecutor(executor=self.client.executor))
+
+        with self.assertRaises(Exception) as e:
+            process.execute_work(work=[], previous_block_hash='0' * 64)
+
+        self.assertIn('Bad work', str(e.exception))
+        self.assertTrue(process.is_alive())
+
+    def test_stop_stops_the_process(self):
+        process = self.start(execution.SerialExecutor(executor=self.client.executor))
+        p = process.process
+
+        process.stop()
+
+        self.assertFalse(p.is_alive())
+        self.assertEqual(p.exitcode, 0)
+
+    def test_event_loop_runs_while_executing(self):
+        process = self.start(SleepingExecutor(executor=self.client.executor, seconds=0.3))
+
+        loop = asyncio.new_event_loop()
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+
+        async def execute():
+            return await loop.run_in_executor(None, partial(process.execute_work, work=[], previous_block_hash='0' * 64))
+
+        ticker = loop.create_task(tick())
+        loop.run_until_complete(execute())
+        ticker.cancel()
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+        self.assertGreater(len(ticks), 10)
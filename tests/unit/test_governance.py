@@ -0,0 +1,79 @@
+from unittest import TestCase
+from lamden import governance
+from contracting.client import ContractingClient
+
+
+def block_writing(*keys):
+    return {
+        'number': 1,
+        'subblocks': [
+            {
+                'transactions': [
+                    {
+                        'state': [{'key': key, 'value': None} for key in keys]
+                    }
+                ]
+            }
+        ]
+    }
+
+
+class TestGovernanceCache(TestCase):
+    def setUp(self):
+        self.client = ContractingClient()
+        self.client.flush()
+
+        self.client.set_var(contract='masternodes', variable='S', arguments=['members'], value=['a', 'b'])
+        self.client.set_var(contract='delegates', variable='S', arguments=['members'], value=['c'])
+        self.client.set_var(contract='stamp_cost', variable='S', arguments=['value'], value=20)
+
+        self.cache = governance.GovernanceCache(client=self.client)
+
+    def tearDown(self):
+        self.client.flush()
+
+    def test_values_are_read_once(self):
+        self.assertListEqual(self.cache.masternodes(), ['a', 'b'])
+
+        self.client.set_var(contract='masternodes', variable='S', arguments=['members'], value=['a'])
+
+        self.assertListEqual(self.cache.masternodes(), ['a', 'b'])
+
+    def test_block_writing_a_key_invalidates_only_that_key(self):
+        self.cache.masternodes()
+        self.cache.get_var(contract='stamp_cost', variable='S', arguments=['value'])
+
+        self.client.set_var(contract='masternodes', variable='S', arguments=['members'], value=['a'])
+        self.client.set_var(contract='stamp_cost', variable='S', arguments=['value'], value=30)
+
+        self.assertTrue(self.cache.update(block_writing('masternodes.S:members')))
+
+        self.assertListEqual(self.cache.masternodes(), ['a'])
+        self.assertEqual(self.cache.get_var(contract='stamp_cost', variable='S', arguments=['value']), 20)
+
+    def test_block_writing_other_keys_changes_nothing(self):
+        self.cache.masternodes()
+
+        self.assertFalse(self.cache.update(block_writing('currency.balances:a')))
+        self.assertFalse(self.cache.update({'number': 2, 'subblocks': []}))
+
+    def test_member_sets(self):
+        self.assertTrue(self.cache.is_member('a'))
+        self.assertTrue(self.cache.is_member('c'))
+        self.assertFalse(self.cache.is_member('d'))
+
+        self.client.set_var(contract='delegates', variable='S', arguments=['members'], value=['c', 'd'])
+        self.cache.update(block_writing('delegates.S:members'))
+
+        self.assertTrue(self.cache.is_member('d'))
+
+    def test_missing_members_are_empty(self):
+        self.assertListEqual(self.cache.members('nothing'), [])
+
+    def test_clear_forgets_everything(self):
+        self.cache.masternodes()
+        self.client.set_var(contract='masternodes', variable='S', arguments=['members'], value=['a'])
+
+        self.cache.clear()
+
+        self.assertListEqual(self.cache.masternodes(), ['a'])
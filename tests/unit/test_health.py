@@ -0,0 +1,64 @@
+from lamden import health
+from unittest import TestCase
+
+
+class TestPeerTable(TestCase):
+    def test_first_rtt_is_taken_as_is_then_smoothed(self):
+        t = health.PeerTable()
+
+        t.succeeded('a', 0.1)
+        self.assertEqual(t.get('a').rtt, 0.1)
+
+        t.succeeded('a', 0.9)
+        self.assertAlmostEqual(t.get('a').rtt, 0.1 + health.ALPHA * 0.8)
+
+    def test_failures_in_a_row_make_a_peer_dead(self):
+        t = health.PeerTable(max_failures=2)
+
+        t.failed('a')
+        self.assertTrue(t.alive('a'))
+
+        t.failed('a')
+        self.assertFalse(t.alive('a'))
+
+        t.succeeded('a', 0.1, now=5)
+        self.assertTrue(t.alive('a'))
+        self.assertEqual(t.get('a').failures, 0)
+        self.assertEqual(t.get('a').last_seen, 5)
+
+    def test_unknown_peers_are_alive(self):
+        self.assertTrue(health.PeerTable().alive('a'))
+
+    def test_rank_puts_live_fast_peers_first(self):
+        t = health.PeerTable(max_failures=1, unknown_rtt=1.0)
+
+        t.succeeded('slow', 2.0)
+        t.succeeded('fast', 0.01)
+        t.succeeded('dead', 0.001)
+        t.failed('dead')
+
+        peers = {'dead': 'ip_1', 'slow': 'ip_2', 'unknown': 'ip_3', 'fast': 'ip_4'}
+
+        ranked = t.rank(peers)
+
+        self.assertListEqual(list(ranked.keys()), ['fast', 'unknown', 'slow', 'dead'])
+        self.assertDictEqual(ranked, peers)
+
+    def test_rank_keeps_order_of_ties(self):
+        self.assertListEqual(list(health.PeerTable().rank({'b': 1, 'a': 2, 'c': 3}).keys()), ['b', 'a', 'c'])
+
+    def test_best_skips_dead_peers(self):
+        t = health.PeerTable(max_failures=1)
+
+        t.failed('a')
+        self.assertEqual(t.best({'a': 'ip_1', 'b': 'ip_2'}), 'b')
+
+        t.failed('b')
+        self.assertIsNone(t.best({'a': 'ip_1', 'b': 'ip_2'}))
+
+    def test_snapshot(self):
+        t = health.PeerTable()
+        t.succeeded('a', 0.5, now=10)
+        t.saw_height('a', 100)
+
+        self.assertDictEqual(t.snapshot(), {'a': {'rtt': 0.5, 'failures': 0, 'last_seen': 10, 'height': 100}})
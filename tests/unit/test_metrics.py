@@ -0,0 +1,77 @@
+from lamden import metrics
+from unittest import TestCase
+
+
+class TestHistogram(TestCase):
+    def test_observe_counts_into_buckets(self):
+        h = metrics.Histogram(buckets=[1, 2, 4])
+
+        for value in (0.5, 1, 1.5, 3, 10):
+            h.observe(value)
+
+        self.assertListEqual(h.counts, [2, 1, 1, 1])
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.total, 16)
+        self.assertEqual(h.max, 10)
+
+    def test_quantile_is_bucket_upper_bound(self):
+        h = metrics.Histogram(buckets=[1, 2, 4])
+
+        for i in range(98):
+            h.observe(0.5)
+        h.observe(3)
+        h.observe(10)
+
+        self.assertEqual(h.quantile(0.5), 1)
+        self.assertEqual(h.quantile(0.99), 4)
+        self.assertEqual(h.quantile(1), 10)
+
+    def test_empty_quantile_is_zero(self):
+        self.assertEqual(metrics.Histogram().quantile(0.99), 0)
+
+    def test_to_dict_only_lists_used_buckets(self):
+        h = metrics.Histogram(buckets=[1, 2])
+        h.observe(1.5)
+        h.observe(5)
+
+        self.assertDictEqual(h.to_dict()['buckets'], {'2': 1, 'inf': 1})
+
+
+class TestRegistry(TestCase):
+    def test_counters_are_kept_per_label_set(self):
+        r = metrics.Registry()
+
+        r.inc('messages', service='work', peer='a')
+        r.inc('messages', 10, peer='a', service='work')
+        r.inc('messages', service='join', peer='a')
+
+        self.assertEqual(r.counter('messages', service='work', peer='a'), 11)
+        self.assertEqual(r.counter('messages', service='join', peer='a'), 1)
+        self.assertEqual(r.counter('messages', service='catchup', peer='a'), 0)
+
+    def test_histograms_are_kept_per_label_set(self):
+        r = metrics.Registry()
+
+        r.observe('seconds', 0.1, service='work')
+        r.observe('seconds', 0.2, service='work')
+
+        self.assertEqual(r.histogram('seconds', service='work').count, 2)
+        self.assertIsNone(r.histogram('seconds', service='join'))
+
+    def test_snapshot(self):
+        r = metrics.Registry()
+
+        r.inc('messages', service='work')
+        r.observe('seconds', 0.1, service='work')
+
+        snapshot = r.snapshot()
+
+        self.assertDictEqual(snapshot['counters'], {'messages': {'service=work': 1}})
+        self.assertEqual(snapshot['histograms']['seconds']['service=work']['count'], 1)
+
+    def test_clear(self):
+        r = metrics.Registry()
+        r.inc('messages')
+        r.clear()
+
+        self.assertDictEqual(r.snapshot(), {'counters': {}, 'histograms': {}})
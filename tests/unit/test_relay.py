@@ -0,0 +1,178 @@
+from unittest import TestCase
+from lamden import relay, router, authentication, metrics
+from lamden.crypto.wallet import Wallet
+from contracting.client import ContractingClient
+import asyncio
+import zmq.asyncio
+
+
+async def stop_server(s, timeout):
+    await asyncio.sleep(timeout)
+    s.stop()
+
+
+class Recorder(router.Processor):
+    def __init__(self):
+        self.messages = []
+
+    async def process_message(self, msg):
+        self.messages.append(msg)
+
+
+class MockRouter:
+    def __init__(self):
+        self.processed = []
+
+    def dispatch_message(self, msg):
+        self.processed.append(msg)
+
+
+class TestSplit(TestCase):
+    def test_groups_are_nearly_even(self):
+        groups = relay.split(list(range(10)), 3)
+        self.assertListEqual(groups, [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]])
+
+    def test_fewer_peers_than_fanout(self):
+        self.assertListEqual(relay.split([1, 2], 4), [[1], [2]])
+
+    def test_no_peers(self):
+        self.assertListEqual(relay.split([], 4), [])
+
+    def test_fanout_below_one_is_one(self):
+        self.assertListEqual(relay.split([1, 2, 3], 0), [[1, 2, 3]])
+
+
+class TestRelayProcessor(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.router = MockRouter()
+        self.processor = relay.RelayProcessor(
+            router=self.router,
+            ctx=None,
+            wallet=Wallet(),
+            services=['new_blocks'],
+            peers={},
+            remember=2
+        )
+        self.processor.metrics = metrics.Registry()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def relayed(self, msg, service='new_blocks'):
+        return {'service': service, 'msg': msg, 'peers': [], 'fanout': 2}
+
+    def test_message_is_handed_to_its_service(self):
+        self.loop.run_until_complete(self.processor.process_message(self.relayed({'number': 1})))
+        self.assertListEqual(self.router.processed, [{'service': 'new_blocks', 'msg': {'number': 1}}])
+
+    def test_duplicates_are_dropped(self):
+        for i in range(3):
+            self.loop.run_until_complete(self.processor.process_message(self.relayed({'number': 1})))
+
+        self.assertEqual(len(self.router.processed), 1)
+        self.assertEqual(self.processor.metrics.counter('relay_duplicates', service='new_blocks'), 2)
+
+    def test_only_recent_messages_are_remembered(self):
+        for i in (1, 2, 3, 1):
+            self.loop.run_until_complete(self.processor.process_message(self.relayed({'number': i})))
+
+        self.assertEqual(len(self.router.processed), 4)
+
+    def test_other_services_are_not_relayed(self):
+        self.loop.run_until_complete(self.processor.process_message(self.relayed({'vk': 'a'}, service='join')))
+        self.assertListEqual(self.router.processed, [])
+
+    def test_badly_formatted_messages_are_ignored(self):
+        bad = [
+            None,
+            {'service': 'new_blocks', 'msg': {}},
+            {'service': 'new_blocks', 'msg': {}, 'peers': [['a', 'tcp://127.0.0.1:10000']], 'fanout': 2},
+            {'service': 'new_blocks', 'msg': {}, 'peers': [], 'fanout': '2'},
+        ]
+
+        for msg in bad:
+            self.loop.run_until_complete(self.processor.process_message(msg))
+
+        self.assertListEqual(self.router.processed, [])
+
+    def test_peers_not_in_the_peer_table_are_not_sent_to(self):
+        msg = self.relayed({'number': 1})
+        msg['peers'] = [Wallet().verifying_key]
+
+        self.loop.run_until_complete(self.processor.process_message(msg))
+
+        self.assertEqual(len(self.router.processed), 1)
+        self.assertEqual(self.processor.metrics.counter('relay_forwarded', service='new_blocks'), 0)
+
+
+class TestSecureRelay(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+    def tearDown(self):
+        self.authenticator.authenticator.stop()
+        self.ctx.destroy()
+        self.loop.close()
+
+    def test_every_peer_gets_the_message_once_with_bounded_fanout(self):
+        sender = Wallet()
+        wallets = [Wallet() for _ in range(7)]
+
+        for w in [sender] + wallets:
+            self.authenticator.add_verifying_key(w.verifying_key)
+        self.authenticator.configure()
+
+        routers = []
+        recorders = []
+        forwarded = metrics.Registry()
+        peers = {}
+
+        for i, w in enumerate(wallets):
+            ip = f'tcp://127.0.0.1:{18100 + i}'
+            peers[w.verifying_key] = ip
+
+            r = router.Router(socket_id=ip, ctx=self.ctx, secure=True, wallet=w)
+
+            recorder = Recorder()
+            r.add_service('new_blocks', recorder)
+
+            processor = relay.RelayProcessor(router=r, ctx=self.ctx, wallet=w, services=['new_blocks'], peers=peers)
+            processor.metrics = forwarded
+            r.add_service(relay.RELAY_SERVICE, processor)
+
+            routers.append(r)
+            recorders.append(recorder)
+
+        async def send():
+            await asyncio.sleep(0.2)
+            return await relay.secure_relay(
+                msg={'number': 1},
+                service='new_blocks',
+                wallet=sender,
+                peer_map=peers,
+                ctx=self.ctx,
+                fanout=2
+            )
+
+        tasks = asyncio.gather(
+            send(),
+            *[r.serve() for r in routers],
+            *[stop_server(r, 1) for r in routers]
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertListEqual(res[0], [True, True])
+
+        for recorder in recorders:
+            self.assertListEqual(recorder.messages, [{'number': 1}])
+
+        # 7 peers in groups of 4 and 3 sent to by the heads of each group, which send to 2 groups of their own
+        self.assertEqual(forwarded.counter('relay_forwarded', service='new_blocks'), 5)
@@ -1,12 +1,14 @@
 from unittest import TestCase
 
-from lamden import router, authentication
+from lamden import router, authentication, codec, metrics, health
 
 from lamden.crypto.wallet import Wallet
 import zmq.asyncio
 import asyncio
+import msgpack
 from contracting.db.encoder import encode, decode
 from contracting.client import ContractingClient
+from contracting.stdlib.bridge.decimal import ContractingDecimal
 
 
 async def stop_server(s, timeout):
@@ -225,6 +227,41 @@ class TestRouter(TestCase):
         self.assertDictEqual(res[1], expected_msg)
 
 
+class TestNotifier(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_notify_wakes_all_waiters(self):
+        notifier = router.Notifier()
+
+        async def notify():
+            await asyncio.sleep(0.01)
+            notifier.notify()
+
+        res = self.loop.run_until_complete(asyncio.gather(notifier.wait(), notifier.wait(), notify()))
+
+        self.assertListEqual(res, [True, True, None])
+        self.assertListEqual(notifier.waiters, [])
+
+    def test_wait_times_out(self):
+        notifier = router.Notifier()
+
+        res = self.loop.run_until_complete(notifier.wait(timeout=0.01))
+
+        self.assertFalse(res)
+        self.assertListEqual(notifier.waiters, [])
+
+    def test_notify_without_waiters_does_nothing(self):
+        notifier = router.Notifier()
+        notifier.notify()
+
+        self.assertFalse(self.loop.run_until_complete(notifier.wait(timeout=0.01)))
+
+
 class TestAsyncServer(TestCase):
     def setUp(self):
         self.ctx = zmq.asyncio.Context()
@@ -278,6 +315,59 @@ class TestAsyncServer(TestCase):
 
         self.assertEqual(res[1], b'howdy')
 
+    def test_receive_messages_drains_what_is_ready(self):
+        m = router.AsyncInbox('tcp://127.0.0.1:10000', self.ctx, max_batch=3)
+        m.setup_socket()
+
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.connect('tcp://127.0.0.1:10000')
+
+        async def receive():
+            for i in range(5):
+                await socket.send(str(i).encode())
+
+            received = []
+            while len(received) < 5:
+                await m.socket.poll(timeout=100, flags=zmq.POLLIN)
+                batch = m.receive_messages()
+                self.assertLessEqual(len(batch), 3)
+                received.extend(batch)
+
+            return received, m.receive_messages()
+
+        received, empty = self.loop.run_until_complete(receive())
+
+        socket.close()
+        m.socket.close()
+
+        self.assertListEqual([msg for _, msg in received], [b'0', b'1', b'2', b'3', b'4'])
+        self.assertListEqual(empty, [])
+
+    def test_many_messages_are_all_answered(self):
+        m = router.AsyncInbox('tcp://127.0.0.1:10000', self.ctx)
+
+        async def get():
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('tcp://127.0.0.1:10000')
+
+            for i in range(100):
+                await socket.send(str(i).encode())
+
+            res = [await socket.recv() for _ in range(100)]
+            socket.close()
+
+            return res
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertListEqual(sorted(res[1]), sorted(str(i).encode() for i in range(100)))
+
 
 class TestJSONAsyncInbox(TestCase):
     def setUp(self):
@@ -588,3 +678,796 @@ class TestJSONAsyncInbox(TestCase):
 
         self.assertEqual(q1.q[0], {'hello': 'there'})
         self.assertEqual(q2.q[0], {'hello': 'there'})
+
+
+class TestSocketPool(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        self.w1 = Wallet()
+        self.w2 = Wallet()
+
+        self.authenticator.add_verifying_key(self.w1.verifying_key)
+        self.authenticator.add_verifying_key(self.w2.verifying_key)
+        self.authenticator.configure()
+
+    def tearDown(self):
+        self.authenticator.authenticator.stop()
+        self.ctx.destroy()
+        self.loop.close()
+
+    def make_router(self):
+        class MockProcessor(router.Processor):
+            async def process_message(self, msg):
+                return {
+                    'whats': 'good'
+                }
+
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        q = router.QueueProcessor()
+        m.add_service('queue', q)
+        m.add_service('something', MockProcessor())
+
+        return m, q
+
+    def test_get_pool_is_per_context_and_wallet(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w1)
+
+        self.assertIs(router.get_pool(ctx=self.ctx, wallet=self.w1), pool)
+        self.assertIsNot(router.get_pool(ctx=self.ctx, wallet=self.w2), pool)
+        self.assertListEqual(router.wallet_pools(ctx=self.ctx, wallet=self.w1), [pool])
+
+    def test_requests_reuse_socket(self):
+        m, _ = self.make_router()
+
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        async def get():
+            sockets = []
+            responses = []
+            for i in range(3):
+                responses.append(await router.secure_request(
+                    msg={'hello': 'there'},
+                    service='something',
+                    wallet=self.w2,
+                    vk=self.w1.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx
+                ))
+                sockets.append(pool.sockets[(self.w1.verifying_key, router.SocketPool.REQUEST)][1])
+
+            return responses, sockets
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+        responses, sockets = res[1]
+
+        self.assertListEqual(responses, [{'whats': 'good'}] * 3)
+        self.assertIs(sockets[0], sockets[1])
+        self.assertIs(sockets[1], sockets[2])
+
+    def test_requests_are_measured_per_peer(self):
+        m, _ = self.make_router()
+
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+        pool.metrics = metrics.Registry()
+
+        vk = self.w1.verifying_key
+
+        async def get():
+            for i in range(2):
+                await router.secure_request(
+                    msg={'hello': 'there'},
+                    service='something',
+                    wallet=self.w2,
+                    vk=vk,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx
+                )
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        self.assertEqual(pool.metrics.counter('pool_requests', service='something', peer=vk), 2)
+        self.assertEqual(pool.metrics.histogram('pool_request_seconds', service='something', peer=vk).count, 2)
+        self.assertGreater(pool.metrics.counter('pool_bytes_out', service='something', peer=vk), 0)
+        self.assertGreater(pool.metrics.counter('pool_bytes_in', peer=vk), 0)
+
+    def test_requests_update_peer_health(self):
+        m, _ = self.make_router()
+
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+        pool.health = health.PeerTable()
+
+        async def get():
+            await router.secure_request(
+                msg={'hello': 'there'},
+                service='something',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx
+            )
+
+            # Nothing listens here
+            await router.secure_request(
+                msg={'hello': 'there'},
+                service='something',
+                wallet=self.w2,
+                vk=self.w2.verifying_key,
+                ip='tcp://127.0.0.1:10001',
+                ctx=self.ctx,
+                timeout=100
+            )
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        peer = pool.health.get(self.w1.verifying_key)
+        self.assertGreater(peer.rtt, 0)
+        self.assertEqual(peer.failures, 0)
+        self.assertIsNotNone(peer.last_seen)
+
+        peer = pool.health.get(self.w2.verifying_key)
+        self.assertIsNone(peer.rtt)
+        self.assertEqual(peer.failures, 1)
+
+    def test_sends_to_a_peer_that_is_down_fail_and_are_not_delivered_later(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+        pool.metrics = metrics.Registry()
+
+        vk = self.w1.verifying_key
+        ip = 'tcp://127.0.0.1:10000'
+
+        sent = self.loop.run_until_complete(
+            pool.send(vk=vk, ip=ip, message=router.build_message(service='queue', message={'stale': True}))
+        )
+
+        self.assertFalse(sent)
+        self.assertEqual(pool.metrics.counter('pool_send_failures', service='queue', peer=vk), 1)
+
+        socket = pool.sockets[(vk, router.SocketPool.SEND)][1]
+        self.assertEqual(socket.getsockopt(zmq.IMMEDIATE), 1)
+        self.assertEqual(socket.getsockopt(zmq.SNDHWM), router.SEND_HWM)
+
+        m, q = self.make_router()
+
+        async def send():
+            await asyncio.sleep(0.2)
+            return await pool.send(vk=vk, ip=ip, message=router.build_message(service='queue', message={'fresh': True}))
+
+        tasks = asyncio.gather(
+            m.serve(),
+            send(),
+            stop_server(m, 1),
+        )
+
+        _, sent, _ = self.loop.run_until_complete(tasks)
+
+        self.assertTrue(sent)
+        self.assertIs(pool.sockets[(vk, router.SocketPool.SEND)][1], socket)
+        self.assertEqual(q.q, [{'fresh': True}])
+
+    def test_send_replies_are_not_read_as_request_responses(self):
+        m, q = self.make_router()
+
+        async def get():
+            for i in range(5):
+                await router.secure_send(
+                    msg={'i': i},
+                    service='queue',
+                    wallet=self.w2,
+                    vk=self.w1.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx
+                )
+
+            await asyncio.sleep(0.2)
+
+            return await router.secure_request(
+                msg={'hello': 'there'},
+                service='something',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx
+            )
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertDictEqual(res[1], {'whats': 'good'})
+        self.assertListEqual(q.q, [{'i': i} for i in range(5)])
+
+    def test_timed_out_request_keeps_socket(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        res = self.loop.run_until_complete(pool.request(
+            vk=self.w1.verifying_key,
+            ip='tcp://127.0.0.1:10005',
+            message={},
+            timeout=50
+        ))
+
+        self.assertIsNone(res)
+        self.assertDictEqual(pool.pending, {})
+        self.assertIn((self.w1.verifying_key, router.SocketPool.REQUEST), pool.sockets)
+
+    def test_concurrent_requests_share_socket_and_match_replies(self):
+        class SlowProcessor(router.Processor):
+            async def process_message(self, msg):
+                # Later requests are answered first
+                await asyncio.sleep(0.01 * (10 - msg['i']))
+                return msg['i'] * 2
+
+        m, _ = self.make_router()
+        m.add_service('slow', SlowProcessor())
+
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        async def get():
+            return await asyncio.gather(*[router.secure_request(
+                msg={'i': i},
+                service='slow',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx
+            ) for i in range(10)])
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertListEqual(res[1], [i * 2 for i in range(10)])
+        self.assertEqual(len(pool.sockets), 1)
+        self.assertDictEqual(pool.pending, {})
+
+    def test_replies_without_id_from_older_nodes_are_accepted(self):
+        class OldRouter(router.Router):
+            def envelope(self, msg, response):
+                return response
+
+        m = OldRouter(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w1
+        )
+
+        class ListProcessor(router.Processor):
+            async def process_message(self, msg):
+                return [msg['i']]
+
+        m.add_service('list', ListProcessor())
+
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        async def get():
+            responses = []
+            for i in range(3):
+                responses.append(await router.secure_request(
+                    msg={'i': i},
+                    service='list',
+                    wallet=self.w2,
+                    vk=self.w1.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx
+                ))
+            return responses
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertListEqual(res[1], [[0], [1], [2]])
+        self.assertDictEqual(pool.in_flight, {})
+
+    def test_late_reply_is_dropped(self):
+        class SlowProcessor(router.Processor):
+            async def process_message(self, msg):
+                await asyncio.sleep(msg['wait'])
+                return msg['wait']
+
+        m, _ = self.make_router()
+        m.add_service('slow', SlowProcessor())
+
+        async def get():
+            responses = []
+            for wait in (0.3, 0):
+                responses.append(await router.secure_request(
+                    msg={'wait': wait},
+                    service='slow',
+                    wallet=self.w2,
+                    vk=self.w1.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx,
+                    timeout=100
+                ))
+            await asyncio.sleep(0.3)
+            responses.append(await router.secure_request(
+                msg={'wait': 0},
+                service='slow',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx
+            ))
+            return responses
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1.5),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertListEqual(res[1], [None, 0, 0])
+
+    def test_missing_certificate_returns_none(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        self.assertIsNone(pool.connect(Wallet().verifying_key, 'tcp://127.0.0.1:10000', router.SocketPool.SEND))
+        self.assertDictEqual(pool.sockets, {})
+
+    def test_new_ip_replaces_socket(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        s1 = pool.connect(self.w1.verifying_key, 'tcp://127.0.0.1:10000', router.SocketPool.SEND)
+        s2 = pool.connect(self.w1.verifying_key, 'tcp://127.0.0.1:10000', router.SocketPool.SEND)
+        s3 = pool.connect(self.w1.verifying_key, 'tcp://127.0.0.1:10001', router.SocketPool.SEND)
+
+        self.assertIs(s1, s2)
+        self.assertIsNot(s1, s3)
+        self.assertTrue(s1.closed)
+
+    def test_retain_closes_sockets_of_peers_that_left(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        s1 = pool.connect(self.w1.verifying_key, 'tcp://127.0.0.1:10000', router.SocketPool.SEND)
+        s2 = pool.connect(self.w2.verifying_key, 'tcp://127.0.0.1:10001', router.SocketPool.REQUEST)
+
+        pool.retain([self.w2.verifying_key])
+
+        self.assertTrue(s1.closed)
+        self.assertFalse(s2.closed)
+        self.assertListEqual(list(pool.sockets.keys()), [(self.w2.verifying_key, router.SocketPool.REQUEST)])
+
+        pool.close()
+
+        self.assertTrue(s2.closed)
+        self.assertDictEqual(pool.sockets, {})
+
+    def test_pool_switches_to_binary_once_peer_supports_it(self):
+        m, q = self.make_router()
+
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        async def get():
+            codecs = [pool.codec(self.w1.verifying_key)]
+            responses = []
+            for i in range(2):
+                responses.append(await router.secure_request(
+                    msg={'hello': 'there'},
+                    service='something',
+                    wallet=self.w2,
+                    vk=self.w1.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx
+                ))
+                codecs.append(pool.codec(self.w1.verifying_key))
+
+            await router.secure_send(
+                msg={'amount': ContractingDecimal('1.5')},
+                service='queue',
+                wallet=self.w2,
+                vk=self.w1.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx
+            )
+
+            return responses, codecs
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+        responses, codecs = res[1]
+
+        self.assertListEqual(responses, [{'whats': 'good'}] * 2)
+        self.assertListEqual(codecs, [codec.JSON, codec.BINARY, codec.BINARY])
+        self.assertListEqual(q.q, [{'amount': ContractingDecimal('1.5')}])
+
+    def test_router_replies_in_the_format_of_the_request(self):
+        m, _ = self.make_router()
+        m.secure = False
+
+        async def request(fmt):
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('tcp://127.0.0.1:10000')
+
+            await socket.send(codec.dumps({'service': 'something', 'msg': {}}, fmt))
+            resp = await socket.recv()
+            socket.close()
+
+            return codec.unpack(resp)
+
+        async def both():
+            return [await request(codec.JSON), await request(codec.BINARY)]
+
+        tasks = asyncio.gather(
+            m.serve(),
+            both(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertListEqual(res[1], [({'whats': 'good'}, codec.JSON), ({'whats': 'good'}, codec.BINARY)])
+
+    def test_router_compresses_large_replies_for_peers_that_accept_it(self):
+        m, _ = self.make_router()
+        m.secure = False
+
+        class BigProcessor(router.Processor):
+            async def process_message(self, msg):
+                return {'blocks': ['a' * 64] * 100}
+
+        m.add_service('big', BigProcessor())
+
+        async def request(codecs):
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('tcp://127.0.0.1:10000')
+
+            await socket.send(codec.dumps({'service': 'big', 'msg': {}, 'id': 1, 'codecs': codecs}))
+            resp = await socket.recv()
+            socket.close()
+
+            return resp
+
+        async def both():
+            return [await request(codec.FORMATS), await request(codec.SUPPORTED)]
+
+        tasks = asyncio.gather(
+            m.serve(),
+            both(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+        plain, compressed = res[1]
+
+        self.assertNotEqual(plain[:1], codec.COMPRESSED_V1)
+        self.assertEqual(compressed[:1], codec.COMPRESSED_V1)
+        self.assertLess(len(compressed), len(plain))
+        self.assertEqual(codec.loads(plain), codec.loads(compressed))
+
+    def test_pool_compresses_once_peer_accepts_it(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+        vk = self.w1.verifying_key
+        msg = {'blocks': ['a' * 64] * 100}
+
+        self.assertEqual(pool.dumps(vk, msg), codec.dumps(msg))
+
+        pool.learn_codec(vk, codec.SUPPORTED)
+        self.assertEqual(pool.dumps(vk, msg)[:1], codec.COMPRESSED_V1)
+
+        pool.learn_codec(vk, codec.FORMATS)
+        self.assertEqual(pool.dumps(vk, msg)[:1], codec.BINARY_V1)
+
+    def test_multicast_reports_outcome_per_peer(self):
+        m, q = self.make_router()
+
+        missing = Wallet()
+
+        async def send():
+            return await router.secure_multicast(
+                msg={'hello': 'there'},
+                service='queue',
+                wallet=self.w2,
+                peer_map={
+                    self.w1.verifying_key: 'tcp://127.0.0.1:10000',
+                    missing.verifying_key: 'tcp://127.0.0.1:10001'
+                },
+                ctx=self.ctx
+            )
+
+        tasks = asyncio.gather(
+            m.serve(),
+            send(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertDictEqual(res[1], {self.w1.verifying_key: True, missing.verifying_key: False})
+        self.assertListEqual(q.q, [{'hello': 'there'}])
+
+    def test_multicast_encodes_once_per_format(self):
+        pool = router.get_pool(ctx=self.ctx, wallet=self.w2)
+
+        w3 = Wallet()
+        w4 = Wallet()
+        pool.learn_codec(w4.verifying_key, codec.FORMATS)
+
+        encoded = []
+        dumps = codec.dumps
+
+        def counting_dumps(*args, **kwargs):
+            encoded.append(args)
+            return dumps(*args, **kwargs)
+
+        peers = {
+            self.w1.verifying_key: 'tcp://127.0.0.1:10000',
+            w3.verifying_key: 'tcp://127.0.0.1:10001',
+            w4.verifying_key: 'tcp://127.0.0.1:10002'
+        }
+
+        codec.dumps = counting_dumps
+        try:
+            self.loop.run_until_complete(pool.multicast(peers=peers, message={'hello': 'there'}))
+        finally:
+            codec.dumps = dumps
+
+        self.assertEqual(len(encoded), 2)
+
+
+class TestServiceQueues(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.ctx = zmq.asyncio.Context()
+
+    def tearDown(self):
+        self.ctx.destroy()
+        self.loop.close()
+
+    def make_router(self, concurrency=1):
+        replies = []
+
+        class RecordingRouter(router.Router):
+            async def return_msg(self, _id, msg, fmt=codec.JSON, compress=False):
+                replies.append((_id, msg))
+                return len(codec.dumps(msg, fmt))
+
+        m = RecordingRouter(socket_id='tcp://127.0.0.1:10000', ctx=self.ctx, concurrency=concurrency)
+        m.metrics = metrics.Registry()
+
+        return m, replies
+
+    def test_drop_newest_rejects_incoming(self):
+        q = router.ServiceQueue(max_queue=2)
+
+        self.assertIsNone(q.put(1))
+        self.assertIsNone(q.put(2))
+        self.assertEqual(q.put(3), 3)
+
+        self.assertListEqual(list(q.q), [1, 2])
+        self.assertEqual(q.stats()['dropped'], 1)
+
+    def test_drop_oldest_makes_room(self):
+        q = router.ServiceQueue(max_queue=2, policy=router.DROP_OLDEST)
+
+        q.put(1)
+        q.put(2)
+        self.assertEqual(q.put(3), 1)
+
+        self.assertListEqual(list(q.q), [2, 3])
+        self.assertDictEqual(q.stats(), {
+            'depth': 2, 'active': 0, 'received': 3, 'handled': 0, 'dropped': 1, 'peak': 2
+        })
+
+    def test_high_priority_services_are_handled_first(self):
+        m, replies = self.make_router()
+        handled = []
+
+        class Recorder(router.Processor):
+            def __init__(self, name):
+                self.name = name
+
+            async def process_message(self, msg):
+                handled.append(self.name)
+                await asyncio.sleep(0)
+
+        m.add_service('catchup', Recorder('catchup'), priority=router.LOW)
+        m.add_service('contenders', Recorder('contenders'), priority=router.HIGH)
+
+        async def send():
+            for i in range(3):
+                m.dispatch(b'a', codec.dumps(router.build_message('catchup', {})))
+            for i in range(3):
+                m.dispatch(b'b', codec.dumps(router.build_message('contenders', {})))
+
+            while len(replies) < 6:
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(send())
+
+        # The first catchup message started before any contenders arrived
+        self.assertListEqual(handled, ['catchup', 'contenders', 'contenders', 'contenders', 'catchup', 'catchup'])
+
+    def test_dispatched_messages_are_queued_and_not_replied_to(self):
+        m, replies = self.make_router()
+        handled = []
+
+        class Recorder(router.Processor):
+            async def process_message(self, msg):
+                handled.append(msg['i'])
+                await asyncio.sleep(0)
+
+        m.add_service('new_blocks', Recorder(), max_queue=2, policy=router.DROP_OLDEST)
+
+        async def send():
+            for i in range(3):
+                m.dispatch_message(router.build_message('new_blocks', {'i': i}))
+
+            while m.active > 0:
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(send())
+
+        # Handling starts once the loop runs, and by then the first one made room for the third
+        self.assertListEqual(handled, [1, 2])
+        self.assertListEqual(replies, [])
+        self.assertEqual(m.metrics.counter('router_dropped', service='new_blocks'), 1)
+
+    def test_batches_are_queued_before_handling(self):
+        m, replies = self.make_router()
+        handled = []
+
+        class Recorder(router.Processor):
+            def __init__(self, name):
+                self.name = name
+
+            async def process_message(self, msg):
+                handled.append(self.name)
+
+        m.add_service('catchup', Recorder('catchup'), priority=router.LOW)
+        m.add_service('contenders', Recorder('contenders'), priority=router.HIGH)
+
+        batch = [(b'a', codec.dumps(router.build_message('catchup', {}))) for _ in range(2)] + \
+                [(b'b', codec.dumps(router.build_message('contenders', {}))) for _ in range(2)]
+
+        async def send():
+            m.dispatch_batch(batch)
+
+            while len(replies) < 4:
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(send())
+
+        self.assertListEqual(handled, ['contenders', 'contenders', 'catchup', 'catchup'])
+
+    def test_full_queue_replies_busy_or_empty_request(self):
+        m, replies = self.make_router(concurrency=0)
+        m.add_service('something', router.QueueProcessor(), max_queue=1)
+
+        m.dispatch(b'a', codec.dumps(router.build_message('something', {})))
+        m.dispatch(b'b', codec.dumps(router.build_message('something', {})))
+        m.dispatch(b'c', codec.dumps({**router.build_message('something', {}), 'id': 5}))
+
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertListEqual(replies, [
+            (b'b', router.BUSY),
+            (b'c', {'id': 5, 'reply': None, 'codecs': codec.SUPPORTED})
+        ])
+        self.assertDictEqual(m.stats()['something'], {
+            'depth': 1, 'active': 0, 'received': 3, 'handled': 0, 'dropped': 2, 'peak': 1
+        })
+
+    def test_concurrency_per_service_is_limited(self):
+        m, replies = self.make_router(concurrency=10)
+        active = []
+        peak = []
+
+        class Slow(router.Processor):
+            async def process_message(self, msg):
+                active.append(msg)
+                peak.append(len(active))
+                await asyncio.sleep(0.01)
+                active.remove(msg)
+
+        m.add_service('slow', Slow(), concurrency=2)
+
+        async def send():
+            for i in range(6):
+                m.dispatch(b'a', codec.dumps(router.build_message('slow', {'i': i})))
+
+            while len(replies) < 6:
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(send())
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(m.stats()['slow']['handled'], 6)
+
+    def test_unknown_service_is_answered_without_queueing(self):
+        m, replies = self.make_router()
+
+        m.dispatch(b'a', codec.dumps(router.build_message('nothing', {})))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertListEqual(replies, [(b'a', router.OK)])
+        self.assertDictEqual(m.stats(), {})
+
+    def test_malformed_message_does_not_stop_the_batch(self):
+        m, replies = self.make_router()
+        m.add_service('something', router.QueueProcessor())
+
+        bad = codec.BINARY_V1 + msgpack.packb({'service': msgpack.ExtType(codec.FIXED_EXT, b'nope')})
+        good = codec.dumps(router.build_message('something', {'hello': 'there'}))
+
+        m.dispatch_batch([(b'a', bad), (b'b', good)])
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertListEqual(sorted(_id for _id, _ in replies), [b'a', b'b'])
+
+    def test_messages_are_measured_per_service(self):
+        m, replies = self.make_router()
+        m.add_service('something', router.QueueProcessor())
+
+        data = codec.dumps(router.build_message('something', {'hello': 'there'}))
+
+        async def send():
+            m.dispatch(b'a', data)
+            m.dispatch(b'b', data)
+
+            while len(replies) < 2:
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(send())
+
+        self.assertEqual(m.metrics.counter('router_messages_in', service='something'), 2)
+        self.assertEqual(m.metrics.counter('router_bytes_in', service='something'), 2 * len(data))
+        self.assertEqual(m.metrics.counter('router_bytes_out', service='something'), 2 * len(codec.dumps(router.OK)))
+
+        for name in ('router_decode_seconds', 'router_process_seconds', 'router_response_seconds'):
+            self.assertEqual(m.metrics.histogram(name, service='something').count, 2)
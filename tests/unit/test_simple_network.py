@@ -449,3 +449,162 @@ class TestNetwork(TestCase):
         self.assertDictEqual(n1.peers, bootnodes)
         self.assertDictEqual(n2.peers, bootnodes)
         self.assertDictEqual(n3.peers, bootnodes)
+
+    def test_unresponsive_bootnode_is_retried_with_backoff(self):
+        joins = []
+
+        class SilentJoin(router.Processor):
+            async def process_message(self, msg):
+                joins.append(time.time())
+
+        me = Wallet()
+        w_1 = Wallet()
+
+        for vk in (me.verifying_key, w_1.verifying_key):
+            self.authenticator.add_verifying_key(vk)
+        self.authenticator.configure()
+
+        router_1 = Router(socket_id='tcp://127.0.0.1:18003', ctx=self.ctx, secure=True, wallet=w_1)
+        router_1.add_service('join', SilentJoin())
+
+        n_router = Router(socket_id='tcp://127.0.0.1:18002', ctx=self.ctx, secure=True, wallet=me)
+        n = Network(wallet=me, ip_string='tcp://127.0.0.1:18002', ctx=self.ctx, router=n_router,
+                    min_delay=0.05, max_delay=0.4)
+
+        async def discover():
+            try:
+                await asyncio.wait_for(n.start({w_1.verifying_key: 'tcp://127.0.0.1:18003'}, [w_1.verifying_key]), 1)
+            except asyncio.TimeoutError:
+                pass
+
+        tasks = asyncio.gather(
+            router_1.serve(),
+            discover(),
+            stop_server(router_1, 1.1)
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        # 0.05, 0.1, 0.2, then 0.4 seconds apart rather than as fast as possible
+        self.assertGreater(len(joins), 2)
+        self.assertLess(len(joins), 9)
+
+    def test_start_returns_at_quorum_and_keeps_looking(self):
+        me = Wallet()
+        w_1 = Wallet()
+        w_2 = Wallet()
+
+        for vk in (me.verifying_key, w_1.verifying_key, w_2.verifying_key):
+            self.authenticator.add_verifying_key(vk)
+        self.authenticator.configure()
+
+        ips = ['tcp://127.0.0.1:18002', 'tcp://127.0.0.1:18003', 'tcp://127.0.0.1:18004']
+
+        r = Router(socket_id=ips[0], ctx=self.ctx, secure=True, wallet=me)
+        n = Network(wallet=me, ip_string=ips[0], ctx=self.ctx, router=r, min_delay=0.05, max_delay=0.2)
+
+        r_1 = Router(socket_id=ips[1], ctx=self.ctx, secure=True, wallet=w_1)
+        n_1 = Network(wallet=w_1, ip_string=ips[1], ctx=self.ctx, router=r_1)
+
+        # w_2 is offline
+        bootnodes = {w_1.verifying_key: ips[1], w_2.verifying_key: ips[2]}
+        vks = [me.verifying_key, w_1.verifying_key, w_2.verifying_key]
+
+        async def start():
+            # A round lasts as long as the join to the offline node takes to time out
+            await asyncio.wait_for(n.start(bootnodes, vks, quorum=0.6), 3)
+            return n.discovery
+
+        tasks = asyncio.gather(
+            r.serve(),
+            r_1.serve(),
+            start(),
+            stop_server(r, 3),
+            stop_server(r_1, 3)
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertIsNotNone(res[2])
+        self.assertFalse(res[2].done())
+        self.assertDictEqual(n.peers, {me.verifying_key: ips[0], w_1.verifying_key: ips[1]})
+
+        n.stop()
+        self.loop.run_until_complete(asyncio.wait([res[2]]))
+        self.assertTrue(res[2].cancelled())
+
+    def test_ping_records_health_of_peers(self):
+        me = Wallet()
+        w_1 = Wallet()
+        w_2 = Wallet()
+
+        for vk in (me.verifying_key, w_1.verifying_key, w_2.verifying_key):
+            self.authenticator.add_verifying_key(vk)
+        self.authenticator.configure()
+
+        r = Router(socket_id='tcp://127.0.0.1:18002', ctx=self.ctx, secure=True, wallet=me)
+        n = Network(wallet=me, ip_string='tcp://127.0.0.1:18002', ctx=self.ctx, router=r)
+
+        r_1 = Router(socket_id='tcp://127.0.0.1:18003', ctx=self.ctx, secure=True, wallet=w_1)
+        Network(wallet=w_1, ip_string='tcp://127.0.0.1:18003', ctx=self.ctx, router=r_1)
+
+        n.health = health.PeerTable()
+        router.get_pool(ctx=self.ctx, wallet=me).health = n.health
+
+        # w_2 is offline
+        n.peers[w_1.verifying_key] = 'tcp://127.0.0.1:18003'
+        n.peers[w_2.verifying_key] = 'tcp://127.0.0.1:18004'
+
+        tasks = asyncio.gather(
+            r_1.serve(),
+            n.ping(),
+            stop_server(r_1, 1.2)
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        self.assertGreater(n.health.get(w_1.verifying_key).rtt, 0)
+        self.assertEqual(n.health.get(w_2.verifying_key).failures, 1)
+        self.assertNotIn(me.verifying_key, n.health.peers)
+
+        self.assertEqual(n.best_peer([me.verifying_key, w_1.verifying_key, w_2.verifying_key]), w_1.verifying_key)
+
+class TestBackoff(TestCase):
+    def test_failures_double_the_delay_up_to_maximum(self):
+        b = Backoff(minimum=1, maximum=4)
+
+        delays = []
+        for i in range(4):
+            b.failed('a', 0)
+            delays.append(b.delays['a'])
+
+        self.assertListEqual(delays, [1, 2, 4, 4])
+        self.assertFalse(b.ready('a', 2.9))
+        self.assertTrue(b.ready('a', 4))
+
+    def test_success_resets_the_delay(self):
+        b = Backoff(minimum=1, maximum=4)
+
+        b.failed('a', 0)
+        b.failed('a', 0)
+        b.succeeded('a', 10)
+
+        self.assertEqual(b.delays['a'], 1)
+        self.assertFalse(b.ready('a', 10.5))
+        self.assertTrue(b.ready('a', 11))
+
+    def test_unknown_keys_are_ready(self):
+        b = Backoff()
+
+        self.assertTrue(b.ready('a', 0))
+        self.assertEqual(b.wait_time(['a'], 0), 0)
+
+    def test_wait_time_is_until_first_key_is_ready(self):
+        b = Backoff(minimum=1, maximum=8)
+
+        b.succeeded('a', 0)
+        b.failed('b', 0)
+        b.failed('b', 0)
+
+        self.assertEqual(b.wait_time(['a', 'b'], 0), 1)
+        self.assertEqual(b.wait_time(['b'], 0.5), b.next_attempt['b'] - 0.5)
@@ -1,6 +1,12 @@
 from lamden import storage
-from contracting.db.driver import ContractDriver
+from contracting.db.driver import ContractDriver, InMemDriver
+from contracting.db.encoder import encode
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+from contracting.stdlib.bridge.time import Datetime
 from unittest import TestCase
+import json
+import pathlib
+import tempfile
 
 from lamden.storage import BlockStorage
 
@@ -57,6 +63,61 @@ class TestNonce(TestCase):
 
         self.assertEqual(n, 2)
 
+    def test_indexes_created_on_init(self):
+        report = self.nonces.index_report()
+
+        self.assertEqual(report, {'nonces': [], 'pending_nonces': []})
+
+    def test_indexes_recreated_after_flush(self):
+        self.nonces.flush()
+
+        report = self.nonces.index_report()
+
+        self.assertEqual(report, {'nonces': [], 'pending_nonces': []})
+
+    def test_remove_duplicates_keeps_highest_nonce(self):
+        self.nonces.nonces.drop()
+
+        self.nonces.nonces.insert_many([
+            {'sender': 'a', 'processor': 'b', 'value': 1},
+            {'sender': 'a', 'processor': 'b', 'value': 3},
+            {'sender': 'a', 'processor': 'b', 'value': 2}
+        ])
+
+        self.assertEqual(self.nonces.remove_duplicates(), {'nonces': 2, 'pending_nonces': 0})
+
+        self.nonces.create_indexes()
+
+        self.assertEqual(self.nonces.get_nonce(sender='a', processor='b'), 3)
+        self.assertEqual(self.nonces.index_report()['nonces'], [])
+
+    def test_nonce_lookups_use_index(self):
+        for stages in self.nonces.query_plans().values():
+            self.assertIn('IXSCAN', stages)
+
+    def test_set_nonces_sets_all(self):
+        self.nonces.set_nonces({
+            ('test', 'test2'): 2,
+            ('test3', 'test2'): 5
+        })
+
+        self.assertEqual(self.nonces.get_nonce(sender='test', processor='test2'), 2)
+        self.assertEqual(self.nonces.get_nonce(sender='test3', processor='test2'), 5)
+
+    def test_set_pending_nonces_overwrites(self):
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=2)
+
+        self.nonces.set_pending_nonces({
+            ('test', 'test2'): None
+        })
+
+        self.assertIsNone(self.nonces.get_pending_nonce(sender='test', processor='test2'))
+
+    def test_set_nonces_empty_does_nothing(self):
+        self.nonces.set_nonces({})
+
+        self.assertEqual(self.nonces.nonces.count_documents({}), 0)
+
     def test_get_latest_nonce_zero_if_none_set(self):
         n = self.nonces.get_latest_nonce(
             sender='test',
@@ -94,6 +155,114 @@ class TestNonce(TestCase):
         self.assertEqual(n, 2)
 
 
+class TestCachedNonce(TestCase):
+    def setUp(self):
+        self.nonces = storage.CachedNonceStorage(max_senders=2)
+        self.nonces.flush()
+
+    def tearDown(self):
+        self.nonces.flush()
+
+    def test_set_nonce_writes_through_to_db(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+
+        n = storage.NonceStorage.get_one('test', 'test2', self.nonces.nonces)
+
+        self.assertEqual(n, 2)
+
+    def test_set_pending_nonce_writes_through_to_db(self):
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=2)
+
+        n = storage.NonceStorage.get_one('test', 'test2', self.nonces.pending_nonces)
+
+        self.assertEqual(n, 2)
+
+    def test_get_nonce_served_from_cache_after_first_read(self):
+        storage.NonceStorage.set_one('test', 'test2', 2, self.nonces.nonces)
+
+        self.assertEqual(self.nonces.get_nonce(sender='test', processor='test2'), 2)
+
+        self.nonces.nonces.drop()
+
+        self.assertEqual(self.nonces.get_nonce(sender='test', processor='test2'), 2)
+
+    def test_missing_nonce_is_cached_as_none(self):
+        self.assertIsNone(self.nonces.get_nonce(sender='test', processor='test2'))
+
+        self.assertIn(('test', 'test2'), self.nonces.nonce_cache)
+
+    def test_least_recently_used_sender_evicted(self):
+        self.nonces.set_nonce(sender='a', processor='p', value=1)
+        self.nonces.set_nonce(sender='b', processor='p', value=1)
+
+        # Touch a so that b is the least recently used
+        self.nonces.get_nonce(sender='a', processor='p')
+
+        self.nonces.set_nonce(sender='c', processor='p', value=1)
+
+        self.assertEqual(list(self.nonces.nonce_cache.keys()), [('a', 'p'), ('c', 'p')])
+
+    def test_evicted_sender_reloaded_from_db(self):
+        self.nonces.set_nonce(sender='a', processor='p', value=5)
+        self.nonces.set_nonce(sender='b', processor='p', value=1)
+        self.nonces.set_nonce(sender='c', processor='p', value=1)
+
+        self.assertNotIn(('a', 'p'), self.nonces.nonce_cache)
+        self.assertEqual(self.nonces.get_nonce(sender='a', processor='p'), 5)
+
+    def test_get_latest_nonce_uses_cached_pending_nonce(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=5)
+
+        self.assertEqual(self.nonces.get_latest_nonce(sender='test', processor='test2'), 5)
+
+    def test_flush_pending_clears_pending_cache(self):
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=5)
+        self.nonces.flush_pending()
+
+        self.assertIsNone(self.nonces.get_pending_nonce(sender='test', processor='test2'))
+
+
+    def test_positional_arguments_go_to_nonce_storage(self):
+        nonces = storage.CachedNonceStorage(27028, 'lamden', 'nonces', 'pending_nonces')
+
+        self.assertEqual(nonces.port, 27028)
+        self.assertEqual(nonces.max_senders, 100_000)
+
+class TestToDocument(TestCase):
+    def test_to_document_matches_json_round_trip(self):
+        block = {
+            'hash': 'a' * 64,
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [
+                        {
+                            'hash': 'b' * 64,
+                            'state': [{'key': 'currency.balances:stu', 'value': ContractingDecimal('100.5')}],
+                            'stamps_used': 10,
+                            'result': 'None',
+                            'raw': b'\x00\x01',
+                            'now': Datetime(2020, 1, 1),
+                            'tuple': (1, 2)
+                        }
+                    ]
+                }
+            ]
+        }
+
+        self.assertEqual(storage.to_document(block), json.loads(encode(block)))
+
+    def test_to_document_does_not_share_structure_with_input(self):
+        tx = {'hash': 'b' * 64}
+        block = {'subblocks': [{'transactions': [tx]}]}
+
+        doc = storage.to_document(block)
+        doc['subblocks'][0]['transactions'][0]['_id'] = 123
+
+        self.assertNotIn('_id', tx)
+
+
 class TestStorage(TestCase):
     def setUp(self):
         self.driver = ContractDriver()
@@ -443,6 +612,88 @@ class TestUpdatingState(TestCase):
         self.assertEqual(v4, 'value')
         self.assertEqual(v5, 'else')
 
+    def test_update_state_with_block_last_write_wins(self):
+        txs = [
+            {
+                'state': [{'key': 'hello', 'value': i}, {'key': f'key{i}', 'value': i}],
+                'transaction': {'payload': {'sender': 'abc', 'processor': 'def', 'nonce': i}}
+            } for i in range(10)
+        ]
+
+        b = {
+            'hash': 'a' * 64,
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': txs[:5]
+                },
+                {
+                    'transactions': txs[5:]
+                }
+            ]
+        }
+
+        storage.update_state_with_block(
+            block=b,
+            driver=self.driver,
+            nonces=self.nonces
+        )
+
+        self.assertEqual(self.driver.get('hello', mark=False), 9)
+        self.assertEqual(self.driver.get('key0', mark=False), 0)
+        self.assertEqual(self.nonces.get_nonce(sender='abc', processor='def'), 10)
+
+    def test_update_state_with_block_none_value_deletes_key(self):
+        self.driver.driver.set('hello', 'there')
+
+        b = {
+            'hash': 'a' * 64,
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [
+                        {
+                            'state': [{'key': 'hello', 'value': None}],
+                            'transaction': {'payload': {'sender': 'abc', 'processor': 'def', 'nonce': 0}}
+                        }
+                    ]
+                }
+            ]
+        }
+
+        storage.update_state_with_block(
+            block=b,
+            driver=self.driver,
+            nonces=self.nonces
+        )
+
+        self.assertIsNone(self.driver.driver.get('hello'))
+
+    def test_update_state_with_block_in_memory_driver(self):
+        driver = ContractDriver(driver=InMemDriver())
+
+        storage.update_state_with_block(
+            block=block,
+            driver=driver,
+            nonces=self.nonces
+        )
+
+        self.assertEqual(driver.get('hello', mark=False), 'there2')
+        self.assertEqual(storage.get_latest_block_height(driver), 555)
+
+    def test_update_state_with_block_updates_nonce_cache(self):
+        nonces = storage.CachedNonceStorage()
+        nonces.set_pending_nonce(sender='abc', processor='def', value=125)
+
+        storage.update_state_with_block(
+            block=block,
+            driver=self.driver,
+            nonces=nonces
+        )
+
+        self.assertEqual(nonces.nonce_cache[('abc', 'def')], 125)
+        self.assertIsNone(nonces.pending_nonce_cache[('abc', 'def')])
+
 
 class TestMasterStorage(TestCase):
     def setUp(self):
@@ -567,10 +818,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block)
@@ -585,10 +836,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -599,14 +850,22 @@ class TestMasterStorage(TestCase):
 
         self.assertEqual(nums, [5, 4, 3])
 
+    def test_get_blocks_returns_range_ascending(self):
+        for i in [5, 1, 3, 2, 4]:
+            self.db.put({'hash': str(i), 'number': i})
+
+        nums = [b['number'] for b in self.db.get_blocks(2, 5)]
+
+        self.assertEqual(nums, [2, 3, 4])
+
     def test_get_none_from_wrong_n_collection(self):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -705,6 +964,117 @@ class TestMasterStorage(TestCase):
 
         self.assertDictEqual(block, got_block)
 
+    def test_store_block_many_txs_stores_all_without_ids(self):
+        txs = [{'hash': f'something{i}', 'key': str(i)} for i in range(1000)]
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': txs[:500]
+                },
+                {
+                    'transactions': txs[500:]
+                }
+            ]
+        }
+
+        self.db.store_block(block)
+
+        for tx in txs:
+            self.assertNotIn('_id', tx)
+
+        self.assertEqual(self.db.txs.count_documents({}), 1000)
+        self.assertDictEqual(self.db.get_tx(h='something999'), txs[999])
+        self.assertDictEqual(self.db.get_block(1), block)
+
+    def test_store_block_no_subblocks_stores_block(self):
+        block = {
+            'hash': 'hello',
+            'number': 1
+        }
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(self.db.get_block(1), block)
+
+    def test_indexes_created_on_init(self):
+        report = self.db.index_report()
+
+        self.assertEqual(report, {'blocks': [], 'tx': []})
+
+    def test_indexes_missing_if_not_ensured(self):
+        self.db.blocks.drop()
+        self.db.txs.drop()
+
+        db = BlockStorage(ensure_indexes=False)
+
+        report = db.index_report()
+
+        self.assertEqual(report, {'blocks': ['number', 'hash'], 'tx': ['hash']})
+
+    def test_duplicates_from_older_versions_do_not_stop_startup(self):
+        self.db.blocks.drop()
+        self.db.txs.drop()
+
+        self.db.blocks.insert_many([{'hash': 'a', 'number': 1}, {'hash': 'a', 'number': 1}, {'hash': 'b', 'number': 2}])
+
+        db = BlockStorage()
+
+        self.assertEqual(db.index_report(), {'blocks': ['number', 'hash'], 'tx': []})
+
+    def test_remove_duplicates_keeps_one_and_allows_indexes(self):
+        self.db.blocks.drop()
+        self.db.txs.drop()
+
+        self.db.blocks.insert_many([
+            {'hash': 'a', 'number': 1, 'copy': 0},
+            {'hash': 'a', 'number': 1, 'copy': 1},
+            {'hash': 'b', 'number': 2},
+            {'hash': 'genesis'}
+        ])
+        self.db.txs.insert_many([{'hash': 'x'}, {'hash': 'x'}, {'hash': 'y'}])
+
+        db = BlockStorage(ensure_indexes=False)
+
+        self.assertEqual(db.remove_duplicates(), {'blocks': 1, 'tx': 1})
+
+        db.create_indexes()
+
+        self.assertEqual(db.index_report(), {'blocks': [], 'tx': []})
+        self.assertEqual(db.get_block(1)['copy'], 0)
+        self.assertEqual(self.db.blocks.count_documents({}), 3)
+        self.assertEqual(self.db.txs.count_documents({}), 2)
+
+    def test_block_and_tx_lookups_use_index(self):
+        for stages in self.db.query_plans().values():
+            self.assertIn('IXSCAN', stages)
+
+    def test_store_block_twice_stores_once(self):
+        tx_1 = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx_1]
+                }
+            ]
+        }
+
+        self.db.store_block(block)
+        self.db.store_block(block)
+
+        self.assertEqual(self.db.blocks.count_documents({}), 1)
+        self.assertEqual(self.db.txs.count_documents({}), 1)
+        self.assertNotIn('_id', block)
+        self.assertNotIn('_id', tx_1)
+
     def test_get_block_v_none_returns_none(self):
         self.assertIsNone(self.db.get_block())
 
@@ -854,3 +1224,390 @@ class TestMasterStorage(TestCase):
         self.assertIsNone(got_1)
         self.assertIsNone(got_2)
         self.assertIsNone(got_3)
+
+
+def make_block(number, txs=2):
+    return {
+        'hash': f'{number:064x}',
+        'number': number,
+        'previous': f'{number - 1:064x}',
+        'subblocks': [
+            {
+                'transactions': [{'hash': f'{number}-{i}', 'key': str(i)} for i in range(txs)]
+            }
+        ]
+    }
+
+
+class TestMemoryBlockStorage(TestCase):
+    def setUp(self):
+        self.db = storage.MemoryBlockStorage()
+
+    def test_store_and_get_block_by_number_and_hash(self):
+        block = make_block(1)
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(self.db.get_block(1), block)
+        self.assertDictEqual(self.db.get_block(block['hash']), block)
+
+    def test_get_block_none_if_missing(self):
+        self.assertIsNone(self.db.get_block(1))
+        self.assertIsNone(self.db.get_block())
+
+    def test_stored_block_is_copied(self):
+        block = make_block(1)
+
+        self.db.store_block(block)
+        block['number'] = 999
+
+        self.assertEqual(self.db.get_block(1)['number'], 1)
+
+    def test_get_tx(self):
+        block = make_block(1)
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(self.db.get_tx('1-1'), block['subblocks'][0]['transactions'][1])
+        self.assertIsNone(self.db.get_tx('2-1'))
+
+    def test_get_last_n(self):
+        for i in range(1, 6):
+            self.db.store_block(make_block(i))
+
+        nums = [b['number'] for b in self.db.get_last_n(3)]
+
+        self.assertEqual(nums, [5, 4, 3])
+
+    def test_get_blocks(self):
+        for i in [5, 1, 3, 2, 4]:
+            self.db.store_block(make_block(i))
+
+        nums = [b['number'] for b in self.db.get_blocks(2, 5)]
+
+        self.assertEqual(nums, [2, 3, 4])
+
+    def test_flush(self):
+        self.db.store_block(make_block(1))
+        self.db.flush()
+
+        self.assertIsNone(self.db.get_block(1))
+        self.assertIsNone(self.db.get_tx('1-1'))
+
+
+class TestFileBlockStorage(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = storage.FileBlockStorage(root=self.dir.name, segment_size=1024)
+
+    def tearDown(self):
+        self.db.close()
+        self.dir.cleanup()
+
+    def test_store_and_get_block_by_number_and_hash(self):
+        block = make_block(1)
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(self.db.get_block(1), block)
+        self.assertDictEqual(self.db.get_block(block['hash']), block)
+
+    def test_get_block_none_if_missing(self):
+        self.assertIsNone(self.db.get_block(1))
+        self.assertIsNone(self.db.get_block('a' * 64))
+        self.assertIsNone(self.db.get_block())
+
+    def test_block_is_stored_as_document(self):
+        block = make_block(1)
+        block['subblocks'][0]['transactions'][0]['state'] = [{'key': 'a', 'value': ContractingDecimal('1.5')}]
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(self.db.get_block(1), json.loads(encode(block)))
+
+    def test_get_tx(self):
+        block = make_block(1)
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(self.db.get_tx('1-1'), block['subblocks'][0]['transactions'][1])
+        self.assertIsNone(self.db.get_tx('2-1'))
+
+    def test_get_last_n(self):
+        for i in range(1, 6):
+            self.db.store_block(make_block(i))
+
+        nums = [b['number'] for b in self.db.get_last_n(3)]
+
+        self.assertEqual(nums, [5, 4, 3])
+
+    def test_get_blocks(self):
+        for i in range(1, 21):
+            self.db.store_block(make_block(i, txs=5))
+
+        nums = [b['number'] for b in self.db.get_blocks(7, 15)]
+
+        self.assertEqual(nums, list(range(7, 15)))
+
+    def test_get_blocks_past_end_is_empty(self):
+        self.db.store_block(make_block(1))
+
+        self.assertEqual(list(self.db.get_blocks(2, 10)), [])
+
+    def test_duplicate_block_not_stored_twice(self):
+        self.db.store_block(make_block(1))
+        self.db.store_block(make_block(1))
+
+        self.assertEqual(len(self.db.get_last_n(10)), 1)
+
+    def test_segments_roll_over(self):
+        for i in range(1, 21):
+            self.db.store_block(make_block(i, txs=5))
+
+        self.assertGreater(self.db.segment, 0)
+
+        for i in range(1, 21):
+            self.assertEqual(self.db.get_block(i)['number'], i)
+
+    def test_reads_after_appends_to_mapped_segment(self):
+        self.db.store_block(make_block(1, txs=0))
+        self.db.get_block(1)
+
+        self.db.store_block(make_block(2, txs=0))
+
+        self.assertEqual(self.db.get_block(2)['number'], 2)
+
+    def test_reopen_loads_index(self):
+        for i in range(1, 21):
+            self.db.store_block(make_block(i, txs=5))
+
+        self.db.close()
+        self.db = storage.FileBlockStorage(root=self.dir.name, segment_size=1024)
+
+        self.assertEqual(self.db.get_block(20)['number'], 20)
+        self.assertEqual(self.db.get_tx('7-3')['key'], '3')
+        self.assertEqual([b['number'] for b in self.db.get_last_n(2)], [20, 19])
+
+        self.db.store_block(make_block(21))
+        self.assertEqual(self.db.get_block(21)['number'], 21)
+
+    def test_partial_index_entry_is_discarded_on_reopen(self):
+        self.db.store_block(make_block(1))
+        self.db.store_block(make_block(2))
+        self.db.close()
+
+        index_path = pathlib.Path(self.dir.name) / storage.FileBlockStorage.INDEX_FILENAME
+        data = index_path.read_bytes()
+        index_path.write_bytes(data[:-5])
+
+        self.db = storage.FileBlockStorage(root=self.dir.name, segment_size=1024)
+
+        self.assertIsNotNone(self.db.get_block(1))
+        self.assertIsNone(self.db.get_block(2))
+
+        self.db.store_block(make_block(2))
+        self.assertEqual(self.db.get_block(2)['number'], 2)
+
+    def test_unindexed_next_segment_is_dropped_on_reopen(self):
+        for i in range(1, 5):
+            self.db.store_block(make_block(i, txs=5))
+
+        # The node stopped after rolling over and writing a block to the new segment, before indexing it
+        orphan = self.db.segment_path(self.db.segment + 1)
+        self.db.close()
+        orphan.write_bytes(encode(make_block(5, txs=5)).encode())
+
+        self.db = storage.FileBlockStorage(root=self.dir.name, segment_size=1024)
+
+        self.assertIsNone(self.db.get_block(5))
+
+        for i in range(5, 21):
+            self.db.store_block(make_block(i, txs=5))
+
+        for i in range(1, 21):
+            self.assertEqual(self.db.get_block(i)['number'], i)
+
+    def test_flush(self):
+        self.db.store_block(make_block(1))
+        self.db.flush()
+
+        self.assertIsNone(self.db.get_block(1))
+        self.assertIsNone(self.db.get_tx('1-1'))
+
+        self.db.store_block(make_block(1))
+        self.assertEqual(self.db.get_block(1)['number'], 1)
+
+
+class TestSnapshots(TestCase):
+    def setUp(self):
+        self.driver = ContractDriver()
+        self.nonces = storage.NonceStorage()
+        self.driver.flush()
+        self.nonces.flush()
+
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.driver.flush()
+        self.nonces.flush()
+        self.dir.cleanup()
+
+    def fill(self, driver):
+        driver.driver.set('currency.balances:stu', ContractingDecimal('123.456'))
+        driver.driver.set('currency.balances:jeff', 10)
+        driver.driver.set('contract.time', Datetime(2020, 1, 1))
+        storage.set_latest_block_height(12, driver)
+        storage.set_latest_block_hash('a' * 64, driver)
+
+        self.nonces.set_nonces({('stu', 'mn1'): 3, ('jeff', 'mn1'): 5})
+
+    def test_make_snapshot_has_height_hash_and_sorted_state(self):
+        self.fill(self.driver)
+
+        snapshot = storage.make_snapshot(self.driver, self.nonces)
+
+        self.assertEqual(snapshot['height'], 12)
+        self.assertEqual(snapshot['hash'], 'a' * 64)
+
+        keys = [key for key, _ in snapshot['state']]
+        self.assertListEqual(keys, sorted(keys))
+        self.assertIn(['currency.balances:jeff', encode(10)], snapshot['state'])
+
+        self.assertListEqual(snapshot['nonces'], [['jeff', 'mn1', 5], ['stu', 'mn1', 3]])
+
+    def test_mongo_and_in_memory_drivers_dump_the_same_snapshot(self):
+        mem = ContractDriver(driver=InMemDriver())
+
+        self.fill(self.driver)
+        self.fill(mem)
+
+        self.assertDictEqual(storage.make_snapshot(self.driver, self.nonces), storage.make_snapshot(mem, self.nonces))
+
+    def test_restore_snapshot_replaces_state_and_nonces(self):
+        self.fill(self.driver)
+        snapshot = storage.make_snapshot(self.driver, self.nonces)
+
+        self.driver.flush()
+        self.nonces.flush()
+        self.driver.driver.set('stale.key', 1)
+        self.nonces.set_nonce(sender='stale', processor='mn1', value=1)
+        self.nonces.set_pending_nonce(sender='stu', processor='mn1', value=9)
+
+        self.assertTrue(storage.restore_snapshot(snapshot, self.driver, self.nonces))
+
+        self.assertIsNone(self.driver.driver.get('stale.key'))
+        self.assertEqual(self.driver.driver.get('currency.balances:stu'), ContractingDecimal('123.456'))
+        self.assertEqual(self.driver.driver.get('contract.time'), Datetime(2020, 1, 1))
+        self.assertEqual(storage.get_latest_block_height(self.driver), 12)
+        self.assertEqual(storage.get_latest_block_hash(self.driver), 'a' * 64)
+
+        self.assertIsNone(self.nonces.get_nonce(sender='stale', processor='mn1'))
+        self.assertIsNone(self.nonces.get_pending_nonce(sender='stu', processor='mn1'))
+        self.assertEqual(self.nonces.get_nonce(sender='stu', processor='mn1'), 3)
+
+        self.assertDictEqual(storage.make_snapshot(self.driver, self.nonces), snapshot)
+
+    def test_restore_snapshot_into_in_memory_driver(self):
+        self.fill(self.driver)
+        snapshot = json.loads(encode(storage.make_snapshot(self.driver, self.nonces)))
+
+        mem = ContractDriver(driver=InMemDriver())
+        self.assertTrue(storage.restore_snapshot(snapshot, mem, self.nonces))
+
+        self.assertEqual(mem.driver.get('currency.balances:stu'), ContractingDecimal('123.456'))
+        self.assertEqual(storage.get_latest_block_height(mem), 12)
+
+    def test_restore_snapshot_rejects_tampered_content(self):
+        self.fill(self.driver)
+        snapshot = storage.make_snapshot(self.driver, self.nonces)
+        snapshot['state'][0][1] = encode(1_000_000)
+
+        self.driver.driver.set('currency.balances:jeff', 11)
+
+        self.assertFalse(storage.restore_snapshot(snapshot, self.driver, self.nonces))
+        self.assertEqual(self.driver.driver.get('currency.balances:jeff'), 11)
+
+    def test_snapshot_storage_keeps_latest(self):
+        snapshots = storage.SnapshotStorage(root=self.dir.name, keep=2)
+        self.assertIsNone(snapshots.get())
+
+        for height in (10, 20, 30):
+            snapshots.save({'height': height, 'hash': 'a' * 64, 'content_hash': '', 'state': [], 'nonces': []})
+
+        self.assertListEqual(snapshots.heights(), [20, 30])
+        self.assertEqual(snapshots.get()['height'], 30)
+        self.assertIsNone(snapshots.get(10))
+
+    def test_snapshot_storage_reads_from_disk(self):
+        self.fill(self.driver)
+        snapshot = storage.make_snapshot(self.driver, self.nonces)
+
+        storage.SnapshotStorage(root=self.dir.name).save(snapshot)
+
+        snapshots = storage.SnapshotStorage(root=self.dir.name)
+        header = snapshots.get(12)
+
+        self.assertEqual(header['hash'], snapshot['hash'])
+        self.assertEqual(header['content_hash'], snapshot['content_hash'])
+        self.assertEqual(header['state'], len(snapshot['state']))
+        self.assertListEqual(snapshots.read(12, 'state', 0, header['state']), snapshot['state'])
+        self.assertListEqual(snapshots.read(12, 'nonces', 0, header['nonces']), snapshot['nonces'])
+
+    def test_snapshot_storage_reads_any_range(self):
+        snapshots = storage.SnapshotStorage(root=self.dir.name, stride=3)
+        state = [[str(i), encode(i)] for i in range(10)]
+
+        snapshots.save({'height': 1, 'hash': 'a' * 64, 'state': state, 'nonces': [['stu', 'mn1', 1]]})
+
+        for start in range(12):
+            for end in range(start, 12):
+                self.assertListEqual(snapshots.read(1, 'state', start, end), state[start:end])
+
+        self.assertListEqual(snapshots.read(1, 'nonces', 0, 5), [['stu', 'mn1', 1]])
+        self.assertListEqual(snapshots.read(1, 'nonces', 1, 5), [])
+        self.assertIsNone(snapshots.read(2, 'state', 0, 5))
+
+    def test_take_streams_state_and_nonces(self):
+        self.fill(self.driver)
+        snapshot = storage.make_snapshot(self.driver, self.nonces)
+
+        snapshots = storage.SnapshotStorage(root=self.dir.name)
+        header = snapshots.take(height=12, block_hash='a' * 64, driver=self.driver, nonces=self.nonces)
+
+        self.assertEqual(header['content_hash'], snapshot['content_hash'])
+
+        restored = {
+            'height': 12,
+            'hash': 'a' * 64,
+            'content_hash': header['content_hash'],
+            'state': snapshots.read(12, 'state', 0, header['state']),
+            'nonces': snapshots.read(12, 'nonces', 0, header['nonces'])
+        }
+
+        self.assertDictEqual(restored, snapshot)
+
+    def test_restore_snapshot_sets_height_and_hash_of_the_snapshot(self):
+        self.fill(self.driver)
+        snapshot = storage.make_snapshot(self.driver, self.nonces)
+
+        # Blocks committed while the state was read
+        storage.set_latest_block_height(13, self.driver)
+        storage.set_latest_block_hash('b' * 64, self.driver)
+        state = [[key, value] for key, value in storage.dump_state(self.driver)]
+
+        snapshot['state'] = state
+        snapshot['content_hash'] = storage.snapshot_content_hash(state, snapshot['nonces'])
+
+        self.assertTrue(storage.restore_snapshot(snapshot, self.driver, self.nonces))
+
+        self.assertEqual(storage.get_latest_block_height(self.driver), 12)
+        self.assertEqual(storage.get_latest_block_hash(self.driver), 'a' * 64)
+
+    def test_snapshot_storage_flush(self):
+        snapshots = storage.SnapshotStorage(root=self.dir.name)
+        snapshots.save({'height': 1, 'hash': 'a' * 64, 'content_hash': '', 'state': [], 'nonces': []})
+
+        snapshots.flush()
+
+        self.assertListEqual(snapshots.heights(), [])
+        self.assertIsNone(snapshots.get())